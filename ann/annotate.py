@@ -10,11 +10,21 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import bisect
+import threading
 import file_utils as fu
 import utils as u
+import pipeline
+import interval_index
+import queries
+import ucsc_bin
+import vcf_record
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
+# Guards counters that query() updates from several threads
+countsLock = threading.Lock()
+
 def collapseGeneNames(row, indices, region, cnt):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
         'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
@@ -72,7 +82,9 @@ def binarySearchUniqueAndSorted(arg0, key):
     return -1 # NOT_FOUND
 
 
-"""Cleans characters not accepted by MySQL
+"""Cleans characters not accepted by MySQL. The lookups bind their
+values as parameters now, but alleles are still matched without their
+quotes, as they were when they were written into the SQL
 """
 def clean_mysql_chars(entry):
     entry = entry.replace("\"", "")
@@ -107,206 +119,871 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
+"""Chromosome naming helpers. Some reference tables key on "chr1",
+others on plain "1"
+"""
+def chromWithPrefix(chr):
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
+    return chr
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
+def chromWithoutPrefix(chr):
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
+    return chr
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
+"""Adds text to the end of the INFO field of a split VCF record
+"""
+def addInfo(fields, text):
+    if isinstance(fields, vcf_record.VcfRecord):
+        fields.addInfo(text)
+    else:
+        fields[7] = fields[7] + text
 
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
 
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+"""Appends an annotation to the INFO field of a split VCF record
+"""
+def appendInfo(fields, text):
+    if isinstance(fields, vcf_record.VcfRecord):
+        fields.appendInfo(text)
+    elif str(fields[7]).endswith(';'):
+        fields[7] = fields[7] + text
+    else:
+        fields[7] = fields[7] + ';' + text
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+"""Loads distinct lookup keys into a per-connection temporary table
+so a stage can resolve all of them with a single join. Keys are
+(chrom, pos[, ref[, alt]]) tuples; the key's position in the list is
+used as its id
+"""
+def loadJobKeys(cursor, keys):
+    cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS job_keys (' + \
+        'id INT NOT NULL PRIMARY KEY, chrom VARCHAR(64), pos BIGINT, ' + \
+        'ref VARCHAR(255), alt VARCHAR(255), compRef VARCHAR(255), ' + \
+        'compAlt VARCHAR(255), KEY chrom_pos (chrom, pos));')
+    cursor.execute('DELETE FROM job_keys;')
+
+    values = []
+    for id, key in enumerate(keys):
+        ref = key[2] if (len(key) > 2) else None
+        alt = key[3] if (len(key) > 3) else None
+        values.append((id, key[0], key[1], ref, alt,
+            getComplementary(ref) if (ref is not None) else None,
+            getComplementary(alt) if (alt is not None) else None))
+
+    if (len(values) > 0):
+        cursor.executemany('INSERT INTO job_keys VALUES ' + \
+            '(%s, %s, %s, %s, %s, %s, %s)', values)
+
+
+"""Groups the (id, row...) results of a join against job_keys by key
+Only the first row of each key is kept unless fetchAll is set. The
+joins are straight joins from job_keys, so the table is looked up once
+per key and each key's rows come in the order the per-variant query
+would return them
+"""
+def groupJobRows(keys, rows, fetchAll=True):
+    found = {}
+    for row in rows:
+        key = keys[row[0]]
+        if key not in found:
+            found[key] = [row[1:]]
+        elif fetchAll:
+            found[key].append(row[1:])
+    return found
+
+
+"""Base class for annotation stages
+
+A stage turns a split record into a lookup key, resolves the key
+against the reference database, and writes what it found into the
+record. Stages keep their own counters and write them to the
+.count.log file at the end of the run. See pipeline.py for the engine
+that runs a list of stages over a VCF file.
+
+index is an interval_index.IntervalIndexCache set by the engine when
+range lookups should be served from memory instead of MySQL; sweep is
+a sweep.SweepJoin set for sweepable stages when the input may be sorted.
+snapshot is a snapshot.Snapshot set when the reference tables are read
+from a local snapshot; every stage then works without the database.
+hashes is a hash_index.HashIndexCache that serves the stages looked up
+by exact position (dbSNP, BigRefGene, gwasCatalog) from memory.
+bloom is a bloom.BloomFilters over the dbSNP positions; lookups of
+positions it rules out are skipped. bins is True when the range tables
+carry UCSC bins (see ucsc_bin), so range queries also narrow the rows
+by bin and can seek on the (chrom, bin, start) indexes. Read through
+those indexes, rows would come back grouped by bin, so binned queries
+order them by start instead. The plain per-variant queries, the
+interval index, the sweep join and the snapshot all return rows in
+table order, the order in which MySQL reads the table for the query.
+Binned queries find the same rows, but where a position overlaps
+several and the table is not read in order of start, they list them
+in another order.
+
+depends lists the labels of the stages whose annotation the stage
+reads from the record. Stages without dependencies between them are
+looked up concurrently by the engine. writesId is True for stages that
+rewrite the ID column. The per-variant queries of pipelined stages may
+be run several at a time (see async_lookup), so their query() must be
+safe to call from several threads.
+
+infoKeys lists the INFO keys (and flags) the stage writes, by which
+re-annotation finds the stage's entries in an annotated record (see
+reannotate.py); padsRecord is True for the stage that puts a space in
+front of the columns of the records it annotates. name and version
+identify the reference data behind the stage in the header of the
+annotated file; they are set by driver.build_stages().
+"""
+class Stage(object):
+    label = ''
+    depends = ()
+    writesId = False
+    infoKeys = ()
+    padsRecord = False
+    name = ''
+    version = ''
+    index = None
+    sweep = None
+    snapshot = None
+    hashes = None
+    bloom = None
+    bins = False
+    sweepable = False
+    pipelined = False
+
+    def __init__(self, format='vcf'):
+        self.inds = getFormatSpecificIndices(format=format)
+        self.counts = {}
+
+    # Lookup key for the record, or None to leave the record untouched
+    def key(self, fields):
+        return None
+
+    # Rows from the reference database for a key
+    def query(self, cursor, key):
+        return ()
+
+    # Rows for a list of distinct keys, as a dict keyed by key. Stages
+    # that can resolve every key with one set-based join override this
+    def bulk_query(self, cursor, keys):
+        found = {}
+        for key in keys:
+            found[key] = self.query(cursor, key)
+        return found
+
+    # True when lookups are served locally, in which case the engine
+    # always hands the stage whole chunks through bulk_query()
+    def indexed(self):
+        return self.snapshot is not None
+
+    # Values of the record's INFO that annotate() reads, beyond what
+    # key() covers, for the key of the variant cache (see variant_cache)
+    def infoInputs(self, fields):
+        return None
+
+    # (table, chrom column, start column, end column) of every table the
+    # stage queries by range, for the bin indexes (see ucsc_bin)
+    def rangeTables(self):
+        return []
+
+    # Adds the annotation for the rows returned by query() to the record
+    def annotate(self, fields, rows):
+        pass
+
+    def report(self, fh_log):
+        pass
+
+
+"""Base class for stages that look for reference regions which
+contain the variant position
+"""
+class OverlapStage(Stage):
+    chromColumn = 'chrom'
+    startColumn = 'chromStart'
+    endColumn = 'chromEnd'
+    chrPrefix = True
+    fetchAll = True
+    sweepable = True
+    pipelined = True
+
+    def __init__(self, format='vcf', table=None):
+        Stage.__init__(self, format=format)
+        self.table = table
+        self.label = table
+        self.infoKeys = (str(table),)
+        self.counts = {'var_count': 0, 'line_count': 0}
+        self.statement = queries.register(str(table) + '.overlap',
+            'select * from ' + str(table) + ' where ' + self.chromColumn + \
+            ' = %s AND (' + self.startColumn + ' <= %s AND %s <= ' + \
+            self.endColumn + ');')
+        self.binStatement = queries.register(str(table) + '.overlap.bin',
+            'select * from ' + str(table) + ' where ' + self.chromColumn + \
+            ' = %s AND ' + ucsc_bin.predicate() + ' AND (' + \
+            self.startColumn + ' <= %s AND %s <= ' + self.endColumn + \
+            ') order by ' + self.startColumn + ';')
+
+    def key(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if self.chrPrefix:
+            chr = chromWithPrefix(chr)
+        else:
+            chr = chromWithoutPrefix(chr)
+        return (chr, fields[self.inds[1]].strip())
+
+    def query(self, cursor, key):
+        chr, pos = key
+        if self.index is not None:
+            rows = self.index.overlapping(cursor, self.table,
+                self.chromColumn, chr, pos, self.startColumn, self.endColumn)
+            return rows if self.fetchAll else rows[:1]
+
+        bins = ucsc_bin.params(pos, pos) if self.bins else None
+        if bins is not None:
+            queries.execute(cursor, self.binStatement,
+                (chr,) + bins + (int(pos), int(pos)))
+        else:
+            queries.execute(cursor, self.statement, (chr, int(pos), int(pos)))
+        if self.fetchAll:
+            return cursor.fetchall()
+
+        row = cursor.fetchone()
+        if row is None:
+            return ()
+        return (row,)
+
+    def bulk_query(self, cursor, keys):
+        if self.sweep is not None:
+            return self.sweepBatch(cursor, keys)
+        if self.index is not None:
+            return self.indexBatch(cursor, keys, self.table,
+                self.chromColumn, self.startColumn, self.endColumn)
+
+        loadJobKeys(cursor, keys)
+        sql = 'select k.id, t.* from job_keys k straight_join ' + \
+            self.table + ' t on t.' + self.chromColumn + ' = k.chrom ' + \
+            'AND t.' + self.startColumn + ' <= k.pos AND k.pos <= t.' + \
+            self.endColumn + ';'
+        cursor.execute(sql)
+        return groupJobRows(keys, cursor.fetchall(), self.fetchAll)
+
+    def indexed(self):
+        return (self.index is not None or self.sweep is not None)
+
+    def rangeTables(self):
+        return [(self.table, self.chromColumn, self.startColumn,
+            self.endColumn)]
+
+    # Rows of a chromosome in table order, for the sweep join
+    def sweepQuery(self, chr):
+        return (interval_index.chromosome_statement(self.table,
+            self.chromColumn), (chr,))
+
+    # Keys arrive in input order; any the sweep cannot serve are looked
+    # up one at a time
+    def sweepBatch(self, cursor, keys):
+        found = {}
+        for key in keys:
+            rows = self.sweep.overlapping(key[0], int(key[1]))
+            if rows is None:
+                found[key] = self.query(cursor, key)
+            else:
+                found[key] = rows if self.fetchAll else rows[:1]
+        return found
+
+    # Resolves the keys one chromosome at a time with the batch kernel
+    def indexBatch(self, cursor, keys, table, chromColumn,
+        startColumn='chromStart', endColumn='chromEnd', columns='*'):
+        byChrom = {}
+        for key in keys:
+            byChrom.setdefault(key[0], []).append(key)
+
+        found = {}
+        for chr, chromKeys in byChrom.items():
+            t = table(chr) if callable(table) else table
+            hits = self.index.overlapping_batch(cursor, t, chromColumn, chr,
+                [key[1] for key in chromKeys], startColumn, endColumn, columns)
+            for key, rows in zip(chromKeys, hits):
+                found[key] = rows if self.fetchAll else rows[:1]
+        return found
+
+    def report(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: " + \
+            f"{str(self.counts['var_count'])} in " + \
+            f"{str(self.counts['line_count'])} variants\n")
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
 
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+""" 
+class DbSnpStage(Stage):
+    label = 'dbSNP'
+    writesId = True
+    infoKeys = ('DB', 'VC', 'GMAF')
+    pipelined = True
+
+    statement = queries.register('dbSNP', 'select * from dbSNP ' + \
+        'where CHR = %s AND POS = %s AND (REF = %s OR REF = %s) AND ' + \
+        'INFO = %s;')
+
+    def __init__(self, format='vcf', varclass='SNV'):
+        Stage.__init__(self, format=format)
+        self.varclass = varclass
+        self.counts = {'records': 0, 'var_count': 0}
+
+    def key(self, fields):
+        chr = chromWithoutPrefix(fields[self.inds[0]].strip())
+        pos = fields[self.inds[1]].strip()
+        ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+        return (chr, pos, ref)
+
+    def query(self, cursor, key):
+        chr, pos, ref = key
+        if not self.mayHave(key):
+            return ()
+        compRef = getComplementary(ref)
+        if self.snapshot is not None:
+            return self.snapshotQuery(chr, pos, ref, compRef)
+        if self.hashes is not None:
+            rows = self.hashes.probe(cursor, 'dbSNP', chr, pos, (ref,),
+                where=('INFO', self.varclass))
+            return self.matchRef(rows, self.hashes.column('dbSNP', 'REF'),
+                ref, compRef)
+
+        queries.execute(cursor, self.statement,
+            (chr, int(pos), ref, compRef, self.varclass))
+        return cursor.fetchall()
+
+    # False if the Bloom filter rules the key out, which is counted as
+    # an avoided lookup. Only keys actually looked up are counted, not
+    # those served by the variant cache
+    def mayHave(self, key):
+        if self.bloom is None:
+            return True
+        if self.bloom.may_contain(key[0], key[1]):
+            with countsLock:
+                self.counts.setdefault('bloom_avoided', 0)
+            return True
+        with countsLock:
+            self.counts['bloom_avoided'] = \
+                self.counts.get('bloom_avoided', 0) + 1
+        return False
+
+    # Rows whose REF (column r) is ref or compRef. MySQL compares
+    # strings without regard to case
+    def matchRef(self, rows, r, ref, compRef):
+        refs = (ref.upper(), compRef.upper())
+        return [row for row in rows if str(row[r]).upper() in refs]
+
+    def snapshotQuery(self, chr, pos, ref, compRef):
+        i = self.snapshot.column('dbSNP', 'INFO')
+        rows = [row for row in self.snapshot.equal('dbSNP', chr, pos)
+            if (str(row[i]).upper() == self.varclass.upper())]
+        return self.matchRef(rows, self.snapshot.column('dbSNP', 'REF'),
+            ref, compRef)
+
+    def indexed(self):
+        return (self.snapshot is not None or self.hashes is not None)
+
+    def bulk_query(self, cursor, keys):
+        if self.indexed():
+            return Stage.bulk_query(self, cursor, keys)
+
+        keys = [key for key in keys if self.mayHave(key)]
+        if (len(keys) == 0):
+            return {}
+        loadJobKeys(cursor, keys)
+        sql = 'select k.id, t.* from job_keys k straight_join dbSNP t ' + \
+            'on t.CHR = k.chrom AND t.POS = k.pos AND ' + \
+            '(t.REF = k.ref OR t.REF = k.compRef) AND t.INFO = %s;'
+        cursor.execute(sql, (self.varclass,))
+        return groupJobRows(keys, cursor.fetchall())
+
+    def annotate(self, fields, rows):
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2] = '.'
+        if (len(rows) > 0):
+            rsids = []
+            mafs = []
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
+
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+            self.counts['var_count'] = self.counts['var_count'] + 1
+            if (str(fields[7]) == '.'):
+                fields[7] = 'DB' + maf_str
             else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+                addInfo(fields, ';DB;VC=' + self.varclass + maf_str)
 
-            linenum = linenum + 1
+            fields[2] = str(';'.join(rsids))
 
-        else:
-            fh_out.write(line + '\n')
+        self.counts['records'] = self.counts['records'] + 1
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    def report(self, fh_log):
+        linenum = self.counts['records'] + 1
+        var_count = self.counts['var_count']
+        ratioInDbSnp = (var_count / float(linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
+        if ('bloom_avoided' in self.counts):
+            fh_log.write("dbSNP lookups avoided by Bloom filter: " + \
+                f"{str(self.counts['bloom_avoided'])}\n")
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t'):
+    pipeline.run_stages(vcf, vcf + tmpextout, vcf + '.count.log',
+        [DbSnpStage(format=format, varclass=varclass)], logmode='w', sep=sep)
 
 
 """NOTE: all isoforms are collapsed in one record
     1. chrom_pos_equal_base
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
+A variant takes the rows of the first tier that matches it. The tiers
+are looked up with one statement per variant, each tier guarded by the
+absence of a match in the tiers before it
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
+class BigRefGeneStage(Stage):
+    label = 'BigRefGene'
+    # Columns of the rows written by collapseRefSeq()
+    infoKeys = ('name', 'name2', 'transcriptStrand', 'positionType', 'frame',
+        'mrnaCoord', 'codonCoord', 'spliceDist', 'referenceCodon',
+        'referenceAA', 'variantCodon', 'variantAA', 'changesAA',
+        'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+        'inCodingRegion', 'spliceInfo', 'uorfChange')
+
+    equalBase = 'select * from chrom_pos_equal_base where CHR = %s ' + \
+        'AND start = %s AND ((haplotypeReference = %s AND ' + \
+        'haplotypeAlternate = %s) OR (haplotypeReference = %s AND ' + \
+        'haplotypeAlternate = %s))'
+    equalNobase = 'select * from chrom_pos_equal_nobase where CHR = %s ' + \
+        'AND start = %s'
+    unequal = 'select * from chrom_pos_unequal where CHR = %s AND ' + \
+        'start <= %s AND %s <= end'
+    tiered = queries.register('BigRefGene', equalBase + ' UNION ALL ' + \
+        equalNobase + ' AND NOT EXISTS (' + equalBase + ') UNION ALL ' + \
+        unequal + ' AND NOT EXISTS (' + equalBase + ') AND NOT EXISTS (' + \
+        equalNobase + ');')
+    rangeTier = queries.register('BigRefGene.unequal', unequal + ';')
+
+    def __init__(self, format='vcf'):
+        Stage.__init__(self, format=format)
+        self.counts = {'variants': 0, 'lookups': 0}
+
+    def key(self, fields):
+        chr = chromWithoutPrefix(fields[self.inds[0]].strip())
+        pos = fields[self.inds[1]].strip()
+        ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+        alt = clean_mysql_chars(fields[self.inds[3]]).strip()
+        return (chr, pos, ref, alt)
+
+    def query(self, cursor, key):
+        chr, pos, ref, alt = key
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+        self.counts['variants'] = self.counts['variants'] + 1
+        if self.snapshot is not None:
+            return self.snapshotQuery(chr, pos, ref, alt, compRef, compAlt)
+
+        pos = int(pos)
+        base = (chr, pos, ref, alt, compRef, compAlt)
+        nobase = (chr, pos)
+        unequal = (chr, pos, pos)
+        if self.hashes is not None:
+            rows = self.hashTiers(cursor, chr, pos, ref, alt)
             if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
+                return rows
+            statement, params = self.rangeTier, unequal
+        else:
+            statement = self.tiered
+            params = base + nobase + base + unequal + base + nobase
+
+        self.counts['lookups'] = self.counts['lookups'] + 1
+        queries.execute(cursor, statement, params)
+        return cursor.fetchall()
+
+    # chrom_pos_equal_base rows whose haplotypes (columns r and a) are
+    # ref/alt or their complements, compared as MySQL does
+    def matchAlleles(self, rows, r, a, ref, alt):
+        alleles = ((ref.upper(), alt.upper()),
+            (getComplementary(ref).upper(), getComplementary(alt).upper()))
+        return [row for row in rows
+            if (str(row[r]).upper(), str(row[a]).upper()) in alleles]
+
+    def snapshotQuery(self, chr, pos, ref, alt, compRef, compAlt):
+        s = self.snapshot
+        rows = self.matchAlleles(s.equal('chrom_pos_equal_base', chr, pos),
+            s.column('chrom_pos_equal_base', 'haplotypeReference'),
+            s.column('chrom_pos_equal_base', 'haplotypeAlternate'), ref, alt)
+        if (len(rows) == 0):
+            rows = s.equal('chrom_pos_equal_nobase', chr, pos)
+        if (len(rows) == 0):
+            rows = s.span('chrom_pos_unequal', chr, pos, pos)
+        return rows
+
+    # The two equality tiers, from the hash indexes
+    def hashTiers(self, cursor, chr, pos, ref, alt):
+        h = self.hashes
+        rows = self.matchAlleles(h.probe(cursor, 'chrom_pos_equal_base',
+            chr, pos, (ref, alt)),
+            h.column('chrom_pos_equal_base', 'haplotypeReference'),
+            h.column('chrom_pos_equal_base', 'haplotypeAlternate'), ref, alt)
+        if (len(rows) == 0):
+            rows = h.probe(cursor, 'chrom_pos_equal_nobase', chr, pos)
+        return rows
+
+    def indexed(self):
+        return (self.snapshot is not None or self.hashes is not None)
+
+    # Each tier is joined against the keys no earlier tier matched; the
+    # matched keys are dropped from job_keys in between. MySQL cannot
+    # refer to a temporary table twice in one statement, so the tiers
+    # cannot be one UNION here. With hash indexes only the keys that
+    # neither equality tier matched are joined, against the range tier
+    def bulk_query(self, cursor, keys):
+        if self.snapshot is not None:
+            return Stage.bulk_query(self, cursor, keys)
+
+        found = {}
+        self.counts['variants'] = self.counts['variants'] + len(keys)
+        if self.hashes is not None:
+            for key in keys:
+                rows = self.hashTiers(cursor, key[0], key[1], key[2], key[3])
                 if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+                    found[key] = rows
+            keys = [key for key in keys if key not in found]
+            if (len(keys) == 0):
+                return found
+
+        loadJobKeys(cursor, keys)
+        tiers = [
+            'select k.id, t.* from job_keys k straight_join ' + \
+            'chrom_pos_equal_base t on t.CHR = k.chrom AND ' + \
+            't.start = k.pos AND ' + \
+            '((t.haplotypeReference = k.ref AND ' + \
+            't.haplotypeAlternate = k.alt) OR ' + \
+            '(t.haplotypeReference = k.compRef AND ' + \
+            't.haplotypeAlternate = k.compAlt));',
+            'select k.id, t.* from job_keys k straight_join ' + \
+            'chrom_pos_equal_nobase t on t.CHR = k.chrom AND ' + \
+            't.start = k.pos;',
+            'select k.id, t.* from job_keys k straight_join ' + \
+            'chrom_pos_unequal t on t.CHR = k.chrom AND ' + \
+            't.start <= k.pos AND k.pos <= t.end;']
+        if self.hashes is not None:
+            tiers = tiers[2:]
+
+        ids = dict([(key, id) for id, key in enumerate(keys)])
+        for i, sql in enumerate(tiers):
+            self.counts['lookups'] = self.counts['lookups'] + 1
+            cursor.execute(sql)
+            matched = groupJobRows(keys, cursor.fetchall())
+            found.update(matched)
+            if (len(matched) > 0) and (i < len(tiers) - 1):
+                cursor.execute('DELETE FROM job_keys WHERE id IN (' + \
+                    ','.join([str(ids[key]) for key in matched]) + ');')
+        return found
+
+    def annotate(self, fields, rows):
+        if (len(rows) > 0):
+            m = set([])
+            for row in rows:
+                m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+
+            fields[7] = fields[7] + ';' + ';'.join(m)
+            if (str(fields[7]).startswith(".;")):
+                fields[7] = str(fields[7]).replace('.;', '', 1)
+
+    # Database statements issued per variant looked up. Variants taken
+    # from the variant cache are neither looked up nor counted
+    def report(self, fh_log):
+        variants = self.counts['variants']
+        lookups = self.counts['lookups']
+        perVariant = (lookups / float(variants)) if (variants > 0) else 0.0
+        fh_log.write(f"BigRefGene lookups: {str(lookups)} for " + \
+            f"{str(variants)} variants ({str(perVariant)} per variant)\n")
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    pipeline.run_stages(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log',
+        [BigRefGeneStage(format=format)], logmode='a', sep=sep)
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+"""A refGene row with its exon bounds parsed into int lists
+maxEnds[e] is the largest end among exons 0..e, so the exons that
+contain a position are found with a binary search even if exons
+overlap. Rows whose exons are not in start order are scanned instead
+"""
+class Transcript(object):
+    def __init__(self, row):
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.strand = str(row[3])
+        exonStarts = str(row[9].decode("utf-8")).split(',')
+        exonEnds = str(row[10].decode("utf-8")).split(',')
+        self.exonStarts = [int(exonStarts[e]) for e in range(self.exonCount)]
+        self.exonEnds = [int(exonEnds[e]) for e in range(self.exonCount)]
+
+        self.maxEnds = []
+        for end in self.exonEnds:
+            self.maxEnds.append(max(end, self.maxEnds[-1]) if self.maxEnds
+                else end)
+        self.sorted = all([self.exonStarts[e] <= self.exonStarts[e + 1]
+            for e in range(self.exonCount - 1)])
+
+    # Exons with start <= pos <= end, in exon order
+    def exonsAt(self, pos):
+        if not self.sorted:
+            return [e for e in range(self.exonCount) if
+                u.isBetween(pos, self.exonStarts[e], self.exonEnds[e])]
+
+        hi = bisect.bisect_right(self.exonStarts, pos)
+        lo = bisect.bisect_left(self.maxEnds, pos, 0, hi)
+        return [e for e in range(lo, hi) if self.exonEnds[e] >= pos]
+
+
+"""First CpG island, in table order, that contains the position, or
+None; the row the per-transcript cpgIslandExt query fetched first.
+cpgIslandExt is small, so every annotator process keeps the
+chromosomes it looks up in memory
+"""
+def cpgIslandAt(cursor, chr, pos):
+    rows = interval_index.table_index('cpgIslandExt',
+        columns='chrom, chromStart, chromEnd, name').overlapping(
+        cursor, chr, pos)
+    return rows[0] if (len(rows) > 0) else None
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+"""Get information about location in gene structures
+"""
+class GenesStage(Stage):
+    label = 'Genes'
+    # positionType is written by BigRefGene
+    depends = ('BigRefGene',)
+    infoKeys = ('name2', 'name', 'transcriptStrand', 'positionType', 'exon',
+        'non_coding_exon', 'intron', 'putativePromoterRegion')
+    positionTypes = {'intron': 'intronic_count',
+        'non_coding_intron': 'non_coding_intronic_count', 'CDS': 'cds_count',
+        'non_coding_exon': 'non_coding_exonic_count', 'utr5': 'utr5_count',
+        'utr3': 'utr3_count'}
+
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500):
+        Stage.__init__(self, format=format)
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.statement = queries.register(table + '.transcripts',
+            'select * from ' + table + ' where chrom = %s AND ' + \
+            '(txStart - %s) <= %s AND %s <= (txEnd + %s);')
+        # The same transcripts as txStart <= pos + offset AND
+        # pos - offset <= txEnd, which an index on txStart can serve
+        self.binStatement = queries.register(table + '.transcripts.bin',
+            'select * from ' + table + ' where chrom = %s AND ' + \
+            ucsc_bin.predicate() + ' AND txStart <= %s AND %s <= txEnd ' + \
+            'order by txStart;')
+        self.counts = {'interGenic_count': 0, 'cds_count': 0,
+            'utr3_count': 0, 'utr5_count': 0, 'intronic_count': 0,
+            'non_coding_intronic_count': 0, 'exonic_count': 0,
+            'non_coding_exonic_count': 0, 'promoter_count': 0}
+        self.transcripts = {}
+
+    def key(self, fields):
+        chr = chromWithPrefix(fields[self.inds[0]].strip())
+        return (chr, fields[self.inds[1]].strip())
+
+    # Returns (row, region, exonic hits, promoter hits) for every
+    # transcript whose promoter-extended span contains the position
+    def query(self, cursor, key):
+        chr, pos = key
+        if self.snapshot is not None:
+            rows = self.snapshot.span(self.table, chr,
+                int(pos) - int(self.promoter_offset),
+                int(pos) + int(self.promoter_offset))
+        else:
+            lo = int(pos) - int(self.promoter_offset)
+            hi = int(pos) + int(self.promoter_offset)
+            bins = ucsc_bin.params(lo, hi) if self.bins else None
+            if bins is not None:
+                queries.execute(cursor, self.binStatement,
+                    (chr,) + bins + (hi, lo))
+            else:
+                queries.execute(cursor, self.statement, (chr,
+                    int(self.promoter_offset), int(pos), int(pos),
+                    int(self.promoter_offset)))
+            rows = cursor.fetchall()
 
-            vcf_linenum = vcf_linenum + 1
+        hits = []
+        for row in rows:
+            hits.append((row,) + self.locate(
+                lambda: self.cpgIsland(cursor, chr, pos), int(pos), row))
+        return hits
+
+    def rangeTables(self):
+        return [(self.table, 'chrom', 'txStart', 'txEnd')]
+
+    def cpgIsland(self, cursor, chr, pos):
+        if self.snapshot is not None:
+            rows = self.snapshot.span('cpgIslandExt', chr, pos, pos)
+            return rows[0] if (len(rows) > 0) else None
+        return cpgIslandAt(cursor, chr, pos)
+
+    # Transcripts for all keys with one join
+    def bulk_query(self, cursor, keys):
+        if self.snapshot is not None:
+            return Stage.bulk_query(self, cursor, keys)
+
+        loadJobKeys(cursor, keys)
+        sql = 'select k.id, t.* from job_keys k straight_join ' + \
+            self.table + ' t on t.chrom = k.chrom AND (t.txStart - ' + \
+            str(self.promoter_offset) + ') <= k.pos AND ' + \
+            'k.pos <= (t.txEnd + ' + str(self.promoter_offset) + \
+            ');'
+        cursor.execute(sql)
+        transcripts = groupJobRows(keys, cursor.fetchall())
+
+        found = {}
+        for key in keys:
+            chr, pos = key
+            hits = []
+            for row in transcripts.get(key, ()):
+                hits.append((row,) + self.locate(
+                    lambda: self.cpgIsland(cursor, chr, pos), int(pos), row))
+            found[key] = hits
+        return found
+
+    # Transcripts repeat across variants, so each row is parsed once.
+    # The cache is dropped when it reaches transcriptCacheSize
+    transcriptCacheSize = 100000
+
+    def transcript(self, row):
+        t = self.transcripts.get(row)
+        if t is None:
+            if (len(self.transcripts) >= self.transcriptCacheSize):
+                self.transcripts = {}
+            t = Transcript(row)
+            self.transcripts[row] = t
+        return t
+
+    # cpgIsland is called only when the position falls in the promoter
+    # window of the transcript
+    def locate(self, cpgIsland, pos, row):
+        t = self.transcript(row)
+        promoter_plus = t.txStart - int(self.promoter_offset)
+        promoter_minus = t.txEnd + int(self.promoter_offset)
+        region = ""
+        exonic = 0
+        promoter = 0
+        exons = []
+
+        if (t.cdsStart == t.cdsEnd):
+            for e in t.exonsAt(pos):
+                exnum = e + 1
+                if (t.strand == '-'):
+                    exnum = t.exonCount - e
+                exons.append("non_coding_exon=" + "ex" + \
+                    str(exnum) + '/' + str(t.exonCount))
+            if (len(exons) > 0):
+                region = ";".join(exons)
+        elif (u.isBetween(pos, t.cdsStart, t.cdsEnd)):
+            for e in t.exonsAt(pos):
+                exnum = e + 1
+                if (t.strand == '-'):
+                    exnum = t.exonCount - e
+                exons.append("exon=" +  "ex" + \
+                    str(exnum) + '/' + str(t.exonCount))
+                exonic = exonic + 1
+            if (len(exons) > 0):
+                region = ";".join(exons)
+
+        elif ((u.isBetween(pos, promoter_plus, t.txStart) and
+            (t.strand == "+")) or
+            (u.isBetween(pos, t.txEnd, promoter_minus) and
+            (t.strand == "-"))):
+            cpg = cpgIsland()
+
+            if (cpg is not None):
+                region = 'putativePromoterRegion=' + \
+                    "".join(str(cpg[3]).split())
+                promoter = 1
+
+        return (region, exonic, promoter)
+
+    # The first positionType in INFO, which picks the counter. On input
+    # that already has one it is the input's, not BigRefGene's
+    def positionType(self, fields):
+        info_field = clean_mysql_chars(fields[7]).strip()
+        return str(u.parse_field(info_field, 'positionType', ';', '='))
+
+    def infoInputs(self, fields):
+        return self.positionType(fields)
+
+    def annotate(self, fields, hits):
+        if (len(hits) > 0):
+            #count location
+            counter = self.positionTypes.get(self.positionType(fields))
+
+            info = []
+            cnt = 1
+            for (row, region, exonic, promoter) in hits:
+                if (counter is not None):
+                    self.counts[counter] = self.counts[counter] + 1
+                self.counts['exonic_count'] = \
+                    self.counts['exonic_count'] + exonic
+                self.counts['promoter_count'] = \
+                    self.counts['promoter_count'] + promoter
+
+                if (region != ''):
+                    info.append(collapseGeneNames(row=row, 
+                        indices=indicesKnownGenes, region=region, cnt=cnt))
+                cnt = cnt + 1
+
+            addInfo(fields, ';' + ";".join(info))
 
         else:
-            fh_out.write(line + '\n')
+            addInfo(fields, ";positionType=interGenic")
+            self.counts['interGenic_count'] = \
+                self.counts['interGenic_count'] + 1
+
+    def report(self, fh_log):
+        lines = ["Variants located:",
+            f"In interGenic {str(self.counts['interGenic_count'])}",
+            f"In CDS {str(self.counts['cds_count'])}",
+            f"In \'3 UTR {str(self.counts['utr3_count'])}",
+            f"In \'5 UTR {str(self.counts['utr5_count'])}",
+            f"In Intronic {str(self.counts['intronic_count'])}",
+            f"In Non_coding_intronic {str(self.counts['non_coding_intronic_count'])}",
+            f"In Exonic {str(self.counts['exonic_count'])}",
+            f"In Non_coding_exonic {str(self.counts['non_coding_exonic_count'])}",
+            f"In Putative Promoter Region {str(self.counts['promoter_count'])}"]
+        for line in lines:
+            print(line)
+            fh_log.write(line + '\n')
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    pipeline.run_stages(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log',
+        [GenesStage(format=format, table=table,
+            promoter_offset=promoter_offset)], logmode='a', sep=sep)
 
 
-"""Get information about location in gene structures
+"""Method used in INDELS, where bigRefGeneTable is not applicable
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
     tmpextin='.2', tmpextout='.3', sep='\t'):
-    
+
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
@@ -336,10 +1013,10 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
         if not line.startswith("#"):
             fields = line.split(sep)
             chr = fields[inds[0]].strip()
-
+            
             if not chr.startswith("chr"):
                 chr = "chr" + chr
-
+            
             pos = fields[inds[1]].strip()
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
@@ -347,41 +1024,22 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
             this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
 
             sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
+                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
                 str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
                 str(promoter_offset) +');'
-
             cursor.execute(sql)
             rows = cursor.fetchall()
             info = []
-
             if (len(rows) > 0):
                 cnt = 1
                 for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
                     txtStart = int(row[4])
                     txtEnd = int(row[5])
                     cdsStart = int(row[6])
                     cdsEnd = int(row[7])
                     exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
+                    exonStarts =str(row[9].decode('utf-8'))
+                    exonEnds = str(row[10].decode('utf-8'))
                     geneSymbol = str(row[12])
                     strand = str(row[3])
 
@@ -398,56 +1056,77 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                             if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
                                 exnum = e + 1
                                 if (strand == '-'):
-                                    exnum = exonCount - e
+                                    exnum =  exonCount - e
                                 exons.append("non_coding_exon=" + "ex" + \
                                     str(exnum) + '/' + str(exonCount))
+                                non_coding_exonic_count = non_coding_exonic_count + 1
                         if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                            region='positionType=non_coding_exon;' + ";".join(exons)
+                        else:
+                            non_coding_intronic_count = non_coding_intronic_count + 1
+                            region = 'positionType=non_coding_intron'
+
+                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+                        cds_count = cds_count + 1
                         for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
+                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
                                 exnum = e + 1
                                 if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
+                                    exnum =  exonCount - e
+                                exons.append("exon=" + "ex" + \
                                     str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
+                                exonic_count=exonic_count+1
                         if (len(exons) > 0):
-                            region = ";".join(exons)
+                            region = 'positionType=CDS;' + ";".join(exons)
+                        else:
+                            intronic_count = intronic_count + 1
+                            region = 'positionType=CDS;' + 'intron'
+
+                    elif (u.isBetween(pos, txtStart, cdsStart) and \
+                        (cdsStart < cdsEnd) and (strand == "+")):
+                        utr5_count = utr5_count + 1
+                        region = 'positionType=utr5'
+
+                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+                        (cdsStart < cdsEnd) (strand == "+")):
+                        utr3_count = utr3_count + 1
+                        region = 'positionType=utr3'
+
+                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
+                        (cdsStart < cdsEnd) (strand == "-")):
+                        utr5_count = utr5_count + 1
+                        region = 'positionType=utr5'
+
+                    elif (u.isBetween(pos, txtStart, cdsStart) and \
+                        (cdsStart < cdsEnd) and (strand == "-")):
+                        utr3_count = utr3_count + 1
+                        region = 'positionType=utr3'
 
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
+                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = cpgIslandAt(cursor, chr, pos)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
                                 "".join(str(rows[3]).split())
                             promoter_count = promoter_count + 1
 
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
+                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
+                        (strand == "-")):
+                        rows = cpgIslandAt(cursor, chr, pos)
 
-                        rows = cursor.fetchone()
                         if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
+                            region = 'putativePromoterRegion=' + \
+                            "".join(str(rows[3]).split())
                             promoter_count = promoter_count + 1
 
                     else:
                         region = ''
 
                     if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+                        info.append(collapseGeneNames(
+                            row=row, indices=indicesKnownGenes, 
+                            region=region, cnt=cnt))
 
                     cnt = cnt + 1
 
@@ -481,7 +1160,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
 
     print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
 
     print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
     fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
@@ -501,635 +1180,271 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     conn.close()
 
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""Overlap with tfbsConsSites
 """
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+class TfbsConsSitesStage(OverlapStage):
+    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
+        '14','15','16','17','18','19','20','21','22','X','Y']
+
+    def __init__(self, format='vcf', table='tfbsConsSites'):
+        OverlapStage.__init__(self, format=format, table=table)
+        self.infoKeys = ('tfbsRegion',)
+        self.statements = dict([(chrIndex, queries.register(
+            'tfbsConsSites' + chrIndex, 'select chrom, chromStart, ' + \
+            'chromEnd, name from tfbsConsSites' + chrIndex + \
+            ' where chromStart <= %s AND %s <= chromEnd;'))
+            for chrIndex in self.allowed_chrom])
+        self.binStatements = dict([(chrIndex, queries.register(
+            'tfbsConsSites' + chrIndex + '.bin', 'select chrom, ' + \
+            'chromStart, chromEnd, name from tfbsConsSites' + chrIndex + \
+            ' where ' + ucsc_bin.predicate() + ' AND chromStart <= %s ' + \
+            'AND %s <= chromEnd order by chromStart;'))
+            for chrIndex in self.allowed_chrom])
+
+    # For some reason this table has no "chr" preceeding number
+    def key(self, fields):
+        chr = chromWithPrefix(fields[self.inds[0]].strip())
+        chrIndex = chr.replace('chr', '')
+        if (chrIndex not in self.allowed_chrom):
+            return None
+        return (chrIndex, fields[self.inds[1]].strip())
+
+    def query(self, cursor, key):
+        chrIndex, pos = key
+        if self.index is not None:
+            return self.index.overlapping(cursor, 'tfbsConsSites' + chrIndex,
+                None, chrIndex, pos, columns='chrom, chromStart, chromEnd, name')
+
+        bins = ucsc_bin.params(pos, pos) if self.bins else None
+        if bins is not None:
+            queries.execute(cursor, self.binStatements[chrIndex],
+                bins + (int(pos), int(pos)))
+        else:
+            queries.execute(cursor, self.statements[chrIndex],
+                (int(pos), int(pos)))
+        return cursor.fetchall()
+
+    # One table per chromosome, without a chromosome column
+    def rangeTables(self):
+        return [('tfbsConsSites' + chrIndex, None, 'chromStart', 'chromEnd')
+            for chrIndex in self.allowed_chrom]
+
+    # Rows of a chromosome's table in table order, for the sweep join
+    def sweepQuery(self, chrIndex):
+        return (interval_index.chromosome_statement('tfbsConsSites' + \
+            chrIndex, None, 'chrom, chromStart, chromEnd, name'), ())
+
+    # One join per chromosome table that the keys touch
+    def bulk_query(self, cursor, keys):
+        if self.sweep is not None:
+            return self.sweepBatch(cursor, keys)
+        if self.index is not None:
+            return self.indexBatch(cursor, keys,
+                lambda chrIndex: 'tfbsConsSites' + chrIndex, None,
+                columns='chrom, chromStart, chromEnd, name')
+
+        loadJobKeys(cursor, keys)
+        found = {}
+        for chrIndex in u.dedup([key[0] for key in keys]):
+            sql = 'select k.id, t.chrom, t.chromStart, t.chromEnd, ' + \
+                't.name from job_keys k straight_join tfbsConsSites' + \
+                chrIndex + ' t on t.chromStart <= k.pos AND ' + \
+                'k.pos <= t.chromEnd where k.chrom = %s;'
+            cursor.execute(sql, (chrIndex,))
+            found.update(groupJobRows(keys, cursor.fetchall()))
+        return found
+
+    def annotate(self, fields, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            records = []
+            for row in rows:
+                self.counts['var_count'] = self.counts['var_count'] + 1
+                t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                    str(row[1]) + '.' + str(row[2])
+                t = t.strip()
+                records.append('tfbsRegion' + '=' + t)
+            appendInfo(fields, ';'.join(records))
+
+
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
     tmpextin='.2', tmpextout='.3', sep='\t'):
+    pipeline.run_stages(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log',
+        [TfbsConsSitesStage(format=format, table=table)], logmode='a',
+        sep=sep)
+
+
+"""Overlap with GadAll table
+"""
+class GadAllStage(OverlapStage):
+    # For some reason this table has no "chr" preceeding number
+    chromColumn = 'chromosome'
+    chrPrefix = False
+    padsRecord = True
+
+    def __init__(self, format='vcf', table='gadAll'):
+        OverlapStage.__init__(self, format=format, table=table)
+
+    def annotate(self, fields, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            records = []
+            r_tmp = []
+            for row in rows:
+                self.counts['var_count'] = self.counts['var_count'] + 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]) )
+                    records.append(str(self.table) + '=' + str(row[3]))
+            appendInfo(fields, ';'.join(records))
+            # Annotated records have always been written out with a space
+            # after every tab
+            vcf_record.pad(fields)
+
+
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+    tmpextout='.1', sep='\t'):
+    pipeline.run_stages(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log',
+        [GadAllStage(format=format, table=table)], logmode='a', sep=sep)
+
+
+""" Overlap with gwasCatalog table """
+class GwasCatalogStage(OverlapStage):
+    sweepable = False
+
+    def __init__(self, format='vcf', table='gwasCatalog'):
+        OverlapStage.__init__(self, format=format, table=table)
+        self.statement = queries.register(table + '.end', 'select * from ' + \
+            table + ' where chrom = %s AND chromEnd = %s;')
+        self.binStatement = queries.register(table + '.end.bin',
+            'select * from ' + table + ' where chrom = %s AND ' + \
+            ucsc_bin.predicate() + ' AND chromEnd = %s order by ' + \
+            'chromStart;')
+
+    def query(self, cursor, key):
+        chr, pos = key
+        if self.snapshot is not None:
+            return self.snapshot.equal(self.table, chr, pos)
+        if self.hashes is not None:
+            return self.hashes.probe(cursor, self.table, chr, pos)
+
+        bins = ucsc_bin.params(pos, pos) if self.bins else None
+        if bins is not None:
+            queries.execute(cursor, self.binStatement,
+                (chr,) + bins + (int(pos),))
+        else:
+            queries.execute(cursor, self.statement, (chr, int(pos)))
+        return cursor.fetchall()
+
+    def indexed(self):
+        return (self.snapshot is not None or self.hashes is not None)
+
+    def bulk_query(self, cursor, keys):
+        if self.indexed():
+            return Stage.bulk_query(self, cursor, keys)
+
+        loadJobKeys(cursor, keys)
+        sql = 'select k.id, t.* from job_keys k straight_join ' + \
+            self.table + ' t on t.chrom = k.chrom AND t.chromEnd = k.pos;'
+        cursor.execute(sql)
+        return groupJobRows(keys, cursor.fetchall())
+
+    def annotate(self, fields, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            records = []
+            for row in rows:
+                self.counts['var_count'] = self.counts['var_count'] + 1
+                records.append(str(self.table) + '=' + str('pubMedID') + \
+                    '=' + str(row[5]) + ',trait=' + str(row[10]))
+            appendInfo(fields, ';'.join(records))
+
+
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t'):
+    pipeline.run_stages(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log',
+        [GwasCatalogStage(format=format, table=table)], logmode='a', sep=sep)
+
+
+"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
+"""
+class HugoStage(OverlapStage):
+    def __init__(self, format='vcf', table='hugo'):
+        OverlapStage.__init__(self, format=format, table=table)
+        self.label = 'HUGO Gene Nomenclature Committee'
+        self.infoKeys = ('HGNC_GeneAnnotation',)
+
+    def annotate(self, fields, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            records = []
+            r_tmp = []
+            for row in rows:
+                self.counts['var_count'] = self.counts['var_count'] + 1
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
+            appendInfo(fields, ','.join(records).replace(';', ','))
+
+
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    pipeline.run_stages(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log',
+        [HugoStage(format=format, table=table)], logmode='a', sep=sep)
+
+
+"""Overlap with segdup regions genomicSuperDups
+"""
+class GenomicSuperDupsStage(OverlapStage):
+    fetchAll = False
+
+    def __init__(self, format='vcf', table='genomicSuperDups'):
+        OverlapStage.__init__(self, format=format, table=table)
+        self.infoKeys = (str(table), 'otherChrom', 'otherStart', 'otherEnd')
+
+    def annotate(self, fields, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            self.counts['var_count'] = self.counts['var_count'] + 1
+            isOverlap = True
+            otherChrom = rows[0][7]
+            otherStart = rows[0][8]
+            otherEnd = rows[0][9]
+            addInfo(fields, ';' + str(self.table) + '=' + \
+                str(isOverlap) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd))
+
+
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
+    pipeline.run_stages(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log',
+        [GenomicSuperDupsStage(format=format, table=table)], logmode='a',
+        sep=sep)
+
 
+"""Searches Genes Databases and returns Genes/Cytobands 
+   with which SNP or INDEL overlaps
+"""
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    
     basefile = vcf
     vcf = basefile + tmpextin
     outfile = basefile + tmpextout
     fh_out = open(outfile, "w")
+    fh = open(vcf)
 
     logcountfile = basefile + '.count.log'
     fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
-
-        else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
-
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
-
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
-
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
-
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
-
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
-
-
-"""Overlap with tfbsConsSites
-"""
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
-    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
-        '14','15','16','17','18','19','20','21','22','X','Y']
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
-
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
-
-        linenum = linenum + 1
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Overlap with GadAll table
-"""
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-""" Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
-"""
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Overlap with segdup regions genomicSuperDups
-"""
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-"""Searches Genes Databases and returns Genes/Cytobands 
-   with which SNP or INDEL overlaps
-"""
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 1
-    colindex2 = 12
-    name = 'name'
-    name2 = 'name2'
-    startName = 'txStart'
-    endName = 'txEnd'
+    var_count = 0
+    line_count = 0
+    colindex = 1
+    colindex2 = 12
+    name = 'name'
+    name2 = 'name2'
+    startName = 'txStart'
+    endName = 'txEnd'
 
     inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
@@ -1189,215 +1504,82 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+class CytobandStage(OverlapStage):
+    def __init__(self, format='vcf', table='cytoBand'):
+        OverlapStage.__init__(self, format=format, table=table)
+        self.colindex = 12
+        self.startColumn = 'txStart'
+        self.endColumn = 'txEnd'
+
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startColumn = 'chromStart'
+            self.endColumn = 'chromEnd'
+
+    def annotate(self, fields, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            overlapsWith = []
+            for row in rows:
+                self.counts['var_count'] = self.counts['var_count'] + 1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+            appendInfo(fields, str(self.table) + '=' + str(cytoband))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    pipeline.run_stages(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log',
+        [CytobandStage(format=format, table=table)], logmode='a', sep=sep)
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+class CnvDatabaseStage(OverlapStage):
+    fetchAll = False
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def annotate(self, fields, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            self.counts['var_count'] = self.counts['var_count'] + 1
+            isOverlap = True
+            appendInfo(fields, str(self.table) + '=' + str(isOverlap))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    pipeline.run_stages(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log',
+        [CnvDatabaseStage(format=format, table=table)], logmode='a', sep=sep)
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+class MiRNAStage(OverlapStage):
+    fetchAll = False
 
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+    def __init__(self, format='vcf', table='targetScanS'):
+        OverlapStage.__init__(self, format=format, table=table)
+        self.label = 'miRNA'
+        self.infoKeys = ('miRNAsites',)
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+    def annotate(self, fields, rows):
+        if (len(rows) > 0):
+            self.counts['line_count'] = self.counts['line_count'] + 1
+            self.counts['var_count'] = self.counts['var_count'] + 1
+            row = rows[0]
+            t = str(row[4]) + ',' +  str(row[1]) + '_' + \
+                str(row[2]) + '_' + str(row[3])
+            appendInfo(fields, 'miRNAsites=' + t.strip())
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def report(self, fh_log):
+        fh_log.write(f"In miRNAsites: {str(self.counts['var_count'])} in " + \
+            f"{str(self.counts['line_count'])} variants\n")
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    pipeline.run_stages(vcf + tmpextin, vcf + tmpextout, vcf + '.count.log',
+        [MiRNAStage(format=format, table=table)], logmode='a', sep=sep)
 
-### EOF
\ No newline at end of file
+### EOF
@@ -4,6 +4,7 @@ import os
 import requests
 import uuid
 import sys
+import shlex
 from subprocess import Popen, PIPE, CalledProcessError
 import boto3
 from botocore.client import Config
@@ -33,6 +34,7 @@ def access_files():
             QueueUrl=queue_url,
             MaxNumberOfMessages=1,
             WaitTimeSeconds = 5,
+            AttributeNames = ['ApproximateReceiveCount'],
         )
 
         try:
@@ -53,10 +55,43 @@ def access_files():
             submit_time = my_message['submit_time']
             job_status = my_message['job_status']
             email = my_message['email']
+            # Jobs submitted before profiles existed run every stage
+            annotation_profile = my_message.get('annotation_profile', '')
 
         except KeyError:
             #If there is no message then break out of loop
             break
+
+        #A job whose annotator died too many times is not run again: it is
+        #marked FAILED and its request is removed from the queue
+        receive_count = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+        if receive_count > config.getint('aws', 'MaxJobAttempts', fallback=3):
+            dynamodb = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+            ann_table = dynamodb.Table(config['aws']['DynamoTable'])
+            try:
+                ann_table.update_item(
+                    Key = {'job_id': job_id},
+                    UpdateExpression = 'set job_status = :f',
+                    ConditionExpression = "job_status <> :c",
+                    ExpressionAttributeValues = {
+                        ':f' : "FAILED",
+                        ':c' : "COMPLETED",
+                    },
+                    ReturnValues = "UPDATED_NEW"
+                )
+            except ClientError as e:
+                print(e.response)
+            sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
+            continue
+
+        #Keep the message hidden for the whole visibility timeout before the
+        #job starts; run.py keeps extending it while the job runs
+        try:
+            sqs.change_message_visibility(QueueUrl=queue_url,
+                ReceiptHandle=receipt_handle,
+                VisibilityTimeout=config.getint('aws', 'QueueVisibilitySeconds', fallback=600))
+        except ClientError as e:
+            print(e.response)
         
         #Write the user email to jobID file so this can be sent to notify.py (sent in run.py)
         my_path = "/home/ubuntu/ann/"+ job_id
@@ -101,8 +136,12 @@ def access_files():
             #Changed to include user_id
             myfile = file.split('/')[2]
             command = 'python /home/ubuntu/ann/run.py '+myfile
+            if annotation_profile:
+                command = command + ' ' + shlex.quote(annotation_profile)
+            #run.py deletes the message once the job has completed
+            env = dict(os.environ, JOB_RECEIPT_HANDLE=receipt_handle)
             try:
-                p = Popen(command, shell = True)
+                p = Popen(command, shell = True, env = env)
             except CalledProcessError as e:
                 print(e.output)
                 raise
@@ -142,13 +181,9 @@ def access_files():
 
 
 
-        # Delete received message from queue
-        sqs.delete_message(
-            QueueUrl=queue_url,
-            ReceiptHandle=receipt_handle
-        )
-
-        print('Received and deleted message: %s' % my_message)
+        # The message stays in the queue until run.py has completed the
+        # job, so the job is delivered again if this instance dies
+        print('Received message: %s' % my_message)
         print("\n")
 
         
@@ -0,0 +1,118 @@
+# async_lookup.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Pipelined per-variant lookups: keeps several queries in flight over
+# several database connections, with the number in flight adapted to
+# the latency the database shows
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+import asyncio
+import threading
+
+# Latency above this multiple of the best latency seen, and at least
+# SLACK seconds above it, counts as the database being overloaded
+TOLERANCE = 2.0
+SLACK = 0.001
+# Per-completion drift of the best latency towards the latencies seen,
+# so a stale minimum does not keep the limit down forever
+DRIFT = 1.001
+
+
+"""Additive increase, multiplicative decrease limit on the number of
+queries in flight, between 1 and maximum. Every completion at a latency
+within TOLERANCE (or SLACK) of the best latency seen raises the limit
+by 1/limit (about one per round of queries); a slower one halves it, at
+most once per round, since the queries already in flight when the
+limit drops come back slow as well
+"""
+class AdaptiveLimit(object):
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.best = None
+        self.cut = 0.0
+        self.decreases = 0
+        self.lock = threading.Lock()
+
+    def current(self):
+        return max(1, int(self.limit))
+
+    # A query that started at started (time.monotonic()) took latency
+    # seconds
+    def update(self, started, latency):
+        with self.lock:
+            if (self.best is None) or (latency < self.best):
+                self.best = latency
+            else:
+                self.best = min(latency, self.best * DRIFT)
+
+            if (latency <= max(TOLERANCE * self.best, self.best + SLACK)):
+                self.limit = min(float(self.maximum),
+                    self.limit + 1.0 / self.limit)
+            elif (started >= self.cut):
+                self.limit = max(1.0, self.limit / 2.0)
+                self.cut = time.monotonic()
+                self.decreases = self.decreases + 1
+
+
+"""Resolves the keys of a stage one query per distinct key, with up to
+limit.current() queries in flight at a time. Queries run on executor,
+whose threads get their cursors from cursor_for(); the executor's size
+bounds the queries in flight across every stage using the engine
+"""
+class PipelinedLookups(object):
+    def __init__(self, executor, cursor_for, maximum):
+        self.executor = executor
+        self.cursor_for = cursor_for
+        self.limit = AdaptiveLimit(maximum)
+        self.queries = 0
+        self.lock = threading.Lock()
+
+    def query(self, stage, key):
+        return stage.query(self.cursor_for(), key)
+
+    # Keeps up to limit.current() lookups running, starting the next
+    # key whenever one completes
+    async def gather(self, stage, keys):
+        loop = asyncio.get_running_loop()
+        results = [None] * len(keys)
+
+        async def lookup(i):
+            started = time.monotonic()
+            try:
+                results[i] = await loop.run_in_executor(self.executor,
+                    self.query, stage, keys[i])
+            finally:
+                self.limit.update(started, time.monotonic() - started)
+
+        pending = set()
+        started = 0
+        while (started < len(keys)) or pending:
+            while (started < len(keys)) and \
+                (len(pending) < self.limit.current()):
+                pending.add(asyncio.ensure_future(lookup(started)))
+                started = started + 1
+            done, pending = await asyncio.wait(pending,
+                return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        return results
+
+    # Rows for each key, in order; None keys get None
+    def resolve(self, stage, keys):
+        distinct = list(dict.fromkeys([key for key in keys
+            if key is not None]))
+        found = {}
+        if distinct:
+            found = dict(zip(distinct,
+                asyncio.run(self.gather(stage, distinct))))
+            with self.lock:
+                self.queries = self.queries + len(distinct)
+        return [found[key] if (key is not None) else None for key in keys]
+
+### EOF
@@ -0,0 +1,129 @@
+# bgzf.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Reading gzip/BGZF-compressed VCFs and writing BGZF output
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import gzip
+import zlib
+import queue
+import struct
+import threading
+
+GZIP_MAGIC = b'\x1f\x8b'
+# Uncompressed bytes per block; the compressed block (at most 64 KiB)
+# must fit even when the data does not compress
+BLOCK_SIZE = 0xff00
+# Empty block that ends every BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# Blocks queued for the compression thread
+QUEUE_BLOCKS = 64
+
+
+def is_gzip(path):
+    with open(path, 'rb') as fh:
+        return fh.read(2) == GZIP_MAGIC
+
+
+"""Opens a VCF for reading as text, decompressing gzip and BGZF files
+(detected from their contents, not their name) as they are read
+"""
+def open_text(path):
+    if is_gzip(path):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+"""One BGZF block holding data
+"""
+def compress_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+        ord('B'), ord('C'), 2, len(deflated) + 25)
+    return header + deflated + \
+        struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+"""Text file writer producing BGZF, which gzip and every gzip tool read
+and which tabix and htslib can index. Blocks are compressed and written
+on a background thread while the caller keeps writing. With append the
+blocks are added to the end of path, which must end on a block boundary
+(see flush())
+"""
+class BgzfWriter(object):
+    def __init__(self, path, append=False):
+        self.fh = open(path, 'ab' if append else 'wb')
+        self.buffer = bytearray()
+        self.blocks = queue.Queue(maxsize=QUEUE_BLOCKS)
+        self.error = None
+        self.thread = threading.Thread(target=self.compress, daemon=True)
+        self.thread.start()
+
+    def compress(self):
+        while True:
+            data = self.blocks.get()
+            if data is None:
+                self.blocks.task_done()
+                return
+            try:
+                if self.error is None:
+                    self.fh.write(compress_block(data))
+            except Exception as e:
+                self.error = e
+            self.blocks.task_done()
+
+    def write(self, text):
+        self.buffer.extend(text.encode())
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self.blocks.put(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+        if self.error is not None:
+            raise self.error
+
+    # Writes out everything written so far, ending the current block, so
+    # the file ends on a block boundary
+    def flush(self):
+        if self.buffer:
+            self.blocks.put(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.blocks.join()
+        if self.error is not None:
+            raise self.error
+        self.fh.flush()
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def close(self):
+        if self.buffer:
+            self.blocks.put(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.blocks.put(None)
+        self.thread.join()
+        if self.error is None:
+            self.fh.write(EOF_BLOCK)
+        self.fh.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Opens an annotated output file for writing as text, as BGZF if
+compress is set, appending to it if append is set
+"""
+def open_output(path, compress=False, append=False):
+    if compress:
+        return BgzfWriter(path, append)
+    return open(path, 'a' if append else 'w')
+
+### EOF
@@ -0,0 +1,189 @@
+# bloom.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Per-chromosome Bloom filters over the (chrom, pos) of a reference
+# table, so lookups of positions the table does not have can be skipped
+#
+# Build the dbSNP filters with:
+#   python bloom.py <filter_dir> [false_positive_rate]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import math
+import mmap
+import time
+import shutil
+import hashlib
+
+import utils as u
+import queries
+
+FORMAT = 1
+
+
+"""Bit positions of a value in a filter of bits bits with hashes hash
+functions, by double hashing one 128-bit digest
+"""
+def positions(value, bits, hashes):
+    digest = hashlib.blake2b(str(value).encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+"""Number of bits and of hash functions for count values at a false
+positive rate of fpr
+"""
+def dimensions(count, fpr):
+    bits = max(8, int(math.ceil(-count * math.log(fpr) / (math.log(2) ** 2))))
+    hashes = max(1, int(round(bits / float(count) * math.log(2))))
+    return bits, hashes
+
+
+"""Bloom filter over a bytes-like bit array. A value that was not added
+is reported present with probability about the false positive rate the
+filter was sized for; a value that was added is always present
+"""
+class BloomFilter(object):
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = data if (data is not None) else \
+            bytearray((bits + 7) // 8)
+
+    def add(self, value):
+        for p in positions(value, self.bits, self.hashes):
+            self.data[p >> 3] = self.data[p >> 3] | (1 << (p & 7))
+
+    def __contains__(self, value):
+        for p in positions(value, self.bits, self.hashes):
+            if not (self.data[p >> 3] & (1 << (p & 7))):
+                return False
+        return True
+
+
+"""Builds a filter per chromosome of table over its positions into
+dirname, sized for a false positive rate of fpr. Chromosome names are
+folded to upper case, as MySQL compares them. The filters are written
+next to dirname and moved into place once complete
+"""
+def build(dirname, fpr=0.01, table='dbSNP', chromColumn='CHR',
+    posColumn='POS', conn=None):
+    if conn is None:
+        conn = u.db_connect()
+    cursor = conn.cursor()
+
+    cursor.execute('select distinct ' + chromColumn + ' from ' + table + ';')
+    names = {}
+    for row in cursor.fetchall():
+        if row[0] is not None:
+            names.setdefault(str(row[0]).strip().upper(), []).append(
+                str(row[0]))
+
+    dirname = os.path.abspath(dirname)
+    tmpdir = dirname + '.tmp'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    schema = {'format': FORMAT, 'table': table, 'fpr': fpr,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'chroms': {}}
+    statement = queries.register(table + '.positions', 'select distinct ' + \
+        posColumn + ' from ' + table + ' where ' + chromColumn + ' = %s;')
+    for i, chrom in enumerate(sorted(names)):
+        values = set()
+        for name in names[chrom]:
+            queries.execute(cursor, statement, (name,))
+            values.update([int(row[0]) for row in cursor.fetchall()
+                if row[0] is not None])
+        if (len(values) == 0):
+            continue
+
+        bits, hashes = dimensions(len(values), fpr)
+        bloom = BloomFilter(bits, hashes)
+        for value in values:
+            bloom.add(value)
+        filename = str(i) + '.bloom'
+        with open(os.path.join(tmpdir, filename), 'wb') as fh:
+            fh.write(bloom.data)
+        schema['chroms'][chrom] = {'file': filename, 'bits': bits,
+            'hashes': hashes, 'count': len(values)}
+        print(f"{table} {chrom}: {str(len(values))} positions, " + \
+            f"{str(bits // 8)} bytes")
+    conn.close()
+
+    with open(os.path.join(tmpdir, 'filters.json'), 'w') as fh:
+        json.dump(schema, fh, indent=2)
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmpdir, dirname)
+    return schema
+
+
+"""The filters built into a directory by build(). Filter files are
+memory-mapped on first use, so processes on a host share them
+"""
+class BloomFilters(object):
+    def __init__(self, dirname):
+        self.dirname = dirname
+        with open(os.path.join(dirname, 'filters.json')) as fh:
+            self.schema = json.load(fh)
+        if (self.schema['format'] != FORMAT):
+            raise ValueError(f"Unsupported Bloom filter format " + \
+                f"{str(self.schema['format'])} in {dirname}")
+        self.filters = {}
+
+    def chromosome(self, chrom):
+        bloom = self.filters.get(chrom)
+        if bloom is None:
+            entry = self.schema['chroms'][chrom]
+            with open(os.path.join(self.dirname, entry['file']), 'rb') as fh:
+                data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            bloom = BloomFilter(entry['bits'], entry['hashes'], data)
+            self.filters[chrom] = bloom
+        return bloom
+
+    # False only if the table has no row at chrom:pos
+    def may_contain(self, chrom, pos):
+        chrom = str(chrom).strip().upper()
+        if chrom not in self.schema['chroms']:
+            return False
+        try:
+            pos = int(pos)
+        except ValueError:
+            return True
+        return pos in self.chromosome(chrom)
+
+
+_filters = {}
+
+"""Process-wide BloomFilters for a directory
+"""
+def open_filters(dirname):
+    dirname = os.path.abspath(dirname)
+    if dirname not in _filters:
+        _filters[dirname] = BloomFilters(dirname)
+    return _filters[dirname]
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) < 2):
+        print("usage: python bloom.py <filter_dir> [false_positive_rate]")
+        sys.exit(1)
+    if (len(sys.argv) > 2):
+        fpr = float(sys.argv[2])
+    else:
+        from configparser import SafeConfigParser
+        config = SafeConfigParser(os.environ)
+        config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+            'ann_config.ini'))
+        fpr = config.getfloat('annotator', 'DbSnpBloomFPR', fallback=0.01)
+    build(sys.argv[1], fpr)
+
+### EOF
@@ -0,0 +1,220 @@
+# checkpoint.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Checkpoints of a running annotation, so a job that was interrupted
+# resumes after the last records it wrote out, on the same instance or,
+# with a shared store, on another one
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import time
+import zlib
+import fcntl
+import boto3
+from botocore.exceptions import ClientError
+
+import bgzf
+
+FORMAT = 1
+
+# Shared copy of the checkpoints (see use_store), or None to keep them
+# on local disk only
+_store = None
+
+
+def path_for(outfile):
+    return outfile + '.ckpt'
+
+
+"""CRC32 of the first lines lines of infile, or None if it has fewer
+"""
+def input_crc(infile, lines):
+    crc = 0
+    count = 0
+    fh = bgzf.open_text(infile)
+    try:
+        for line in fh:
+            if (count >= lines):
+                break
+            crc = zlib.crc32(line.encode(), crc)
+            count = count + 1
+    finally:
+        fh.close()
+    return crc if (count == lines) else None
+
+
+"""Records that the first lines lines of infile, whose CRC32 is crc, have
+been annotated and written to outfile (flushed to disk by the caller),
+together with the counters of stages. done marks outfile as complete.
+The checkpoint is written next to outfile and replaces the previous one
+in one rename
+"""
+def save(outfile, infile, stages, lines, crc, compress, done=False):
+    state = {'format': FORMAT, 'input': os.path.basename(infile),
+        'lines': lines, 'crc': crc, 'offset': os.path.getsize(outfile),
+        'compress': bool(compress), 'done': done,
+        'stages': [stage.label for stage in stages],
+        'counts': [stage.counts for stage in stages]}
+    tmpfile = path_for(outfile) + '.tmp'
+    with open(tmpfile, 'w') as fh:
+        json.dump(state, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmpfile, path_for(outfile))
+    if _store is not None:
+        _store.push(outfile)
+    return state
+
+
+"""The checkpoint of annotating infile into outfile with stages, or None
+if there is none or it was written for another input, other stages or
+another output format, or outfile no longer holds what it records.
+Without a local checkpoint, the one in the shared store (if any) is
+fetched together with outfile
+"""
+def load(outfile, infile, stages, compress):
+    if (_store is not None) and not os.path.exists(path_for(outfile)):
+        _store.pull(outfile)
+    try:
+        with open(path_for(outfile)) as fh:
+            state = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if (state.get('format') != FORMAT) or \
+        (state['stages'] != [stage.label for stage in stages]) or \
+        (state['compress'] != bool(compress)) or \
+        (not os.path.exists(outfile)) or \
+        (os.path.getsize(outfile) < state['offset']) or \
+        (input_crc(infile, state['lines']) != state['crc']):
+        return None
+    return state
+
+
+"""Puts outfile and the counters of stages back to where state left
+them; output after an unfinished checkpoint is dropped
+"""
+def resume(outfile, state, stages):
+    if not state['done']:
+        os.truncate(outfile, state['offset'])
+    for stage, counts in zip(stages, state['counts']):
+        stage.counts.update(counts)
+
+
+"""Raised by lock() when another run holds the lock on the output
+"""
+class Locked(RuntimeError):
+    pass
+
+
+"""Takes the lock on annotating outfile, which is held until the returned
+file is passed to unlock(). Two runs of the same job, as when a job
+message is delivered again while the first run is still going, would
+otherwise write the same output
+"""
+def lock(outfile):
+    fh = open(outfile + '.lock', 'w')
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fh.close()
+        raise Locked(f"{outfile} is being annotated by another run")
+    return fh
+
+
+def unlock(fh):
+    os.remove(fh.name)
+    fh.close()
+
+
+def remove(outfile):
+    for name in [path_for(outfile), path_for(outfile) + '.tmp']:
+        if os.path.exists(name):
+            os.remove(name)
+    if _store is not None:
+        _store.remove(outfile)
+
+
+"""Keeps a copy of every checkpoint in store, an S3Store, or only on
+local disk if store is None
+"""
+def use_store(store):
+    global _store
+    _store = store
+
+
+"""Copy of the checkpoints in an S3 bucket, so that a job delivered
+again to another instance after its annotator died resumes there. The
+output and its checkpoint are uploaded under prefix/<output name>
+(which starts with the job id) at most once every interval seconds.
+Every upload copies the output written so far, so interval bounds the
+cost of checkpointing a big job
+"""
+class S3Store(object):
+    def __init__(self, bucket, prefix, interval=300):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.interval = interval
+        self.uploaded = {}
+        self.s3 = None
+        self.pid = None
+
+    # boto3 clients are not shared with forked shard workers
+    def client(self):
+        if (self.pid != os.getpid()):
+            self.s3 = boto3.client('s3')
+            self.pid = os.getpid()
+        return self.s3
+
+    def key(self, path):
+        return self.prefix + '/' + os.path.basename(path)
+
+    # The output goes first: a checkpoint is only ever uploaded after
+    # the output it covers
+    def push(self, outfile):
+        if (time.time() - self.uploaded.get(outfile, 0) < self.interval):
+            return
+        try:
+            self.client().upload_file(outfile, self.bucket,
+                self.key(outfile))
+            self.client().upload_file(path_for(outfile), self.bucket,
+                self.key(path_for(outfile)))
+        except ClientError as e:
+            print(f"Unable to upload the checkpoint of {outfile}: {e}")
+            return
+        self.uploaded[outfile] = time.time()
+
+    # Downloads the checkpoint of outfile and outfile, if there is one
+    def pull(self, outfile):
+        try:
+            self.client().download_file(self.bucket,
+                self.key(path_for(outfile)), path_for(outfile))
+        except ClientError as e:
+            if (e.response['Error']['Code'] not in ('404', 'NoSuchKey')):
+                print(f"Unable to download the checkpoint of {outfile}: {e}")
+            return False
+        try:
+            self.client().download_file(self.bucket, self.key(outfile),
+                outfile)
+        except ClientError as e:
+            print(f"Unable to download the output of {outfile}: {e}")
+            os.remove(path_for(outfile))
+            return False
+        print(f"Fetched the checkpoint of {outfile} from " + \
+            f"s3://{self.bucket}/{self.key(outfile)}")
+        return True
+
+    def remove(self, outfile):
+        for path in [outfile, path_for(outfile)]:
+            try:
+                self.client().delete_object(Bucket=self.bucket,
+                    Key=self.key(path))
+            except ClientError as e:
+                print(f"Unable to delete s3://{self.bucket}/" + \
+                    f"{self.key(path)}: {e}")
+
+### EOF
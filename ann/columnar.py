@@ -0,0 +1,168 @@
+# columnar.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Parquet sidecar of an annotated VCF, with one typed column per
+# annotation key, for querying the annotations without parsing INFO
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import bgzf
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Records per row group. Readers skip whole row groups by the min/max
+# statistics of their columns (CHROM and POS of sorted input, say)
+ROW_GROUP_ROWS = 100000
+
+# Kinds of the annotation keys that are not lists of strings: flags
+# are True where the key is present, string and int keys are written
+# once per record
+KEY_KINDS = {'DB': 'flag', 'VC': 'string', 'GMAF': 'doubles',
+    'intron': 'flag', 'miRNAsites': 'string', 'dgv_Cnv': 'flag',
+    'abParts_IG_T_CelReceptors': 'flag', 'mcCarroll_Cnv': 'flag',
+    'conrad_Cnv': 'flag', 'genomicSuperDups': 'flag',
+    'otherChrom': 'string', 'otherStart': 'int', 'otherEnd': 'int'}
+
+
+def available():
+    return (pa is not None)
+
+
+"""Name of the sidecar of an annotated VCF: <name>.annot.parquet for
+<name>.annot.vcf or <name>.annot.vcf.gz
+"""
+def path_for(annotfile):
+    base = annotfile[:-3] if annotfile.endswith('.gz') else annotfile
+    if base.endswith('.vcf'):
+        base = base[:-4]
+    return base + '.parquet'
+
+
+"""(key, kind) of the annotation columns for the INFO keys the stages
+write (see annotate.Stage.infoKeys), in stage order
+"""
+def annotation_columns(stages):
+    keys = []
+    for stage in stages:
+        for key in stage.infoKeys:
+            if key not in keys:
+                keys.append(key)
+    return [(key, KEY_KINDS.get(key, 'strings')) for key in keys]
+
+
+def arrow_type(kind):
+    return {'flag': pa.bool_(), 'string': pa.string(), 'int': pa.int64(),
+        'doubles': pa.list_(pa.float64()),
+        'strings': pa.list_(pa.string())}[kind]
+
+
+"""Schema of the sidecar: the fixed VCF columns, with the rsIDs of the
+ID column as a list, and the annotation columns
+"""
+def schema(columns):
+    return pa.schema([('CHROM', pa.string()), ('POS', pa.int64()),
+        ('rsID', pa.list_(pa.string())), ('REF', pa.string()),
+        ('ALT', pa.string()), ('QUAL', pa.float64()),
+        ('FILTER', pa.string())] + \
+        [(key, arrow_type(kind)) for key, kind in columns])
+
+
+def number(value, cast):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+"""Values of the columns for one annotated record, as a dict. Entries
+without a key (a second cytoband, say) go with the list column before
+them; INFO keys of the input are left out
+"""
+def parse_record(line, kinds, sep='\t'):
+    fields = [field.strip() for field in line.split(sep, 8)[:8]]
+    fields = fields + ['.'] * (8 - len(fields))
+    values = {'CHROM': fields[0], 'POS': number(fields[1], int),
+        'rsID': [rsid for rsid in fields[2].split(';') if rsid != '.'],
+        'REF': fields[3], 'ALT': fields[4],
+        'QUAL': number(fields[5], float), 'FILTER': fields[6]}
+    for key, kind in kinds.items():
+        if (kind == 'flag'):
+            values[key] = False
+        elif kind in ('strings', 'doubles'):
+            values[key] = []
+        else:
+            values[key] = None
+
+    current = None
+    for entry in fields[7].split(';'):
+        key, eq, value = entry.partition('=')
+        key = key.strip()
+        kind = kinds.get(key)
+        if (kind is None) and eq:
+            current = None
+            continue
+        if kind is None:
+            if (current is not None) and entry.strip():
+                values[current].append(entry.strip())
+            continue
+
+        current = key if (kind == 'strings') else None
+        value = value.strip()
+        if (kind == 'flag'):
+            values[key] = True
+        elif (kind == 'strings'):
+            values[key].append(value)
+        elif (kind == 'doubles'):
+            values[key].append(number(value, float))
+        elif (values[key] is None):
+            values[key] = number(value, int) if (kind == 'int') else value
+    return values
+
+
+"""Writes the records of the annotated VCF annotfile (which may be
+compressed) to the Parquet file outfile, in row groups of
+row_group_rows records, with the annotation columns of stages.
+Returns the number of records written
+"""
+def write_parquet(annotfile, outfile, stages, sep='\t',
+    row_group_rows=ROW_GROUP_ROWS):
+    columns = annotation_columns(stages)
+    kinds = dict(columns)
+    table_schema = schema(columns)
+    names = table_schema.names
+    writer = pq.ParquetWriter(outfile, table_schema, compression='zstd')
+    batch = dict([(name, []) for name in names])
+    count = 0
+
+    def flush():
+        if batch['CHROM']:
+            writer.write_table(pa.Table.from_pydict(batch,
+                schema=table_schema), row_group_size=row_group_rows)
+            for name in names:
+                del batch[name][:]
+
+    fh = bgzf.open_text(annotfile)
+    try:
+        for line in fh:
+            if line.startswith('#') or not line.strip():
+                continue
+            values = parse_record(line.rstrip('\n'), kinds, sep)
+            for name in names:
+                batch[name].append(values[name])
+            count = count + 1
+            if (len(batch['CHROM']) >= row_group_rows):
+                flush()
+        flush()
+    finally:
+        fh.close()
+        writer.close()
+    return count
+
+### EOF
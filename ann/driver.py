@@ -12,110 +12,315 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
-import file_utils as fu
 import annotate as ann
+import pipeline
+import interval_index
+import hash_index
+import snapshot as snap
+import variant_cache
+import bloom as bl
+import checkpoint as ck
+import reannotate as rean
+import columnar
 
-def run(infile, format):
+# Get annotator configuration
+from configparser import SafeConfigParser
+config = SafeConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config.ini'))
+
+"""Annotation stages in the order their annotations are applied, as
+(name, stage class, arguments). Dependencies between stages are
+declared on the stage classes (see annotate.Stage.depends)
+"""
+STAGES = [
+    ('dbSNP', ann.DbSnpStage, {}),
+    ('BigRefGene', ann.BigRefGeneStage, {}),
+    ('Genes', ann.GenesStage, {'table': 'refGene', 'promoter_offset': 500}),
+    ('cytoBand', ann.CytobandStage, {'table': 'cytoBand'}),
+    ('gadAll', ann.GadAllStage, {'table': 'gadAll'}),
+    ('gwasCatalog', ann.GwasCatalogStage, {'table': 'gwasCatalog'}),
+    ('targetScanS', ann.MiRNAStage, {'table': 'targetScanS'}),
+    ('hugo', ann.HugoStage, {'table': 'hugo'}),
+    ('dgv_Cnv', ann.CnvDatabaseStage, {'table': 'dgv_Cnv'}),
+    ('abParts_IG_T_CelReceptors', ann.CnvDatabaseStage,
+        {'table': 'abParts_IG_T_CelReceptors'}),
+    ('mcCarroll_Cnv', ann.CnvDatabaseStage, {'table': 'mcCarroll_Cnv'}),
+    ('conrad_Cnv', ann.CnvDatabaseStage, {'table': 'conrad_Cnv'}),
+    ('genomicSuperDups', ann.GenomicSuperDupsStage,
+        {'table': 'genomicSuperDups'}),
+    ('tfbsConsSites', ann.TfbsConsSitesStage, {'table': 'tfbsConsSites'}),
+]
+
+"""Named annotation profiles, as the names of the stages they run
+"""
+PROFILES = {
+    'full': [name for name, cls, kwargs in STAGES],
+    'fast': ['dbSNP', 'BigRefGene', 'Genes'],
+    'cnv': ['cytoBand', 'dgv_Cnv', 'abParts_IG_T_CelReceptors',
+        'mcCarroll_Cnv', 'conrad_Cnv', 'genomicSuperDups'],
+}
+
+
+"""Names of the stages a profile asks for: a name from PROFILES or a
+comma-separated list of stage names
+"""
+def profile_stages(profile):
+    names = PROFILES.get(profile)
+    if names is None:
+        names = [name.strip() for name in profile.split(',') if name.strip()]
+    known = [name for name, cls, kwargs in STAGES]
+    unknown = [name for name in names if name not in known]
+    if unknown or not names:
+        raise ValueError(f"Unknown annotation profile {profile}; use one " + \
+            f"of {', '.join(sorted(PROFILES))} or a list of stages from " + \
+            f"{', '.join(known)}")
+    return names
+
+
+"""Version of the reference data behind a stage of the registry, from
+the [references] section of the configuration
+"""
+def reference_version(name):
+    return config.get('references', name, fallback=config.get('annotator',
+        'ReferenceVersion', fallback=''))
+
+
+"""New stage objects from the registry above for the stages of a
+profile, in registry order. The stages they depend on are included
+"""
+def build_stages(format, profile='full'):
+    wanted = set(profile_stages(profile))
+    stages = [(name, cls(format=format, **kwargs))
+        for name, cls, kwargs in STAGES]
+    for name, stage in stages:
+        stage.name = name
+        stage.version = reference_version(name)
+    names = dict([(stage.label, name) for name, stage in stages])
+    # A stage only depends on stages before it
+    for name, stage in reversed(stages):
+        if name in wanted:
+            wanted.update([names[label] for label in stage.depends
+                if label in names])
+    return [stage for name, stage in stages if name in wanted]
+
+
+"""Name of the log of counters for infile: <name>.vcf.count.log for
+<name>.vcf or <name>.vcf.gz
+"""
+def log_path(infile):
+    base = infile[:-3] if infile.endswith('.gz') else infile
+    return base + '.count.log'
+
+
+"""Annotates infile, which may be gzip or BGZF compressed, and returns
+the name of the annotated file: <name>.annot.vcf for <name>.vcf or
+<name>.vcf.gz, with .gz added if compress is set. The counters go to
+log_path(infile). With checkpoint, a run of the same input that
+was interrupted is resumed from its last checkpoint, which is also
+kept in CheckpointBucket if that is set. profile picks the
+stages to run (see profile_stages). With parquet, the annotations are
+also written to the Parquet sidecar <name>.annot.parquet (see
+columnar.py)
+"""
+def run(infile, format, bulk=None, chunksize=None, index=None,
+    sorted_input=None, snapshot=None, workers=None, shard_records=None,
+    threads=None, cache=None, hashes=None, bloom=None, inflight=None,
+    compress=None, checkpoint=None, bins=None, profile=None, parquet=None):
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
-
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    if bulk is None:
+        bulk = config.getboolean('annotator', 'BulkLookups', fallback=False)
+    if chunksize is None:
+        chunksize = config.getint('annotator', 'ChunkSize', fallback=10000)
+    if index is None:
+        index = config.getboolean('annotator', 'IntervalIndex', fallback=False)
+    if index:
+        index = interval_index.shared_cache(
+            config.getint('annotator', 'IndexMemoryMB', fallback=1024))
+    else:
+        index = None
+    if hashes is None:
+        hashes = config.getboolean('annotator', 'HashIndex', fallback=False)
+    if hashes:
+        hashes = hash_index.shared_cache(
+            config.getint('annotator', 'HashIndexMemoryMB', fallback=1024))
+    else:
+        hashes = None
+    if bloom is None:
+        bloom = config.get('annotator', 'DbSnpBloom', fallback='')
+    bloom = bl.open_filters(bloom) if bloom else None
+    if workers is None:
+        workers = config.getint('annotator', 'Workers', fallback=1)
+    if shard_records is None:
+        shard_records = config.getint('annotator', 'ShardRecords',
+            fallback=50000)
+    if threads is None:
+        threads = config.getint('annotator', 'StageThreads', fallback=1)
+    if inflight is None:
+        inflight = config.getint('annotator', 'InFlightQueries', fallback=1)
+    if compress is None:
+        compress = config.getboolean('annotator', 'CompressOutput',
+            fallback=False)
+    if checkpoint is None:
+        checkpoint = config.getboolean('annotator', 'Checkpoints',
+            fallback=False)
+    if checkpoint:
+        use_checkpoint_store()
+    if bins is None:
+        bins = config.getboolean('annotator', 'BinnedQueries',
+            fallback=False)
+    if snapshot is None:
+        snapshot = config.get('annotator', 'Snapshot', fallback='')
+    snapshot = snap.open_snapshot(snapshot, config.getint('annotator',
+        'SnapshotRowCacheMB', fallback=256)) if snapshot else None
+    if (sorted_input is None) and (snapshot is None):
+        sorted_input = config.getboolean('annotator', 'SortedInput',
+            fallback=False)
+
+    if not profile:
+        profile = config.get('annotator', 'AnnotationProfile',
+            fallback='full')
+    stages = build_stages(format, profile)
+    print(f"Annotation profile {profile}: {str(len(stages))} of " + \
+        f"{str(len(STAGES))} stages")
+
+    if cache is None:
+        cache = config.get('annotator', 'VariantCache', fallback='')
+    if cache:
+        # The version covers the reference data of every stage, so that
+        # jobs with other profiles share the cache rather than clear it
+        version = config.get('annotator', 'ReferenceVersion', fallback='')
+        if snapshot is not None:
+            version = version + '@' + snapshot.version
+        cache = variant_cache.VariantCache(cache,
+            '|'.join([version] + [name + '@' + reference_version(name)
+            for name, cls, kwargs in STAGES]),
+            config.getint('annotator', 'VariantCacheMB', fallback=1024) * \
+            1024 * 1024,
+            profile='|'.join([format] + [stage.label for stage in stages]))
+    else:
+        cache = None
+
+    base = infile[:-3] if infile.endswith('.gz') else infile
+    pipeline.run_stages(infile, base + '.annot', log_path(infile),
+        stages, bulk=bulk, chunksize=chunksize, index=index,
+        sweep=sorted_input, snapshot=snapshot, workers=workers,
+        shard_records=shard_records, threads=threads, cache=cache,
+        hashes=hashes, bloom=bloom, inflight=inflight, compress=compress,
+        checkpoint=checkpoint, bins=bins)
+
+    finalout=(base + '.annot').replace('.vcf.annot', '.annot.vcf')
+    if compress:
+        finalout = finalout + '.gz'
+    os.rename(base + '.annot', finalout)
+    write_sidecar(finalout, stages, parquet)
+    return finalout
+
+
+"""Keeps the checkpoints in CheckpointBucket as well as on local disk,
+under <Key>/checkpoints, so that a job delivered again to another
+instance resumes there (see checkpoint.S3Store). Without a bucket they
+stay on local disk
+"""
+def use_checkpoint_store():
+    bucket = config.get('annotator', 'CheckpointBucket', fallback='')
+    if not bucket:
+        ck.use_store(None)
+        return
+    ck.use_store(ck.S3Store(bucket,
+        config.get('aws', 'Key', fallback='') + '/checkpoints',
+        config.getint('annotator', 'CheckpointUploadSeconds', fallback=300)))
+
+
+"""Writes the Parquet sidecar of annotfile if parquet (by default, the
+ParquetSidecar setting) is set and pyarrow is installed
+"""
+def write_sidecar(annotfile, stages, parquet=None):
+    if parquet is None:
+        parquet = config.getboolean('annotator', 'ParquetSidecar',
+            fallback=False)
+    if not parquet:
+        return
+    if not columnar.available():
+        print("pyarrow is not installed; no Parquet sidecar written")
+        return
+    records = columnar.write_parquet(annotfile, columnar.path_for(annotfile),
+        stages)
+    print(f"Parquet sidecar: {str(records)} records")
+
+
+"""Brings the annotated VCF annotfile (<name>.annot.vcf, or .vcf.gz)
+up to date with reloaded reference tables, in place. Only the stages
+named in names (a profile, see profile_stages) are annotated again; by
+default those whose version in the source headers of annotfile differs
+from reference_version(). infile is the input annotfile was
+annotated from, by default <name>.vcf or <name>.vcf.gz next to it. The
+counters of the stages annotated again are added to the end of
+<name>.vcf.count.log and the Parquet sidecar is written again (see
+write_sidecar). Returns the names of the stages annotated again
+"""
+def reannotate(annotfile, format='vcf', names=None, bulk=None,
+    chunksize=None, snapshot=None, bins=None, parquet=None, infile=None):
+
+    print("Re-annotating . . .")
+
+    if bulk is None:
+        bulk = config.getboolean('annotator', 'BulkLookups', fallback=False)
+    if chunksize is None:
+        chunksize = config.getint('annotator', 'ChunkSize', fallback=10000)
+    if bins is None:
+        bins = config.getboolean('annotator', 'BinnedQueries',
+            fallback=False)
+    if snapshot is None:
+        snapshot = config.get('annotator', 'Snapshot', fallback='')
+    snapshot = snap.open_snapshot(snapshot, config.getint('annotator',
+        'SnapshotRowCacheMB', fallback=256)) if snapshot else None
+
+    recorded = rean.sources(annotfile)
+    # The stages of the run that wrote annotfile; files without source
+    # headers were annotated with every stage
+    stages = build_stages(format, ','.join(recorded) if recorded else 'full')
+    if names is None:
+        if not recorded:
+            raise ValueError(f"{annotfile} records no reference versions; " + \
+                "name the stages to annotate again")
+        changed = [stage for stage in stages if (stage.name in recorded) and
+            (recorded[stage.name] != stage.version)]
+    else:
+        wanted = profile_stages(names)
+        missing = [name for name in wanted if recorded and
+            (name not in recorded)]
+        if missing:
+            raise ValueError(f"{annotfile} was not annotated with " + \
+                f"{', '.join(missing)}")
+        changed = [stage for stage in stages if stage.name in wanted]
+    if not changed:
+        print(f"{annotfile} is up to date")
+        return []
+
+    compress = annotfile.endswith('.gz')
+    base = annotfile[:-3] if compress else annotfile
+    if infile is None:
+        infile = base.replace('.annot.vcf', '.vcf')
+        if not os.path.exists(infile) and os.path.exists(infile + '.gz'):
+            infile = infile + '.gz'
+    if not os.path.exists(infile):
+        raise ValueError(f"Re-annotating {annotfile} needs the input it " + \
+            f"was annotated from; {infile} was not found")
+    rean.reannotate_file(annotfile, annotfile + '.reannot', stages,
+        changed, infile, bulk=bulk, chunksize=chunksize, snapshot=snapshot,
+        bins=bins, compress=compress)
+    os.replace(annotfile + '.reannot', annotfile)
+
+    fh_log = open(base.replace('.annot.vcf', '.vcf') + '.count.log', 'a')
+    for stage in changed:
+        fh_log.write(f"## Annotated again with {stage.name} " + \
+            f"{stage.version}\n")
+        stage.report(fh_log)
+        print(f"{stage.label} - done.")
+    fh_log.close()
+    write_sidecar(annotfile, stages, parquet)
+    return [stage.name for stage in changed]
 
 ### EOF
\ No newline at end of file
@@ -0,0 +1,201 @@
+# hash_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory hash indexes for the reference tables that are looked up
+# by exact position (and allele), loaded one chromosome at a time
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import threading
+from collections import OrderedDict
+
+import queries
+
+CONTIGS = dict([(str(c), c) for c in range(1, 23)] +
+    [('X', 23), ('Y', 24), ('M', 25), ('MT', 25)])
+BASES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+
+_contigs = dict(CONTIGS)
+_contigs_lock = threading.Lock()
+
+
+"""Small integer id of a chromosome name, with or without "chr".
+Contigs other than 1-22, X, Y and M get ids from 100 up, in the order
+they are first seen by the process
+"""
+def contig_id(chrom):
+    name = str(chrom)
+    if name.startswith('chr'):
+        name = name[3:]
+    id = _contigs.get(name)
+    if id is None:
+        with _contigs_lock:
+            id = _contigs.setdefault(name, 100 + len(_contigs) - len(CONTIGS))
+    return id
+
+
+"""Strand-canonical code of a tuple of alleles (e.g. (REF,) or
+(REF, ALT)), from 1 up. An allele set and its complement (A/T, C/G on
+every allele) get the same code. Alleles that are not all single
+A, C, G or T bases get 0
+"""
+def allele_code(alleles):
+    codes = []
+    for allele in alleles:
+        base = BASES.get(str(allele).upper())
+        if base is None:
+            return 0
+        codes.append(base)
+    forward = 0
+    reverse = 0
+    for base in codes:
+        forward = forward * 4 + base
+        reverse = reverse * 4 + (3 - base)
+    return min(forward, reverse) + 1
+
+
+"""Integer key of a position and allele code: the contig id in the high
+bits, then the position, then the allele code
+"""
+def position_key(chrom, pos, code=0):
+    return (((contig_id(chrom) << 32) | int(pos)) << 8) | code
+
+
+"""Rows of one chromosome of a table, hashed by position_key()
+alleles names the columns folded into the allele code; rows whose
+alleles have no code are stored under code 0. Each row is stored with
+its position in the table, so rows from two codes can be merged back
+into table order
+"""
+class HashIndex(object):
+    def __init__(self, rows, chrom, posIndex, alleleIndices=()):
+        self.rows = {}
+        self.count = 0
+        for n, row in enumerate(rows):
+            if row[posIndex] is None:
+                continue
+            code = allele_code([row[i] for i in alleleIndices]) \
+                if alleleIndices else 0
+            key = position_key(chrom, row[posIndex], code)
+            self.rows.setdefault(key, []).append((n, row))
+            self.count = self.count + 1
+
+    # Rows at pos whose allele code is code or 0, in table order. Rows
+    # can still differ from the alleles in case or be coded 0, so
+    # callers filter them
+    def probe(self, chrom, pos, code=0):
+        hits = self.rows.get(position_key(chrom, pos, code), [])
+        if (code != 0):
+            hits = sorted(hits + self.rows.get(position_key(chrom, pos, 0),
+                []))
+        return [row for n, row in hits]
+
+    # Rough size in bytes, for the memory budget
+    def nbytes(self):
+        size = sys.getsizeof(self.rows) + 100 * len(self.rows)
+        sample = [row for rows in list(self.rows.values())[:100]
+            for n, row in rows]
+        if (len(sample) > 0):
+            per_row = sum([sys.getsizeof(row) + \
+                sum([sys.getsizeof(v) for v in row]) for row in sample])
+            size = size + (per_row * self.count) // len(sample)
+        return size
+
+
+"""Tables looked up by equality, as
+name: (chrom column, position column, allele columns)
+"""
+TABLES = {
+    'dbSNP': ('CHR', 'POS', ('REF',)),
+    'chrom_pos_equal_base': ('CHR', 'start',
+        ('haplotypeReference', 'haplotypeAlternate')),
+    'chrom_pos_equal_nobase': ('CHR', 'start', ()),
+    'gwasCatalog': ('chrom', 'chromEnd', ()),
+}
+
+
+"""Least recently used set of HashIndex objects, keyed by (table,
+where, chrom), with the same memory budget rules as
+interval_index.IntervalIndexCache. where is an extra (column, value)
+condition the rows are loaded with, e.g. the dbSNP variant class
+"""
+class HashIndexCache(object):
+    def __init__(self, budget=1024 * 1024 * 1024):
+        self.budget = budget
+        self.indexes = OrderedDict()
+        self.sizes = {}
+        self.used = 0
+        self.loads = 0
+        self.evictions = 0
+        self.columns = {}
+        self.lock = threading.RLock()
+
+    # Position of a column in the rows of a table that has been loaded
+    def column(self, table, name):
+        return self.columns[table].index(name)
+
+    # Candidate rows of table at chrom:pos for the given alleles
+    def probe(self, cursor, table, chrom, pos, alleles=(), where=None):
+        index = self.chromosome(cursor, table, chrom, where)
+        return index.probe(chrom, pos, allele_code(alleles) if alleles else 0)
+
+    def chromosome(self, cursor, table, chrom, where):
+        key = (table, where, chrom)
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is None:
+                return self.load(cursor, table, chrom, where)
+            self.indexes.move_to_end(key)
+            return index
+
+    def load(self, cursor, table, chrom, where):
+        chromColumn, posColumn, alleleColumns = TABLES[table]
+        name = table + '.hash'
+        sql = 'select * from ' + table + ' where ' + chromColumn + ' = %s'
+        params = (str(chrom),)
+        if where is not None:
+            name = name + '.' + where[0]
+            sql = sql + ' AND ' + where[0] + ' = %s'
+            params = params + (where[1],)
+        queries.execute(cursor, queries.register(name, sql + ';'), params)
+        names = [d[0] for d in cursor.description]
+        self.columns[table] = names
+        index = HashIndex(cursor.fetchall(), chrom, names.index(posColumn),
+            [names.index(c) for c in alleleColumns])
+
+        key = (table, where, chrom)
+        self.indexes[key] = index
+        self.sizes[key] = index.nbytes()
+        self.used = self.used + self.sizes[key]
+        self.loads = self.loads + 1
+        self.evict(keep=key)
+        return index
+
+    def evict(self, keep=None):
+        with self.lock:
+            while (self.used > self.budget and len(self.indexes) > 1):
+                key = next(iter(self.indexes))
+                if (key == keep):
+                    break
+                del self.indexes[key]
+                self.used = self.used - self.sizes.pop(key)
+                self.evictions = self.evictions + 1
+
+
+_cache = None
+
+"""Process-wide hash index cache
+"""
+def shared_cache(budget_mb=1024):
+    global _cache
+    if _cache is None:
+        _cache = HashIndexCache()
+    _cache.budget = int(budget_mb) * 1024 * 1024
+    _cache.evict()
+    return _cache
+
+### EOF
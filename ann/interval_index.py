@@ -0,0 +1,283 @@
+# interval_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory interval indexes for the reference range tables, loaded one
+# chromosome at a time on first use
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import bisect
+import threading
+from array import array
+from collections import OrderedDict
+
+import queries
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+"""Vectorized point-in-interval lookup for a batch of positions
+starts must be sorted and maxEnds is the running maximum of ends in the
+same order. Returns (variant, interval) index arrays with one entry per
+hit, ordered by variant and then by interval start
+"""
+def overlap_hits(starts, ends, maxEnds, positions):
+    hi = np.searchsorted(starts, positions, side='right')
+    lo = np.minimum(np.searchsorted(maxEnds, positions, side='left'), hi)
+    counts = hi - lo
+    variants = np.repeat(np.arange(len(positions)), counts)
+    offsets = np.arange(counts.sum()) - \
+        np.repeat(np.cumsum(counts) - counts, counts)
+    candidates = np.repeat(lo, counts) + offsets
+    keep = ends[candidates] >= positions[variants]
+    return variants[keep], candidates[keep]
+
+
+"""Reorders the (variant, interval) hits of overlap_hits() by variant
+and then by ids[interval], the position of the interval's row in the
+table, so that every variant gets its rows in the order the reference
+database returns them
+"""
+def in_table_order(variants, intervals, ids):
+    order = np.lexsort((ids[intervals], variants))
+    return variants[order], intervals[order]
+
+
+"""Sorted, array-backed intervals of one chromosome of one table
+intervals are (start, end, row) in the order the table returned them;
+ids[i] is that position for interval i of the sorted arrays, so hits
+come back in table order, as they would from the database. maxEnds[i]
+is the largest end among the first i+1 intervals, which lets lookups
+skip everything that ends before the position even when intervals are
+nested
+"""
+class IntervalIndex(object):
+    def __init__(self, intervals):
+        intervals = list(intervals)
+        order = sorted(range(len(intervals)),
+            key=lambda i: (intervals[i][0], i))
+        self.starts = array('q', [intervals[i][0] for i in order])
+        self.ends = array('q', [intervals[i][1] for i in order])
+        self.ids = array('q', order)
+        self.rows = [intervals[i][2] for i in order]
+        self.maxEnds = array('q')
+        maxEnd = None
+        for end in self.ends:
+            maxEnd = end if (maxEnd is None or end > maxEnd) else maxEnd
+            self.maxEnds.append(maxEnd)
+
+    def __len__(self):
+        return len(self.rows)
+
+    # Rows with start <= pos <= end, in table order
+    def overlapping(self, pos):
+        hi = bisect.bisect_right(self.starts, pos)
+        lo = bisect.bisect_left(self.maxEnds, pos, 0, hi)
+        ends = self.ends
+        hits = [i for i in range(lo, hi) if ends[i] >= pos]
+        hits.sort(key=self.ids.__getitem__)
+        return [self.rows[i] for i in hits]
+
+    # Rows overlapping each position of a batch, as a list of lists.
+    # Uses the NumPy kernel when NumPy is installed
+    def overlapping_batch(self, positions):
+        if np is None:
+            return [self.overlapping(pos) for pos in positions]
+
+        hits = [[] for pos in positions]
+        variants, intervals = overlap_hits(
+            np.frombuffer(self.starts, dtype=np.int64),
+            np.frombuffer(self.ends, dtype=np.int64),
+            np.frombuffer(self.maxEnds, dtype=np.int64),
+            np.asarray(positions, dtype=np.int64))
+        variants, intervals = in_table_order(variants, intervals,
+            np.frombuffer(self.ids, dtype=np.int64))
+        rows = self.rows
+        for v, i in zip(variants.tolist(), intervals.tolist()):
+            hits[v].append(rows[i])
+        return hits
+
+    # Rough size in bytes, for the memory budget
+    def nbytes(self):
+        size = 4 * 8 * len(self.rows) + sys.getsizeof(self.rows)
+        sample = self.rows[:100]
+        if (len(sample) > 0):
+            per_row = sum([sys.getsizeof(row) + \
+                sum([sys.getsizeof(v) for v in row]) for row in sample])
+            size = size + (per_row * len(self.rows)) // len(sample)
+        return size
+
+
+"""Least recently used set of IntervalIndex objects, keyed by
+(table, chrom). A chromosome is loaded from the reference database the
+first time it is looked up; whole chromosomes are evicted once the
+indexes go over the memory budget. Stages looked up on different
+threads share the cache, so lookups of the cache are serialized
+"""
+class IntervalIndexCache(object):
+    def __init__(self, budget=1024 * 1024 * 1024):
+        self.budget = budget
+        self.indexes = OrderedDict()
+        self.sizes = {}
+        self.used = 0
+        self.loads = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    # Rows of table whose [startColumn, endColumn] contains pos.
+    # chromColumn is None for tables that hold a single chromosome
+    def overlapping(self, cursor, table, chromColumn, chrom, pos,
+        startColumn='chromStart', endColumn='chromEnd', columns='*'):
+        index = self.chromosome(cursor, table, chromColumn, chrom,
+            startColumn, endColumn, columns)
+        return index.overlapping(int(pos))
+
+    # Same as overlapping() for a list of positions on one chromosome
+    def overlapping_batch(self, cursor, table, chromColumn, chrom, positions,
+        startColumn='chromStart', endColumn='chromEnd', columns='*'):
+        index = self.chromosome(cursor, table, chromColumn, chrom,
+            startColumn, endColumn, columns)
+        return index.overlapping_batch([int(pos) for pos in positions])
+
+    # The IntervalIndex of one chromosome, loaded on first use
+    def chromosome(self, cursor, table, chromColumn, chrom, startColumn,
+        endColumn, columns):
+        key = (table, chrom)
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is None:
+                return self.load(cursor, table, chromColumn, chrom,
+                    startColumn, endColumn, columns)
+            self.indexes.move_to_end(key)
+            return index
+
+    def load(self, cursor, table, chromColumn, chrom, startColumn,
+        endColumn, columns):
+        queries.execute(cursor, chromosome_statement(table, chromColumn,
+            columns), () if (chromColumn is None) else (str(chrom),))
+        names = [d[0] for d in cursor.description]
+        s = names.index(startColumn)
+        e = names.index(endColumn)
+        index = IntervalIndex([(int(row[s]), int(row[e]), row)
+            for row in cursor.fetchall()])
+
+        key = (table, chrom)
+        self.indexes[key] = index
+        self.sizes[key] = index.nbytes()
+        self.used = self.used + self.sizes[key]
+        self.loads = self.loads + 1
+        self.evict(keep=key)
+        return index
+
+    def evict(self, keep=None):
+        with self.lock:
+            while (self.used > self.budget and len(self.indexes) > 1):
+                key = next(iter(self.indexes))
+                if (key == keep):
+                    break
+                del self.indexes[key]
+                self.used = self.used - self.sizes.pop(key)
+                self.evictions = self.evictions + 1
+
+
+"""Chromosome name as the reference database compares it: MySQL's
+collation ignores case and trailing spaces, so chrMT, chrmt and
+'chrMT ' all name the same chromosome
+"""
+def chrom_key(chrom):
+    return str(chrom).rstrip().upper()
+
+
+"""Index of a whole table that every job needs, such as cpgIslandExt
+Each chromosome is loaded with chromosome_statement() the first time it
+is looked up and kept for the life of the process. Its rows keep the
+order that query returned them in, which is the order the per-position
+query reads them in too, so overlapping()[0] is the row that query
+fetches first. Chromosomes are keyed by chrom_key(), so lookups match
+them as the query would
+"""
+class TableIndex(object):
+    def __init__(self, table, chromColumn='chrom', startColumn='chromStart',
+        endColumn='chromEnd', columns='*'):
+        self.table = table
+        self.chromColumn = chromColumn
+        self.startColumn = startColumn
+        self.endColumn = endColumn
+        self.columns = columns
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    # Rows with start <= pos <= end on chrom, in table order
+    def overlapping(self, cursor, chrom, pos):
+        with self.lock:
+            index = self.indexes.get(chrom_key(chrom))
+            if index is None:
+                index = self.load(cursor, chrom)
+        return index.overlapping(int(pos))
+
+    def load(self, cursor, chrom):
+        queries.execute(cursor, chromosome_statement(self.table,
+            self.chromColumn, self.columns), (str(chrom),))
+        names = [d[0] for d in cursor.description]
+        c = names.index(self.chromColumn)
+        s = names.index(self.startColumn)
+        e = names.index(self.endColumn)
+        key = chrom_key(chrom)
+        index = IntervalIndex([(int(row[s]), int(row[e]), row)
+            for row in cursor.fetchall() if (chrom_key(row[c]) == key)])
+        self.indexes[key] = index
+        return index
+
+
+"""Registered statement that selects the rows of one chromosome of
+table, with the chromosome as its parameter. Tables without a
+chromosome column (chromColumn None) are selected whole. Like the
+per-variant queries it has no order by, so rows come back in table
+order: the order MySQL reads them in, by the chromosome index where
+there is one and as stored otherwise. The per-variant query reads the
+same rows the same way, so both return the hits of a position in the
+same order on tables without an index on the start column. The binned
+statements, which order by start, are the only ones that differ (see
+annotate.Stage)
+"""
+def chromosome_statement(table, chromColumn, columns='*'):
+    sql = 'select ' + columns + ' from ' + table
+    if chromColumn is not None:
+        sql = sql + ' where ' + chromColumn + ' = %s'
+    return queries.register(table + '.chromosome', sql + ';')
+
+
+_tables = {}
+
+"""Process-wide TableIndex for a table
+"""
+def table_index(table, chromColumn='chrom', startColumn='chromStart',
+    endColumn='chromEnd', columns='*'):
+    if table not in _tables:
+        _tables[table] = TableIndex(table, chromColumn, startColumn,
+            endColumn, columns)
+    return _tables[table]
+
+
+_cache = None
+
+"""Process-wide index cache. Each job runs in a process of its own
+(see annotator.py), so chromosomes are loaded once per job and shared
+by its stages
+"""
+def shared_cache(budget_mb=1024):
+    global _cache
+    if _cache is None:
+        _cache = IntervalIndexCache()
+    _cache.budget = int(budget_mb) * 1024 * 1024
+    _cache.evict()
+    return _cache
+
+### EOF
@@ -0,0 +1,496 @@
+# pipeline.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Single-pass annotation engine: every stage runs on the in-memory
+# record and the annotated record is written out once
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import copy
+import zlib
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import utils as u
+import sweep as sw
+import snapshot as snap
+import interval_index
+import hash_index
+import bloom as bl
+import queries
+import async_lookup
+import bgzf
+import checkpoint as ck
+from vcf_record import VcfRecord
+
+
+"""Stages used to pass records to each other through temporary files,
+and each stage stripped the line it read back in. Drop the trailing
+whitespace that round trip would have dropped so the output stays the same
+"""
+def restrip(fields):
+    if isinstance(fields, VcfRecord):
+        fields.restrip()
+    elif fields[-1][-1:].isspace():
+        fields[-1] = fields[-1].rstrip()
+
+
+"""Header lines naming the reference data behind each stage, in the
+form ##annotationSource=<ID=name,Version=version>. Stages without a
+name (see annotate.Stage) get none
+"""
+SOURCE_HEADER = '##annotationSource=<'
+
+def source_headers(stages):
+    return [SOURCE_HEADER + 'ID=' + stage.name + ',Version=' + \
+        str(stage.version) + '>' for stage in stages if stage.name]
+
+
+"""(name, version) from a source header line, or None for other lines
+"""
+def parse_source(line):
+    if not line.startswith(SOURCE_HEADER):
+        return None
+    fields = dict([field.split('=', 1) for field in
+        line.strip()[len(SOURCE_HEADER):].rstrip('>').split(',')
+        if '=' in field])
+    return (fields.get('ID', ''), fields.get('Version', ''))
+
+
+"""Looks up the keys of a chunk of records for one stage
+Returns the rows for each key, in order. Each distinct key is looked
+up once and its rows handed to every record with that key (records at
+the same site, e.g. split multi-allelic sites, share keys). In bulk
+mode, and for stages served from a local index, the distinct keys are
+resolved together through the stage's bulk_query(). Otherwise, given
+an async_lookup.PipelinedLookups, the keys of pipelined stages are
+looked up with several queries in flight
+"""
+def resolve(cursor, stage, keys, bulk=False, engine=None):
+    local = (bulk or stage.indexed())
+    if (engine is not None) and stage.pipelined and not local:
+        return engine.resolve(stage, keys)
+
+    distinct = list(dict.fromkeys([key for key in keys if key is not None]))
+    if not distinct:
+        found = {}
+    elif local:
+        found = stage.bulk_query(cursor, distinct)
+    else:
+        found = dict([(key, stage.query(cursor, key)) for key in distinct])
+    return [found.get(key, ()) if (key is not None) else None
+        for key in keys]
+
+
+"""Checks that every stage comes after the stages it depends on
+Dependencies on stages that are not in the list are taken to be
+satisfied by an earlier run over the file
+"""
+def check_depends(stages):
+    labels = [stage.label for stage in stages]
+    for i, stage in enumerate(stages):
+        for label in stage.depends:
+            if (label in labels) and (labels.index(label) >= i):
+                raise ValueError(f"Stage {stage.label} depends on " + \
+                    f"{label}, which runs after it")
+
+
+"""Runs every stage over a chunk of split records
+Annotations are always applied in stage order. Given an executor, the
+lookups of the stages run concurrently on it: a stage is looked up as
+soon as the stages it depends on have annotated the chunk, on a thread
+that gets its cursor from cursor_for(). Given a list of deltas (one
+per record), the counter increments of each stage are recorded there
+as [stage index, [[counter, increment], ...]] entries. engine is passed
+on to resolve()
+"""
+def annotate_chunk(cursor, stages, records, bulk=False, executor=None,
+    cursor_for=None, deltas=None, engine=None):
+    labels = [stage.label for stage in stages]
+    last = len(stages) - 1
+    pending = {}
+
+    def lookup(stage, keys):
+        return resolve(cursor_for(), stage, keys, bulk=bulk, engine=engine)
+
+    for i, stage in enumerate(stages):
+        if executor is None:
+            keys = [stage.key(fields) for fields in records]
+            results = resolve(cursor, stage, keys, bulk=bulk, engine=engine)
+        else:
+            done = labels[:i]
+            for j in range(i, len(stages)):
+                if (j not in pending) and all([(label in done) or
+                    (label not in labels) for label in stages[j].depends]):
+                    keys = [stages[j].key(fields) for fields in records]
+                    pending[j] = (keys,
+                        executor.submit(lookup, stages[j], keys))
+            keys, future = pending.pop(i)
+            results = future.result()
+
+        for r, (fields, key, rows) in enumerate(zip(records, keys, results)):
+            if key is not None:
+                if deltas is not None:
+                    before = dict(stage.counts)
+                stage.annotate(fields, rows)
+                if (i < last):
+                    restrip(fields)
+                if deltas is not None:
+                    changed = [[name, count - before[name]] for name, count
+                        in stage.counts.items() if (count != before[name])]
+                    if changed:
+                        deltas[r].append([i, changed])
+
+
+"""Runs every stage over a chunk of split records, taking the records
+found in a variant_cache.VariantCache from there and adding the rest
+to it once annotated
+"""
+def annotate_cached(cursor, stages, records, cache, bulk=False,
+    executor=None, cursor_for=None, engine=None):
+    keys = [cache.key(stages, fields) for fields in records]
+    found = cache.get(list(dict.fromkeys([key for key in keys
+        if key is not None])))
+
+    misses = []
+    for fields, key in zip(records, keys):
+        entry = found.get(key)
+        if entry is not None:
+            cache.apply(stages, fields, entry)
+        else:
+            misses.append((key, fields.copy(), fields))
+    if (len(misses) == 0):
+        return
+
+    deltas = [[] for miss in misses]
+    annotate_chunk(cursor, stages, [miss[2] for miss in misses], bulk=bulk,
+        executor=executor, cursor_for=cursor_for, deltas=deltas,
+        engine=engine)
+    cache.put(stages, [(key, original, annotated, counts) for
+        (key, original, annotated), counts in zip(misses, deltas)
+        if key is not None])
+
+
+"""Points stages at the lookup structures annotate_file() was given
+"""
+def attach(stages, index=None, sweep=False, snapshot=None, hashes=None,
+    bloom=None, bins=False):
+    for stage in stages:
+        stage.index = index if (snapshot is None) else snapshot
+        stage.snapshot = snapshot
+        stage.hashes = hashes if (snapshot is None) else None
+        stage.bloom = bloom if (snapshot is None) else None
+        stage.bins = bins if (snapshot is None) else False
+        if (sweep and stage.sweepable and snapshot is None):
+            stage.sweep = sw.SweepJoin(stage.sweepQuery,
+                stage.startColumn, stage.endColumn)
+
+
+"""Annotates infile into outfile with a list of annotate.Stage objects,
+in one pass. Records are read and annotated in chunks of chunksize;
+header lines are copied through. index, an IntervalIndexCache, serves
+range lookups from memory for the stages that support it. sweep=True
+sweeps each sweepable stage's table alongside the records instead, for
+as long as they come in coordinate order. With a snapshot.Snapshot every stage
+reads the reference tables from the snapshot and no database
+connection is opened. threads > 1 runs the lookups of independent
+stages concurrently, each thread with its own connection. With a
+variant_cache.VariantCache, variants annotated by earlier jobs are
+taken from the cache. hashes, a hash_index.HashIndexCache, serves the
+exact position lookups from memory, and bloom, a bloom.BloomFilters,
+rules out dbSNP lookups of positions dbSNP does not have. inflight > 1
+keeps up to that many per-variant queries of the pipelined stages in
+flight, each connection on its own thread. With bins the range queries
+also select by UCSC bin (see ucsc_bin). infile may be gzip or BGZF
+compressed; with compress the output is written as BGZF. The source
+headers of the stages (see source_headers) are written before the
+#CHROM line, in place of any the input has for the same stages.
+
+With checkpoint, a checkpoint (see checkpoint.py) is written next to
+outfile after every chunk and once outfile is complete. A run that
+finds a checkpoint of the same input and stages picks up after the
+last records it covers, with the stage counters it recorded
+"""
+def annotate_file(infile, outfile, stages, sep='\t', bulk=False,
+    chunksize=10000, index=None, sweep=False, snapshot=None, threads=1,
+    cache=None, hashes=None, bloom=None, inflight=1, compress=False,
+    checkpoint=False, bins=False):
+    check_depends(stages)
+    state = None
+    if checkpoint:
+        state = ck.load(outfile, infile, stages, compress)
+    if state is not None:
+        ck.resume(outfile, state, stages)
+        print(f"Resuming {outfile} after {str(state['lines'])} lines")
+        if state['done']:
+            return
+    attach(stages, index=index, sweep=sweep, snapshot=snapshot,
+        hashes=hashes, bloom=bloom, bins=bins)
+    names = [stage.name for stage in stages if stage.name]
+
+    fh = bgzf.open_text(infile)
+    fh_out = bgzf.open_output(outfile, compress, append=(state is not None))
+    conn = None
+    cursor = None
+    if snapshot is None:
+        conn = u.db_connect()
+        cursor = conn.cursor()
+    chunk = []
+
+    executor = None
+    local = threading.local()
+    connections = []
+    if (threads > 1):
+        executor = ThreadPoolExecutor(max_workers=threads)
+
+    # pymysql connections must not be shared between threads
+    def cursor_for():
+        if snapshot is not None:
+            return None
+        if getattr(local, 'cursor', None) is None:
+            connections.append(u.db_connect())
+            local.cursor = connections[-1].cursor()
+        return local.cursor
+
+    lookups = None
+    engine = None
+    if (inflight > 1) and (snapshot is None):
+        lookups = ThreadPoolExecutor(max_workers=inflight)
+        engine = async_lookup.PipelinedLookups(lookups, cursor_for, inflight)
+
+    def flush():
+        if cache is not None:
+            annotate_cached(cursor, stages, chunk, cache, bulk=bulk,
+                executor=executor, cursor_for=cursor_for, engine=engine)
+        else:
+            annotate_chunk(cursor, stages, chunk, bulk=bulk,
+                executor=executor, cursor_for=cursor_for, engine=engine)
+        for fields in chunk:
+            fh_out.write(fields.serialize() + '\n')
+        del chunk[:]
+
+    # Lines of the input read so far and their CRC32; a resumed run
+    # skips the lines its checkpoint covers
+    lines = 0
+    crc = 0
+    skip = state['lines'] if (state is not None) else 0
+    for line in fh:
+        lines = lines + 1
+        if checkpoint:
+            crc = zlib.crc32(line.encode(), crc)
+        if (lines <= skip):
+            continue
+        line = line.strip()
+        if line.startswith('#'):
+            flush()
+            source = parse_source(line)
+            if (source is not None) and (source[0] in names):
+                continue
+            if line.startswith('#CHROM'):
+                for header in source_headers(stages):
+                    fh_out.write(header + '\n')
+            fh_out.write(line + '\n')
+            continue
+
+        chunk.append(VcfRecord(line, sep))
+        if (len(chunk) >= chunksize):
+            flush()
+            if checkpoint:
+                fh_out.flush()
+                os.fsync(fh_out.fileno())
+                ck.save(outfile, infile, stages, lines, crc, compress)
+    flush()
+
+    if executor is not None:
+        executor.shutdown()
+    if lookups is not None:
+        lookups.shutdown()
+        print(f"Pipelined lookups: {str(engine.queries)} queries, " + \
+            f"{str(engine.limit.current())} of {str(inflight)} in flight " + \
+            f"at the end, {str(engine.limit.decreases)} backoffs")
+    for thread_conn in connections:
+        thread_conn.close()
+    for stage in stages:
+        if stage.sweep is not None:
+            stage.sweep.close()
+            stage.sweep = None
+    if conn is not None:
+        conn.close()
+    if cache is not None:
+        print(f"Variant cache: {str(cache.hits)} hits, " + \
+            f"{str(cache.misses)} misses")
+        cache.close()
+    fh.close()
+    fh_out.close()
+    if checkpoint:
+        ck.save(outfile, infile, stages, lines, crc, compress, done=True)
+
+
+"""Splits a VCF into shard files of consecutive lines. A shard ends where
+the chromosome changes or once it holds shard_records records (0 for no
+limit), so the shards concatenated in order give back the input.
+Returns the shard file names
+"""
+def split_shards(infile, prefix, sep='\t', shard_records=50000):
+    names = []
+    fh_out = None
+    chrom = None
+    records = 0
+    fh = bgzf.open_text(infile)
+    for line in fh:
+        record = not line.strip().startswith('#')
+        if record:
+            c = line.strip().split(sep, 1)[0].strip()
+            if (fh_out is not None) and ((c != chrom) or
+                (shard_records > 0 and records >= shard_records)):
+                fh_out.close()
+                fh_out = None
+            chrom = c
+
+        if fh_out is None:
+            names.append(prefix + str(len(names)))
+            fh_out = open(names[-1], 'w')
+            records = 0
+        fh_out.write(line)
+        if record:
+            records = records + 1
+    if fh_out is not None:
+        fh_out.close()
+    fh.close()
+    return names
+
+
+"""Annotates one shard in a worker process and returns the counters of
+each stage and the worker's query statistics. The worker opens its own
+index caches and snapshot
+"""
+def annotate_shard(infile, outfile, stages, sep, bulk, chunksize, index_mb,
+    sweep, snapshot_dir, snapshot_mb, threads, cache, hash_mb, bloom_dir,
+    inflight, checkpoint, bins):
+    index = None
+    if index_mb is not None:
+        index = interval_index.shared_cache(index_mb)
+    hashes = None
+    if hash_mb is not None:
+        hashes = hash_index.shared_cache(hash_mb)
+    bloom = None
+    if bloom_dir is not None:
+        bloom = bl.open_filters(bloom_dir)
+    queries.reset()
+    snapshot = None
+    if snapshot_dir is not None:
+        snapshot = snap.open_snapshot(snapshot_dir, snapshot_mb)
+    annotate_file(infile, outfile, stages, sep=sep, bulk=bulk,
+        chunksize=chunksize, index=index, sweep=sweep, snapshot=snapshot,
+        threads=threads, cache=cache, hashes=hashes, bloom=bloom,
+        inflight=inflight, checkpoint=checkpoint, bins=bins)
+    return [stage.counts for stage in stages], queries.stats()
+
+
+"""Annotates infile into outfile on a pool of worker processes
+The shards from split_shards() are annotated concurrently, their output
+is concatenated in order and each worker's stage counters are added to
+the counters of stages. The index and snapshot row cache memory
+budgets are split between the workers, since each one keeps its own
+caches. The shards are written uncompressed; with compress the
+concatenated output is BGZF. With checkpoint every shard is
+checkpointed, and the shards are left in place if the run fails, so
+the next run over the same input resumes each shard where it stopped
+"""
+def annotate_sharded(infile, outfile, stages, sep='\t', bulk=False,
+    chunksize=10000, index=None, sweep=False, snapshot=None, workers=2,
+    shard_records=50000, threads=1, cache=None, hashes=None, bloom=None,
+    inflight=1, compress=False, checkpoint=False, bins=False):
+    index_mb = None
+    if index is not None:
+        index_mb = max(1, index.budget // workers // (1024 * 1024))
+    hash_mb = None
+    if hashes is not None:
+        hash_mb = max(1, hashes.budget // workers // (1024 * 1024))
+    snapshot_dir = None
+    snapshot_mb = None
+    if snapshot is not None:
+        snapshot_dir = snapshot.dirname
+        snapshot_mb = max(1, snapshot.rows.budget // workers // (1024 * 1024))
+    bloom_dir = bloom.dirname if (bloom is not None) else None
+
+    shards = split_shards(infile, outfile + '.shard', sep=sep,
+        shard_records=shard_records)
+    completed = False
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Arguments are pickled later, on the executor's thread, so each
+            # shard gets its own copy of the stages before any counters
+            # are merged into them
+            futures = [pool.submit(annotate_shard, shard, shard + '.annot',
+                copy.deepcopy(stages), sep, bulk, chunksize, index_mb, sweep,
+                snapshot_dir, snapshot_mb, threads, cache, hash_mb, bloom_dir,
+                inflight, checkpoint, bins) for shard in shards]
+
+            fh_out = bgzf.open_output(outfile, compress)
+            for shard, future in zip(shards, futures):
+                shard_counts, stats = future.result()
+                queries.merge(stats)
+                for stage, counts in zip(stages, shard_counts):
+                    for name, count in counts.items():
+                        stage.counts[name] = stage.counts.get(name, 0) + count
+                with open(shard + '.annot') as fh:
+                    shutil.copyfileobj(fh, fh_out)
+            fh_out.close()
+        completed = True
+    finally:
+        if completed or not checkpoint:
+            for shard in shards:
+                ck.remove(shard + '.annot')
+                for name in [shard, shard + '.annot']:
+                    if os.path.exists(name):
+                        os.remove(name)
+
+
+"""Runs a list of annotate.Stage objects over a VCF file and writes the
+stage counters to the log file once all records have been annotated.
+With workers > 1 the file is annotated in shards on that many
+processes (see annotate_sharded); otherwise see annotate_file. The
+execution counts and latency of the stages' queries are printed at the
+end. A checkpointed run holds a lock on outfile (see checkpoint.lock)
+and removes its checkpoints once the log is written
+"""
+def run_stages(infile, outfile, logfile, stages, logmode='w', sep='\t',
+    bulk=False, chunksize=10000, index=None, sweep=False, snapshot=None,
+    workers=1, shard_records=50000, threads=1, cache=None, hashes=None,
+    bloom=None, inflight=1, compress=False, checkpoint=False, bins=False):
+    queries.reset()
+    held = ck.lock(outfile) if checkpoint else None
+    try:
+        if (workers > 1):
+            annotate_sharded(infile, outfile, stages, sep=sep, bulk=bulk,
+                chunksize=chunksize, index=index, sweep=sweep,
+                snapshot=snapshot, workers=workers,
+                shard_records=shard_records, threads=threads, cache=cache,
+                hashes=hashes, bloom=bloom, inflight=inflight,
+                compress=compress, checkpoint=checkpoint, bins=bins)
+        else:
+            annotate_file(infile, outfile, stages, sep=sep, bulk=bulk,
+                chunksize=chunksize, index=index, sweep=sweep,
+                snapshot=snapshot, threads=threads, cache=cache,
+                hashes=hashes, bloom=bloom, inflight=inflight,
+                compress=compress, checkpoint=checkpoint, bins=bins)
+
+        fh_log = open(logfile, logmode)
+        for stage in stages:
+            stage.report(fh_log)
+            print(f"{stage.label} - done.")
+        fh_log.close()
+        if checkpoint:
+            ck.remove(outfile)
+    finally:
+        if held is not None:
+            ck.unlock(held)
+    queries.report()
+
+### EOF
@@ -0,0 +1,90 @@
+# queries.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Registry of the statements the annotation stages run per variant, so
+# each has a name it is counted and timed under. pymysql binds the
+# parameters on the client: every execution sends the statement text
+# with the values escaped into it, and MySQL parses it again. The
+# registry names and counts the statements; it does not make them
+# server-side prepared statements
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import time
+import threading
+
+_statements = {}
+_stats = {}
+_lock = threading.Lock()
+
+
+"""A statement with %s placeholders for its parameters
+"""
+class Statement(object):
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+
+
+"""Registers sql under name and returns its Statement. A name always
+stands for the same statement
+"""
+def register(name, sql):
+    with _lock:
+        statement = _statements.setdefault(name, Statement(name, sql))
+    if (statement.sql != sql):
+        raise ValueError(f"Statement {name} is already registered as " + \
+            f"{statement.sql}")
+    return statement
+
+
+"""Executes statement with params bound to its placeholders and returns
+the cursor to fetch the rows from. pymysql escapes the parameters into
+the statement text before sending it, so values never need quoting by
+the caller
+"""
+def execute(cursor, statement, params=()):
+    start = time.perf_counter()
+    cursor.execute(statement.sql, params)
+    elapsed = time.perf_counter() - start
+    with _lock:
+        stats = _stats.setdefault(statement.name, [0, 0.0])
+        stats[0] = stats[0] + 1
+        stats[1] = stats[1] + elapsed
+    return cursor
+
+
+"""Execution counts and seconds spent per statement since the last
+reset(), as {name: [count, seconds]}
+"""
+def stats():
+    with _lock:
+        return dict([(name, list(s)) for name, s in _stats.items()])
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+# Adds the stats() of another process
+def merge(other):
+    with _lock:
+        for name, (count, seconds) in other.items():
+            stats = _stats.setdefault(name, [0, 0.0])
+            stats[0] = stats[0] + count
+            stats[1] = stats[1] + seconds
+
+
+def report(fh=None):
+    fh = sys.stdout if (fh is None) else fh
+    for name, (count, seconds) in sorted(stats().items()):
+        fh.write(f"Query {name}: {str(count)} executions, " + \
+            f"{(seconds * 1000):.1f} ms ({(seconds * 1000 / count):.3f} " + \
+            "ms each)\n")
+
+### EOF
@@ -0,0 +1,293 @@
+# reannotate.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Re-annotation of an annotated VCF after one reference table has been
+# reloaded: the entries the stages of that table wrote are taken out of
+# every record and looked up again, and the rest of the record is kept.
+# Records that cannot be split that way are annotated again from the
+# input with every stage
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import utils as u
+import bgzf
+import pipeline
+from vcf_record import VcfRecord, INFO
+
+
+"""The source headers of an annotated VCF (see pipeline.source_headers),
+as a dict of stage name to version
+"""
+def sources(path):
+    found = {}
+    fh = bgzf.open_text(path)
+    try:
+        for line in fh:
+            if not line.startswith('#'):
+                break
+            source = pipeline.parse_source(line)
+            if source is not None:
+                found[source[0]] = source[1]
+    finally:
+        fh.close()
+    return found
+
+
+"""Index in stages of the stage that writes each INFO key. A key written
+by several stages goes to the first of them
+"""
+def key_owners(stages):
+    owners = {}
+    for i, stage in enumerate(stages):
+        for key in stage.infoKeys:
+            owners.setdefault(key, i)
+    return owners
+
+
+"""True when no other stage of stages writes the INFO keys of stage, so
+that its entries can be told apart from theirs
+"""
+def separable(stage, stages):
+    others = set([key for other in stages if other is not stage
+        for key in other.infoKeys])
+    return (len(stage.infoKeys) > 0) and \
+        (len(set(stage.infoKeys) & others) == 0)
+
+
+"""Index in stages of the stage that wrote each ;-separated INFO entry,
+or None for entries of the input. Entries without a key (a second
+cytoband, say) go with the entry before them
+"""
+def entry_owners(entries, owners):
+    found = []
+    owner = None
+    for entry in entries:
+        key = entry.split('=', 1)[0].strip()
+        if key in owners:
+            owner = owners[key]
+        elif ('=' in entry):
+            owner = None
+        found.append(owner)
+    return found
+
+
+"""Splits the INFO of an annotated record, given the INFO of the input
+record it was annotated from, into the entries written before stage
+number s of the run, the entries of the stage itself and those written
+after it. Stages only ever add to INFO, in stage order, so every entry
+after the input's belongs to a stage, whatever keys the input's own
+entries have. Returns None when the entries cannot be told apart that
+way: the annotated INFO does not start with the input's entries, what
+follows them is not entries of the stages in stage order, or an empty
+entry could be the stage's or the next one's. An INFO of . is replaced
+by dbSNP or dropped by BigRefGene, so it need not be there
+"""
+def split_info(info, original, s, owners):
+    entries = info.split(';')
+    if (original == '.'):
+        count = 1 if (entries[0] == '.') else 0
+    else:
+        count = len(original.split(';'))
+        if (entries[:count] != original.split(';')):
+            return None
+
+    added = entries[count:]
+    found = entry_owners(added, owners)
+    if None in found:
+        return None
+    sides = [(owner > s) - (owner < s) for owner in found]
+    if (sides != sorted(sides)):
+        return None
+    before = entries[:count] + [entry for entry, side in
+        zip(added, sides) if (side < 0)]
+    own = [entry for entry, side in zip(added, sides) if (side == 0)]
+    after = [entry for entry, side in zip(added, sides) if (side > 0)]
+    # An empty entry after the stage's may be a later stage's (Genes
+    # writes a lone ; for transcripts without a region)
+    if own and (own[-1] == ''):
+        return None
+    return before, own, after
+
+
+"""Annotates a chunk of annotated lines again with the stages numbered
+in numbers (in run order) of stages, the full list of stages of the
+run, and returns the new lines. inputs holds the input line each line
+was annotated from.
+
+Each record is stripped of the stage's entries and of its padding (see
+vcf_record.pad), the stage is run over what the earlier stages wrote,
+and the entries of the later stages and the padding are put back. That
+gives what a full run would write as long as the stage's INFO is
+joined to its neighbours the same way as before, so records that
+cannot be split (see split_info), that gain or lose the stage's
+entries, or whose INFO ends with an empty entry once the stage has
+run, are annotated again from their input line with every stage
+instead. Each stage's counters count every record once
+"""
+def reannotate_chunk(cursor, stages, numbers, lines, inputs, sep='\t',
+    bulk=False):
+    owners = key_owners(stages)
+    lines = list(lines)
+    rebuilt = [False] * len(lines)
+    # Counter increments of the records annotated so far, which are
+    # taken back when a record is annotated again with every stage
+    deltas = [[] for line in lines]
+
+    for s in numbers:
+        stage = stages[s]
+        last = (s == len(stages) - 1)
+        found = []
+        for i, (line, original) in enumerate(zip(lines, inputs)):
+            if rebuilt[i]:
+                continue
+            source = VcfRecord(original, sep)
+            columns = line.split(sep, 2)
+            padded = (len(columns) > 1) and (len(source) > 1) and \
+                (columns[1] == ' ' + source[1])
+            if padded:
+                line = line.replace(sep + ' ', sep)
+            record = VcfRecord(line, sep)
+            parts = None
+            if record.info and source.info:
+                parts = split_info(record[INFO], source[INFO], s, owners)
+            if parts is None:
+                rebuilt[i] = True
+                continue
+            record[INFO] = ';'.join(parts[0]) or '.'
+            found.append((i, record, padded, parts))
+
+        keys = [stage.key(record) for (i, record, padded, parts) in found]
+        results = pipeline.resolve(cursor, stage, keys, bulk=bulk)
+        for (i, record, padded, parts), key, rows in \
+            zip(found, keys, results):
+            before, own, after = parts
+            if ((key is not None) and (len(rows) > 0)) != (len(own) > 0):
+                rebuilt[i] = True
+                continue
+            counts = dict(stage.counts)
+            if key is not None:
+                stage.annotate(record, rows)
+                # The run that wrote the lines dropped trailing
+                # whitespace after every stage but the last
+                if not last:
+                    pipeline.restrip(record)
+            if after:
+                info = record[INFO]
+                if info.endswith(';'):
+                    stage.counts.update(counts)
+                    rebuilt[i] = True
+                    continue
+                # The placeholder of an empty INFO goes once there is
+                # more, as BigRefGene drops it
+                if (len(before) == 0) and (info.strip() == '.'):
+                    info = info.replace('.', '', 1)
+                record[INFO] = info + (';' if info.strip() else '') + \
+                    ';'.join(after)
+            if padded and not stage.padsRecord:
+                record.pad()
+            deltas[i].append((stage, [(name, count - counts.get(name, 0))
+                for name, count in stage.counts.items()]))
+            lines[i] = record.serialize()
+
+    redo = [i for i in range(len(lines)) if rebuilt[i]]
+    if redo:
+        for i in redo:
+            for stage, changes in deltas[i]:
+                for name, change in changes:
+                    stage.counts[name] = stage.counts[name] - change
+        records = [VcfRecord(inputs[i], sep) for i in redo]
+        pipeline.annotate_chunk(cursor, stages, records, bulk=bulk)
+        for i, record in zip(redo, records):
+            lines[i] = record.serialize()
+    return lines
+
+
+"""Data lines of the VCF at path, stripped as a run reads them
+"""
+def data_lines(path):
+    fh = bgzf.open_text(path)
+    try:
+        for line in fh:
+            line = line.strip()
+            if not line.startswith('#'):
+                yield line
+    finally:
+        fh.close()
+
+
+"""Annotates the annotated VCF infile again with the stages in changed,
+which are taken from stages, the full list of stages of the run that
+wrote infile, and writes the result to outfile. original is the input
+the run annotated. Only the entries of the changed stages are looked up
+again, except on the records that are annotated again with every stage
+(see reannotate_chunk); the source headers of the changed stages are
+brought up to date. The stages' counters cover every record of the
+file. The changed stages must be separable (see separable())
+"""
+def reannotate_file(infile, outfile, stages, changed, original, sep='\t',
+    bulk=False, chunksize=10000, snapshot=None, bins=False,
+    compress=False):
+    for stage in changed:
+        if not separable(stage, stages):
+            raise ValueError(f"The annotation of {stage.label} cannot " + \
+                "be told apart from that of the other stages; " + \
+                "annotate the input again instead")
+    pipeline.attach(stages, snapshot=snapshot, bins=bins)
+    numbers = [stages.index(stage) for stage in changed]
+    names = dict([(stage.name, stage) for stage in changed])
+
+    fh = bgzf.open_text(infile)
+    inputs = data_lines(original)
+    fh_out = bgzf.open_output(outfile, compress)
+    conn = None
+    cursor = None
+    if snapshot is None:
+        conn = u.db_connect()
+        cursor = conn.cursor()
+    chunk = []
+    originals = []
+
+    def flush():
+        lines = reannotate_chunk(cursor, stages, numbers, chunk, originals,
+            sep=sep, bulk=bulk)
+        for line in lines:
+            fh_out.write(line + '\n')
+        del chunk[:]
+        del originals[:]
+
+    written = set()
+    for line in fh:
+        line = line.strip()
+        if line.startswith('#'):
+            flush()
+            source = pipeline.parse_source(line)
+            if (source is not None) and (source[0] in names):
+                line = pipeline.source_headers([names[source[0]]])[0]
+                written.add(source[0])
+            elif line.startswith('#CHROM'):
+                for header in pipeline.source_headers([stage for stage
+                    in changed if stage.name not in written]):
+                    fh_out.write(header + '\n')
+            fh_out.write(line + '\n')
+            continue
+
+        source = next(inputs, None)
+        if (source is None) or \
+            (source.split(sep, 1)[0] != line.split(sep, 1)[0]):
+            raise ValueError(f"{infile} was not annotated from {original}")
+        chunk.append(line)
+        originals.append(source)
+        if (len(chunk) >= chunksize):
+            flush()
+    flush()
+
+    if conn is not None:
+        conn.close()
+    inputs.close()
+    fh.close()
+    fh_out.close()
+
+### EOF
@@ -10,9 +10,12 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import time
+import threading
 import boto3
 #import boto
 import driver
+import columnar
+import checkpoint as ck
 from datetime import datetime
 import subprocess
 from botocore.exceptions import ClientError
@@ -41,149 +44,338 @@ class Timer(object):
     if self.verbose:
       print(f"Approximate runtime: {self.secs:.2f} seconds")
 
-if __name__ == '__main__':
+"""The SQS message of the job being run, whose receipt handle the
+annotator passes in JOB_RECEIPT_HANDLE. While the job runs the message
+is kept hidden from other annotators; it is deleted once the job has
+completed. If this process dies, the message becomes visible again and
+the job is delivered to another annotator, which resumes it from its
+checkpoint (up to MaxJobAttempts deliveries; see annotator.py)
+"""
+class JobMessage(object):
+  def __init__(self, receipt_handle):
+    self.receipt_handle = receipt_handle
+    self.queue_url = config['aws']['QueueURL']
+    self.timeout = config.getint('aws', 'QueueVisibilitySeconds',
+      fallback=600)
+    self.stopped = threading.Event()
+    self.sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
 
-  if len(sys.argv) > 1:
-    
-    with Timer():
-      driver.run(sys.argv[1], 'vcf')
+  # Extends the visibility of the message now and every half timeout
+  def start(self):
+    if self.receipt_handle:
+      self.extend()
+      threading.Thread(target=self.keep_hidden, daemon=True).start()
 
-    s3 = boto3.resource('s3')
-    BUCKET = config['aws']['ResultsBucket']
+  def keep_hidden(self):
+    while not self.stopped.wait(self.timeout / 2):
+      self.extend()
 
+  def extend(self):
     try:
-      prec_file = sys.argv[1].split('~')[0]
-      act_file = sys.argv[1].split('~')[1]
-      act_file2 = act_file.split('.')[0]
-      annot_file = prec_file+"~"+act_file2 +".annot.vcf"
-      annot_filename = act_file2+".annot.vcf"
-      log_file = prec_file+"~"+act_file2+".vcf.count.log"
-      log_filename = act_file2+".vcf.count.log"
-    except:
-      print("The given argument did not have the file name.")
-      raise
+      self.sqs.change_message_visibility(QueueUrl=self.queue_url,
+        ReceiptHandle=self.receipt_handle, VisibilityTimeout=self.timeout)
+    except ClientError as e:
+      print(e.response)
 
-    #Update job status, completion time, the results bucket, results files to DynamoDB 
-    dynamodb = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
-    ann_table = dynamodb.Table(config['aws']['DynamoTable']) 
+  # Stops keeping the message hidden; it is delivered again once its
+  # visibility timeout runs out
+  def release(self):
+    self.stopped.set()
 
-    #Source - https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.Python.04.html
+  def delete(self):
+    self.stopped.set()
+    if self.receipt_handle:
+      self.sqs.delete_message(QueueUrl=self.queue_url,
+        ReceiptHandle=self.receipt_handle)
+
+"""Annotates the results of a completed job again after reference
+tables have been reloaded: the annotated file and its log are taken
+from the results bucket and the job's input from the inputs bucket,
+the stages whose tables changed (or the stages named, comma-separated)
+are annotated again (see driver.reannotate) and both files are put
+back in their place
+"""
+def reannotate_job(job_id, stages=None):
+  dynamodb = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+  ann_table = dynamodb.Table(config['aws']['DynamoTable'])
+  try:
+    response = ann_table.query(
+      KeyConditionExpression=Key('job_id').eq(job_id)
+    )
+  except ClientError as e:
+    print(e.response)
+    raise
+
+  for i in response['Items']:
+    results_key = i['s3_key_results_file']
+    log_key = i['s3_key_log_file']
+    bucket_name = i.get('s3_results_bucket', config['aws']['ResultsBucket'])
+    input_key = i['s3_key_input_file']
+    inputs_bucket = i.get('s3_inputs_bucket', config['aws']['BucketName'])
+
+  #Download the annotated file, the log and the input next to this script
+  s3 = boto3.resource('s3')
+  annot_file = os.path.basename(results_key)
+  log_file = os.path.basename(log_key)
+  input_file = os.path.basename(input_key)
+  try:
+    s3.Bucket(bucket_name).download_file(results_key, annot_file)
+    s3.Bucket(bucket_name).download_file(log_key, log_file)
+    s3.Bucket(inputs_bucket).download_file(input_key, input_file)
+  except ClientError as e:
+    print(e.response)
+    raise
+
+  with Timer():
+    changed = driver.reannotate(annot_file, 'vcf', names=stages,
+      infile=input_file)
+
+  try:
+    if changed:
+      extra_args = {'ContentType': 'application/gzip'} \
+        if annot_file.endswith('.gz') else None
+      s3.Bucket(bucket_name).upload_file(annot_file, results_key,
+        ExtraArgs=extra_args)
+      s3.Bucket(bucket_name).upload_file(log_file, log_key)
+      parquet_file = columnar.path_for(annot_file)
+      if os.path.exists(parquet_file):
+        s3.Bucket(bucket_name).upload_file(parquet_file,
+          columnar.path_for(results_key))
+  except ClientError as e:
+    print(e.response)
+    raise
+
+  try:
+    os.remove(annot_file)
+    os.remove(log_file)
+    os.remove(input_file)
+    if os.path.exists(columnar.path_for(annot_file)):
+      os.remove(columnar.path_for(annot_file))
+  except OSError:
+    print("No such files in the system")
+    raise
+
+  if changed:
     try:
-      response = ann_table.query(
-        KeyConditionExpression=Key('job_id').eq(prec_file)
+      ann_table.update_item(
+          Key = {'job_id': job_id},
+          UpdateExpression = 'set reannotate_time = :rt, reannotated_stages = :rs',
+          ExpressionAttributeValues = {
+              ':rt' : int(time.time()),
+              ':rs' : changed,
+          },
+          ReturnValues = "UPDATED_NEW"
       )
     except ClientError as e:
       print(e.response)
       raise
 
+"""Marks a job FAILED in DynamoDB, unless it has completed already
+"""
+def fail_job(job_id):
+  dynamodb = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+  ann_table = dynamodb.Table(config['aws']['DynamoTable'])
+  try:
+    ann_table.update_item(
+        Key = {'job_id': job_id},
+        UpdateExpression = 'set job_status = :f',
+        ConditionExpression = 'job_status <> :c',
+        ExpressionAttributeValues = {
+            ':f' : "FAILED",
+            ':c' : "COMPLETED",
+        },
+        ReturnValues = "UPDATED_NEW"
+    )
+  except ClientError as e:
+    print(e.response)
 
-    for i in response['Items']:
-      user_id = i['user_id'] 
+"""Annotates the input file of a job, puts the annotated file and its
+log in the results bucket, marks the job COMPLETED and announces it on
+the results topic
+"""
+def annotate_job(infile, profile=None):
+  with Timer():
+    annot_file = driver.run(infile, 'vcf', profile=profile)
 
-    #After completing the annotation job, upload the log and annotation file to the gas-results s3 bucket
-    try:
-      key = config['aws']['Key'] + "/" + user_id + "/"
-      s3.Bucket(BUCKET).upload_file(annot_file,key+annot_file)
-      s3.Bucket(BUCKET).upload_file(log_file,key+log_file)
-    except ClientError as e:
-      print(e.response)
-      raise
+  s3 = boto3.resource('s3')
+  BUCKET = config['aws']['ResultsBucket']
 
-    #Remove all the corresponding files in the local folder
-    try:
-      annotation_path = "/home/ubuntu/ann/"+ annot_file
-      log_path = "/home/ubuntu/ann/"+ log_file
-      sys_path = "/home/ubuntu/ann/" + sys.argv[1]
-      os.remove(annot_file)
-      os.remove(log_file)
-      os.remove(sys.argv[1])
-    except OSError:
+  try:
+    prec_file = infile.split('~')[0]
+    act_file = infile.split('~')[1]
+    log_file = driver.log_path(infile)
+  except:
+    print("The given argument did not have the file name.")
+    raise
+
+  #Update job status, completion time, the results bucket, results files to DynamoDB 
+  dynamodb = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+  ann_table = dynamodb.Table(config['aws']['DynamoTable']) 
+
+  #Source - https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.Python.04.html
+  try:
+    response = ann_table.query(
+      KeyConditionExpression=Key('job_id').eq(prec_file)
+    )
+  except ClientError as e:
+    print(e.response)
+    raise
+
+
+  for i in response['Items']:
+    user_id = i['user_id'] 
+
+  #After completing the annotation job, upload the log and annotation file to the gas-results s3 bucket
+  try:
+    key = config['aws']['Key'] + "/" + user_id + "/"
+    # Compressed results are stored as they are, as gzip files
+    extra_args = {'ContentType': 'application/gzip'} \
+      if annot_file.endswith('.gz') else None
+    s3.Bucket(BUCKET).upload_file(annot_file,key+annot_file,
+      ExtraArgs=extra_args)
+    s3.Bucket(BUCKET).upload_file(log_file,key+log_file)
+    # Parquet sidecar of the annotations, if the driver wrote one
+    parquet_file = columnar.path_for(annot_file)
+    if os.path.exists(parquet_file):
+      s3.Bucket(BUCKET).upload_file(parquet_file,key+parquet_file)
+  except ClientError as e:
+    print(e.response)
+    raise
+
+  #Remove all the corresponding files in the local folder
+  try:
+    annotation_path = "/home/ubuntu/ann/"+ annot_file
+    log_path = "/home/ubuntu/ann/"+ log_file
+    sys_path = "/home/ubuntu/ann/" + infile
+    os.remove(annot_file)
+    os.remove(log_file)
+    os.remove(infile)
+    if os.path.exists(parquet_file):
+      os.remove(parquet_file)
+  except OSError:
+    print("No such files in the system")
+    raise
+    
+  
+  #Get completion time for the job
+  t = time.localtime()
+  now = datetime.now()
+  dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
+  pattern = '%d/%m/%Y %H:%M:%S'
+  #Source - https://stackoverflow.com/questions/7241170/how-to-convert-current-date-to-epoch-timestamp
+  epoch = int(time.mktime(time.strptime(dt_string, pattern)))
+
+
+  #Source - https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.Python.04.html
+  try:
+    response = ann_table.query(
+      KeyConditionExpression=Key('job_id').eq(prec_file)
+    )
+  except ClientError as e:
+    print(e.response)
+    raise
+
+  for i in response['Items']:
+    user_id = i['user_id'] 
+
+  #Set the relevant parameters in DynamoDB after job completion
+  try:
+    #source - https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.Python.03.html
+    ann_table.update_item(
+        Key = {'job_id': prec_file},
+        UpdateExpression = 'set job_status = :j, s3_results_bucket = :rb, s3_key_results_file = :rf, s3_key_log_file = :lf, complete_time = :ct',
+        ExpressionAttributeValues = {
+            ':j' : "COMPLETED",
+            ':rb' : config['aws']['ResultsBucket'],
+            ':rf' : config['aws']['Key'] + "/" + user_id+"/"+annot_file,
+            ':lf' : config['aws']['Key'] + "/" + user_id+"/"+log_file,
+            ':ct' : epoch,
+        },
+        ReturnValues = "UPDATED_NEW"
+
+    )
+  except ClientError as e:
+      #source - https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.Python.03.html
+      if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+          print(e.response['Error']['Message'])
+      else:
+          raise
+  
+  #Open file to get email
+  try:
+    f2 = open(prec_file, "r")
+    email = f2.read()
+  except OSError:
+    print("No such files in the system")
+    raise
+
+  #Remove the email file from the system
+  #Source - https://www.geeksforgeeks.org/python-os-remove-method/#:~:text=os.,be%20raised%20by%20the%20method.
+  try:
+      os.remove(prec_file)
+  except OSError:
       print("No such files in the system")
       raise
-      
-    
-    #Get completion time for the job
-    t = time.localtime()
-    now = datetime.now()
-    dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
-    pattern = '%d/%m/%Y %H:%M:%S'
-    #Source - https://stackoverflow.com/questions/7241170/how-to-convert-current-date-to-epoch-timestamp
-    epoch = int(time.mktime(time.strptime(dt_string, pattern)))
 
+  data = { 'job_id': prec_file, 'user_id': user_id, 
+  # "s3_input_bucket": config['aws']['InputsBucket'],   
+  "s3_results_bucket": config['aws']['ResultsBucket'], 
+  "s3_key_results_file" : config['aws']['Key'] + "/" + user_id+"/"+annot_file,
+  "s3_key_log_file" : config['aws']['Key'] + "/" + user_id+"/"+log_file,
+  "complete_time": epoch,
+  "email": email,
+  "job_status": "COMPLETED"
+  }
+  #Send a notification to results arn (notify.py), so a confirmation email can be sent
+  sns = boto3.client('sns', region_name = config['aws']['AwsRegionName'])
+  try:
+      response  = sns.publish(
 
-    #Source - https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.Python.04.html
-    try:
-      response = ann_table.query(
-        KeyConditionExpression=Key('job_id').eq(prec_file)
+          TopicArn = config['aws']['ResultsArn'],
+          #Source - https://stackoverflow.com/questions/34029251/aws-publish-sns-message-for-lambda-function-via-boto3-python2
+          Message = json.dumps({'default': json.dumps(data)}),
+          MessageStructure='json',
       )
-    except ClientError as e:
+  except (ClientError, ParamValidationError) as e:
       print(e.response)
       raise
 
-    for i in response['Items']:
-      user_id = i['user_id'] 
+if __name__ == '__main__':
 
-    #Set the relevant parameters in DynamoDB after job completion
-    try:
-      #source - https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.Python.03.html
-      ann_table.update_item(
-          Key = {'job_id': prec_file},
-          UpdateExpression = 'set job_status = :j, s3_results_bucket = :rb, s3_key_results_file = :rf, s3_key_log_file = :lf, complete_time = :ct',
-          ExpressionAttributeValues = {
-              ':j' : "COMPLETED",
-              ':rb' : config['aws']['ResultsBucket'],
-              ':rf' : config['aws']['Key'] + "/" + user_id+"/"+annot_file,
-              ':lf' : config['aws']['Key'] + "/" + user_id+"/"+log_file,
-              ':ct' : epoch,
-          },
-          ReturnValues = "UPDATED_NEW"
+  # python run.py --reannotate <job_id> [stage,...]
+  if (len(sys.argv) > 2) and (sys.argv[1] == '--reannotate'):
+    reannotate_job(sys.argv[2], sys.argv[3] if (len(sys.argv) > 3) else None)
 
-      )
-    except ClientError as e:
-        #source - https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.Python.03.html
-        if e.response['Error']['Code'] == "ConditionalCheckFailedException":
-            print(e.response['Error']['Message'])
-        else:
-            raise
+  elif len(sys.argv) > 1:
     
-    #Open file to get email
+    # Inputs may be .vcf or gzip/BGZF .vcf.gz; the annotated file is named
+    # by the driver (.annot.vcf, or .annot.vcf.gz when compressed). The
+    # job's annotation profile, if any, follows the file name
+    profile = sys.argv[2] if (len(sys.argv) > 2) else None
+    message = JobMessage(os.environ.get('JOB_RECEIPT_HANDLE'))
+    message.start()
     try:
-      f2 = open(prec_file, "r")
-      email = f2.read()
-    except OSError:
-      print("No such files in the system")
+      annotate_job(sys.argv[1], profile)
+    except ck.Locked:
+      # Another run of the same job is still writing its output. This
+      # run neither fails the job nor deletes its message: the message
+      # comes back after its visibility timeout, and by then the other
+      # run has completed the job or died and left its checkpoint
+      message.release()
+      raise
+    except Exception:
+      # A job that fails is not run again: it is marked FAILED and its
+      # request is removed from the queue
+      fail_job(sys.argv[1].split('~')[0])
+      message.delete()
       raise
 
-    #Remove the email file from the system
-    #Source - https://www.geeksforgeeks.org/python-os-remove-method/#:~:text=os.,be%20raised%20by%20the%20method.
-    try:
-        os.remove(prec_file)
-    except OSError:
-        print("No such files in the system")
-        raise
-
-    data = { 'job_id': prec_file, 'user_id': user_id, 
-    # "s3_input_bucket": config['aws']['InputsBucket'],   
-    "s3_results_bucket": config['aws']['ResultsBucket'], 
-    "s3_key_results_file" : config['aws']['Key'] + "/" + user_id+"/"+annot_file,
-    "s3_key_log_file" : config['aws']['Key'] + "/" + user_id+"/"+log_file,
-    "complete_time": epoch,
-    "email": email,
-    "job_status": "COMPLETED"
-    }
-    #Send a notification to results arn (notify.py), so a confirmation email can be sent
-    sns = boto3.client('sns', region_name = config['aws']['AwsRegionName'])
+    #The job is done; remove its request from the queue
     try:
-        response  = sns.publish(
-
-            TopicArn = config['aws']['ResultsArn'],
-            #Source - https://stackoverflow.com/questions/34029251/aws-publish-sns-message-for-lambda-function-via-boto3-python2
-            Message = json.dumps({'default': json.dumps(data)}),
-            MessageStructure='json',
-        )
-    except (ClientError, ParamValidationError) as e:
-        print(e.response)
-        raise
+      message.delete()
+    except ClientError as e:
+      print(e.response)
+      raise
 
   else:
     print("A valid .vcf file must be provided as input to this program.")
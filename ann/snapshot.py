@@ -0,0 +1,448 @@
+# snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Memory-mapped, per-chromosome columnar snapshot of the reference
+# tables, so annotators can run without the reference database
+#
+# Build a snapshot with:
+#   python snapshot.py <snapshot_dir> [table ...]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import mmap
+import time
+import shutil
+import bisect
+import threading
+from array import array
+from collections import OrderedDict
+
+import utils as u
+import queries
+import interval_index
+
+np = interval_index.np
+
+FORMAT = 3
+
+"""Tables the stages in annotate.py read, as
+name: (chrom column, start column, end column, columns)
+Rows of a chromosome are stored in order of the start column, with
+their position in the table alongside. Tables looked up by equality use the compared column as both start and end.
+The tfbsConsSites tables hold a single chromosome each, so they have
+no chrom column
+"""
+TABLES = {
+    'dbSNP': ('CHR', 'POS', 'POS', '*'),
+    'chrom_pos_equal_base': ('CHR', 'start', 'start', '*'),
+    'chrom_pos_equal_nobase': ('CHR', 'start', 'start', '*'),
+    'chrom_pos_unequal': ('CHR', 'start', 'end', '*'),
+    'refGene': ('chrom', 'txStart', 'txEnd', '*'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd',
+        'chrom, chromStart, chromEnd, name'),
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd', '*'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd', '*'),
+    'gwasCatalog': ('chrom', 'chromEnd', 'chromEnd', '*'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd', '*'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd', '*'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd', '*'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd', '*'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd', '*'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd', '*'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd', '*'),
+}
+for c in ['1','2','3','4','5','6','7','8','9','10','11','12','13','14',
+    '15','16','17','18','19','20','21','22','X','Y']:
+    TABLES['tfbsConsSites' + c] = (None, 'chromStart', 'chromEnd',
+        'chrom, chromStart, chromEnd, name')
+
+# Chromosome name used for tables without a chrom column
+WHOLE_TABLE = '_'
+
+# Chromosomes are stored and looked up by their name as MySQL compares
+# it, so lowercase contigs find the rows the queries found
+chrom_key = interval_index.chrom_key
+
+
+"""Storage type of a column of one chromosome: i8 and f8 are native
+64-bit arrays, str and bytes are an offsets array plus the data. Columns
+that mix types (or hold DECIMAL, DATETIME, ...) are stored as the str()
+of each value, which is all the stages use them for
+"""
+def columnType(values):
+    kinds = set([type(v) for v in values if v is not None])
+    if (len(kinds) == 1):
+        kind = kinds.pop()
+        if (kind is int) and (None not in values):
+            return 'i8'
+        if (kind is float) and (None not in values):
+            return 'f8'
+        if (kind is bytes):
+            return 'bytes'
+    return 'str'
+
+
+def writeColumn(path, kind, values):
+    if (kind == 'i8') or (kind == 'f8'):
+        with open(path + '.' + kind, 'wb') as fh:
+            array('q' if (kind == 'i8') else 'd', values).tofile(fh)
+        return
+
+    offsets = array('q', [0])
+    with open(path + '.dat', 'wb') as fh:
+        for v in values:
+            if v is None:
+                v = b''
+            elif (kind == 'str'):
+                v = str(v).encode('utf-8')
+            fh.write(v)
+            offsets.append(offsets[-1] + len(v))
+    with open(path + '.off', 'wb') as fh:
+        offsets.tofile(fh)
+    if None in values:
+        with open(path + '.null', 'wb') as fh:
+            array('b', [v is None for v in values]).tofile(fh)
+
+
+"""Writes the rows of one chromosome of a table, sorted by start, and
+returns its schema entry. rows are in the table order of
+interval_index.chromosome_statement(); that order is kept in .row.i8,
+so lookups return a position's rows in the order the per-variant query
+returns them
+"""
+def writeChromosome(path, columns, rows, startColumn, endColumn):
+    s = columns.index(startColumn)
+    e = columns.index(endColumn)
+    order = sorted(range(len(rows)), key=lambda i: (int(rows[i][s]), i))
+    rows = [rows[i] for i in order]
+    os.makedirs(path)
+
+    types = []
+    for i, name in enumerate(columns):
+        values = [row[i] for row in rows]
+        if (i == s) or (i == e):
+            values = [int(v) for v in values]
+        kind = columnType(values)
+        writeColumn(os.path.join(path, name), kind, values)
+        types.append(kind)
+
+    maxEnds = array('q')
+    maxEnd = None
+    for row in rows:
+        end = int(row[e])
+        maxEnd = end if (maxEnd is None or end > maxEnd) else maxEnd
+        maxEnds.append(maxEnd)
+    with open(os.path.join(path, '.maxEnd.i8'), 'wb') as fh:
+        maxEnds.tofile(fh)
+    with open(os.path.join(path, '.row.i8'), 'wb') as fh:
+        array('q', order).tofile(fh)
+    return {'rows': len(rows), 'types': types}
+
+
+"""Exports one table into dirname/table/<chrom>/ and returns its schema
+entry. Each chromosome is read with its own query, which matches its
+name as MySQL compares it, and is stored under its chrom_key()
+"""
+def exportTable(cursor, dirname, table):
+    chromColumn, startColumn, endColumn, columns = TABLES[table]
+    if chromColumn is None:
+        chroms = [WHOLE_TABLE]
+    else:
+        cursor.execute('select distinct ' + chromColumn + ' from ' + \
+            table + ';')
+        names = {}
+        for row in cursor.fetchall():
+            names.setdefault(chrom_key(row[0]), str(row[0]))
+        chroms = [names[key] for key in sorted(names)]
+
+    entry = {'chromColumn': chromColumn, 'startColumn': startColumn,
+        'endColumn': endColumn, 'columns': None, 'chroms': {}}
+    statement = interval_index.chromosome_statement(table, chromColumn,
+        columns)
+    for chrom in chroms:
+        queries.execute(cursor, statement,
+            () if (chromColumn is None) else (chrom,))
+        names = [d[0] for d in cursor.description]
+        entry['columns'] = names
+        key = chrom if (chromColumn is None) else chrom_key(chrom)
+        entry['chroms'][key] = writeChromosome(
+            os.path.join(dirname, table, key), names, cursor.fetchall(),
+            startColumn, endColumn)
+        print(f"{table} {key}: {entry['chroms'][key]['rows']} rows")
+    return entry
+
+
+"""Builds a snapshot of the given tables (all of TABLES by default)
+into dirname. The snapshot is written next to dirname and moved into
+place once complete, so annotators never open a partial snapshot
+"""
+def build(dirname, tables=None, conn=None):
+    if conn is None:
+        conn = u.db_connect()
+    cursor = conn.cursor()
+    tables = tables if tables else list(TABLES.keys())
+
+    dirname = os.path.abspath(dirname)
+    tmpdir = dirname + '.tmp'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    schema = {'format': FORMAT, 'byteorder': sys.byteorder,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'tables': {}}
+    for table in tables:
+        schema['tables'][table] = exportTable(cursor, tmpdir, table)
+    conn.close()
+
+    with open(os.path.join(tmpdir, 'schema.json'), 'w') as fh:
+        json.dump(schema, fh, indent=2)
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmpdir, dirname)
+    return schema
+
+
+def mapFile(path, typecode):
+    with open(path, 'rb') as fh:
+        if (os.fstat(fh.fileno()).st_size == 0):
+            return memoryview(b'').cast(typecode)
+        m = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(m).cast(typecode)
+
+
+"""Least recently used set of the rows assembled from a snapshot's
+column files, keyed by (table, chrom, row), with the same memory budget
+rules as interval_index.IntervalIndexCache. Rows are evicted one at a
+time once the cache goes over budget bytes; an evicted row is
+assembled again from the mapped columns when it is next returned
+"""
+class RowCache(object):
+    def __init__(self, budget=256 * 1024 * 1024):
+        self.budget = budget
+        self.rows = OrderedDict()
+        self.used = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.rows.get(key)
+            if entry is None:
+                return None
+            self.rows.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, row):
+        size = sys.getsizeof(key) + sys.getsizeof(row) + \
+            sum([sys.getsizeof(v) for v in row])
+        with self.lock:
+            if key in self.rows:
+                return
+            self.rows[key] = (row, size)
+            self.used = self.used + size
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            while (self.used > self.budget and len(self.rows) > 1):
+                key, (row, size) = self.rows.popitem(last=False)
+                self.used = self.used - size
+                self.evictions = self.evictions + 1
+
+
+"""One chromosome of one table, mapped from disk
+starts, ends, maxEnds and ids are int64 views as in
+interval_index.IntervalIndex; rows are assembled from the column files
+the first time they are returned and kept in cache, a RowCache shared
+by the chromosomes of the snapshot, under name, the (table, chrom) of
+the chromosome
+"""
+class SnapshotChromosome(object):
+    def __init__(self, path, columns, types, startColumn, endColumn,
+        cache=None, name=None):
+        self.readers = []
+        self.cache = cache if (cache is not None) else RowCache()
+        self.name = name
+        mapped = {}
+        for name, kind in zip(columns, types):
+            base = os.path.join(path, name)
+            if (kind == 'i8') or (kind == 'f8'):
+                values = mapFile(base + '.' + kind,
+                    'q' if (kind == 'i8') else 'd')
+                self.readers.append(values.__getitem__)
+                mapped[name] = values
+                continue
+
+            offsets = mapFile(base + '.off', 'q')
+            data = mapFile(base + '.dat', 'B')
+            nulls = None
+            if os.path.exists(base + '.null'):
+                nulls = mapFile(base + '.null', 'b')
+            self.readers.append(self.blobReader(offsets, data, nulls,
+                kind == 'str'))
+
+        self.starts = mapped[startColumn]
+        self.ends = mapped[endColumn]
+        self.maxEnds = mapFile(os.path.join(path, '.maxEnd.i8'), 'q')
+        self.ids = mapFile(os.path.join(path, '.row.i8'), 'q')
+
+    # Reads value i of a str or bytes column
+    def blobReader(self, offsets, data, nulls, text):
+        def read(i):
+            if (nulls is not None) and nulls[i]:
+                return None
+            v = data[offsets[i]:offsets[i + 1]].tobytes()
+            return v.decode('utf-8') if text else v
+        return read
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Row i, assembled once while it stays in the cache; regions such as
+    # large CNVs overlap many variants
+    def row(self, i):
+        key = (self.name, i)
+        row = self.cache.get(key)
+        if row is None:
+            row = tuple([read(i) for read in self.readers])
+            self.cache.put(key, row)
+        return row
+
+    # Rows whose [start, end] overlaps [lo, hi], in the table order
+    # kept in .row.i8
+    def span(self, lo, hi):
+        end = bisect.bisect_right(self.starts, hi)
+        begin = bisect.bisect_left(self.maxEnds, lo, 0, end)
+        ends = self.ends
+        hits = [i for i in range(begin, end) if ends[i] >= lo]
+        hits.sort(key=self.ids.__getitem__)
+        return [self.row(i) for i in hits]
+
+    # Rows overlapping each position of a batch, as a list of lists
+    def span_batch(self, positions):
+        if (np is None) or (len(self) == 0):
+            return [self.span(pos, pos) for pos in positions]
+
+        hits = [[] for pos in positions]
+        variants, intervals = interval_index.overlap_hits(
+            np.frombuffer(self.starts, dtype=np.int64),
+            np.frombuffer(self.ends, dtype=np.int64),
+            np.frombuffer(self.maxEnds, dtype=np.int64),
+            np.asarray(positions, dtype=np.int64))
+        variants, intervals = interval_index.in_table_order(variants,
+            intervals, np.frombuffer(self.ids, dtype=np.int64))
+        for v, i in zip(variants.tolist(), intervals.tolist()):
+            hits[v].append(self.row(i))
+        return hits
+
+
+"""Read-only reference snapshot built by build()
+overlapping() and overlapping_batch() have the signatures of
+interval_index.IntervalIndexCache, so the engine can hand a snapshot to
+the range stages in place of an index. Chromosomes are mapped on first
+use and stay mapped; the page cache is shared by every process that
+opens the same snapshot. The rows assembled from them are kept in a
+RowCache of rows_budget bytes
+"""
+class Snapshot(object):
+    def __init__(self, dirname, rows_budget=256 * 1024 * 1024):
+        self.dirname = dirname
+        self.rows = RowCache(rows_budget)
+        with open(os.path.join(dirname, 'schema.json')) as fh:
+            self.schema = json.load(fh)
+        if (self.schema['format'] != FORMAT):
+            raise ValueError(f"Unsupported snapshot format " + \
+                f"{self.schema['format']} in {dirname}")
+        if (self.schema['byteorder'] != sys.byteorder):
+            raise ValueError(f"Snapshot {dirname} was built on a " + \
+                f"{self.schema['byteorder']}-endian host")
+        self.version = self.schema['created']
+        self.chroms = {}
+
+    def table(self, table):
+        entry = self.schema['tables'].get(table)
+        if entry is None:
+            raise KeyError(f"Table {table} is not in snapshot {self.dirname}")
+        return entry
+
+    # Position of a column in the rows of a table
+    def column(self, table, name):
+        return self.table(table)['columns'].index(name)
+
+    # The mapped chromosome, or None if the table has no rows there.
+    # chrom is matched as MySQL would, whatever its case
+    def chromosome(self, table, chrom):
+        entry = self.table(table)
+        if entry['chromColumn'] is None:
+            chrom = WHOLE_TABLE
+        else:
+            chrom = chrom_key(chrom)
+        key = (table, chrom)
+        if key not in self.chroms:
+            c = entry['chroms'].get(chrom)
+            self.chroms[key] = None if c is None else SnapshotChromosome(
+                os.path.join(self.dirname, table, chrom),
+                entry['columns'], c['types'], entry['startColumn'],
+                entry['endColumn'], self.rows, key)
+        return self.chroms[key]
+
+    # Rows of table whose start..end overlaps lo..hi
+    def span(self, table, chrom, lo, hi):
+        c = self.chromosome(table, chrom)
+        return [] if c is None else c.span(int(lo), int(hi))
+
+    # Rows of an equality-keyed table (see TABLES) that match value
+    def equal(self, table, chrom, value):
+        return self.span(table, chrom, value, value)
+
+    def checkColumns(self, table, startColumn, endColumn):
+        entry = self.table(table)
+        if ((entry['startColumn'], entry['endColumn']) != \
+            (startColumn, endColumn)):
+            raise ValueError(f"Snapshot of {table} is keyed on " + \
+                f"{entry['startColumn']}..{entry['endColumn']}")
+
+    # IntervalIndexCache interface; the snapshot holds the columns the
+    # stages select, so cursor, chromColumn and columns are not used
+    def overlapping(self, cursor, table, chromColumn, chrom, pos,
+        startColumn='chromStart', endColumn='chromEnd', columns='*'):
+        self.checkColumns(table, startColumn, endColumn)
+        return self.span(table, chrom, pos, pos)
+
+    def overlapping_batch(self, cursor, table, chromColumn, chrom, positions,
+        startColumn='chromStart', endColumn='chromEnd', columns='*'):
+        self.checkColumns(table, startColumn, endColumn)
+        c = self.chromosome(table, chrom)
+        if c is None:
+            return [[] for pos in positions]
+        return c.span_batch([int(pos) for pos in positions])
+
+
+_snapshots = {}
+
+"""Process-wide Snapshot for a directory, so the stages of a job map
+each snapshot once, with rows_mb megabytes for its row cache
+"""
+def open_snapshot(dirname, rows_mb=256):
+    dirname = os.path.abspath(dirname)
+    if dirname not in _snapshots:
+        _snapshots[dirname] = Snapshot(dirname)
+    snapshot = _snapshots[dirname]
+    snapshot.rows.budget = int(rows_mb) * 1024 * 1024
+    snapshot.rows.evict()
+    return snapshot
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) < 2):
+        print("usage: python snapshot.py <snapshot_dir> [table ...]")
+        sys.exit(1)
+    build(sys.argv[1], sys.argv[2:])
+
+### EOF
@@ -0,0 +1,181 @@
+# sweep.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Merge-sweep join of coordinate-sorted variants against a reference
+# range table, streamed one chromosome at a time
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import heapq
+import bisect
+import threading
+import pymysql.cursors
+
+import utils as u
+import queries
+
+# Chromosomes streamed at the same time by the sweeps of a process, each
+# on a connection of its own
+MAX_STREAMS = 4
+
+_streams = threading.BoundedSemaphore(MAX_STREAMS)
+
+
+"""The statement that streams a chromosome for the sweep: the rows of
+statement from the first that ends at or after a position, ordered by
+start. row_number() over () numbers the rows in table order, the order
+the unordered statement reads them in, which is also the order the
+per-variant query reads a position's rows in; the sweep uses that
+number to hand back each variant's rows in the same order. The
+numbering needs MySQL 8
+"""
+def ordered_statement(statement, startColumn, endColumn):
+    sql = statement.sql.rstrip().rstrip(';')
+    return queries.register(statement.name + '.sweep',
+        'select * from (select row_number() over () as sweep_rank, t.* ' + \
+        'from (' + sql + ') as t) as r where r.' + endColumn + \
+        ' >= %s order by r.' + startColumn + ', r.sweep_rank;')
+
+
+"""Sweeps one range table alongside sorted variants
+
+regionQuery(chrom) returns the queries.Statement that selects a
+chromosome's rows and its parameters, as (statement, params);
+startColumn and endColumn name the interval columns. When the variants
+reach a chromosome its rows are streamed ordered by start (see
+ordered_statement) through an unbuffered cursor on a connection from
+utils.db_connect() that the SweepJoin holds until the stream is read,
+so several stages can sweep at the same time and no more than the
+active regions are held in memory. Regions join the active set as the
+variants reach their start and leave it, through a heap of their ends,
+once a variant passes their end; the set is kept in table order (by
+sweep_rank), so the rows overlapping a variant come back in the order
+the per-variant query returns them.
+
+The sweeps of a process stream at most MAX_STREAMS chromosomes at
+once. A SweepJoin that reaches a chromosome while none is free returns
+None for that chromosome's variants, which the caller looks up the
+usual way, and tries again at the next chromosome.
+
+The sweep checks the order of the variants as it goes. At the first
+one out of order (a position goes backwards or a chromosome comes back)
+it stops for good: overlapping() returns None from then on and the
+caller looks the variants up the usual way.
+"""
+class SweepJoin(object):
+    def __init__(self, regionQuery, startColumn='chromStart',
+        endColumn='chromEnd'):
+        self.regionQuery = regionQuery
+        self.startColumn = startColumn
+        self.endColumn = endColumn
+        self.conn = None
+        self.cursor = None
+        self.swept = False
+        self.chrom = None
+        self.pos = None
+        self.done = set()
+        self.sorted = True
+        self.pending = None
+        self.ends = []
+        self.ranks = []
+        self.rows = {}
+        self.streamed = 0
+
+    # Rows with start <= pos <= end, in table order
+    def overlapping(self, chrom, pos):
+        if not self.sorted:
+            return None
+        if (chrom != self.chrom):
+            if chrom in self.done:
+                return self.unsorted()
+            self.begin(chrom, pos)
+        elif (pos < self.pos):
+            return self.unsorted()
+        self.pos = pos
+        if not self.swept:
+            return None
+
+        while (self.pending is not None and self.pending[0] <= pos):
+            start, end, rank, row = self.pending
+            heapq.heappush(self.ends, (end, rank))
+            bisect.insort(self.ranks, rank)
+            self.rows[rank] = row
+            self.pending = self.next_region()
+        while (self.ends and self.ends[0][0] < pos):
+            end, rank = heapq.heappop(self.ends)
+            del self.ranks[bisect.bisect_left(self.ranks, rank)]
+            del self.rows[rank]
+        return [self.rows[rank] for rank in self.ranks]
+
+    # Starts streaming the regions of chrom that end at or after pos,
+    # unless MAX_STREAMS chromosomes are being streamed already
+    def begin(self, chrom, pos):
+        self.end()
+        if self.chrom is not None:
+            self.done.add(self.chrom)
+        self.chrom = chrom
+        self.ends = []
+        self.ranks = []
+        self.rows = {}
+
+        self.swept = _streams.acquire(blocking=False)
+        if not self.swept:
+            return
+        try:
+            self.conn = u.db_connect()
+        except Exception:
+            _streams.release()
+            self.swept = False
+            raise
+        self.cursor = self.conn.cursor(pymysql.cursors.SSCursor)
+        statement, params = self.regionQuery(chrom)
+        queries.execute(self.cursor, ordered_statement(statement,
+            self.startColumn, self.endColumn), tuple(params) + (pos,))
+        names = [d[0] for d in self.cursor.description]
+        self.s = names.index(self.startColumn)
+        self.e = names.index(self.endColumn)
+        self.pending = self.next_region()
+
+    # The next region of the stream as (start, end, row number, row).
+    # Once the stream is read its connection goes back to the pool
+    def next_region(self):
+        row = self.cursor.fetchone()
+        if row is None:
+            self.cursor.close()
+            self.conn.close()
+            self.release()
+            return None
+        self.streamed = self.streamed + 1
+        return (int(row[self.s]), int(row[self.e]), row[0], row[1:])
+
+    # The variants are out of order: stops sweeping
+    def unsorted(self):
+        self.sorted = False
+        self.end()
+        return None
+
+    # Leaves the rest of the stream unread. The server sends the whole of
+    # an unbuffered result whether it is read or not, and closing the
+    # cursor would read it to the end, so the connection is discarded
+    # instead of going back to the pool, and the cursor let go of it
+    # first
+    def end(self):
+        if self.conn is not None:
+            self.cursor.connection = None
+            self.conn.discard()
+            self.release()
+        self.pending = None
+
+    # Gives up the connection and the stream slot of the chromosome
+    def release(self):
+        self.conn = None
+        self.cursor = None
+        _streams.release()
+
+    def close(self):
+        self.end()
+
+### EOF
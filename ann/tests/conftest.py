@@ -0,0 +1,17 @@
+# conftest.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# The annotator modules import each other by bare name, as when run from
+# the ann directory, so the tests put that directory on the path
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+### EOF
@@ -0,0 +1,113 @@
+# reference_db.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Small in-memory reference database for the tests: SQLite behind the
+# pymysql calls the stages make, with text compared without regard to
+# case, as MySQL's default collation does
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import re
+import sqlite3
+
+
+"""pymysql-style cursor over a SQLite connection. Statements use %s
+placeholders; the MySQL-only parts of the job_keys table are dropped,
+and straight joins become SQLite's cross joins, which also keep the
+left table outermost
+"""
+class Cursor(object):
+    def __init__(self, db):
+        self.db = db
+        self.description = None
+        self.rows = []
+        self.executed = 0
+
+    def convert(self, sql):
+        sql = sql.replace('%s', '?')
+        sql = sql.replace('CREATE TEMPORARY TABLE', 'CREATE TEMP TABLE')
+        sql = sql.replace('straight_join', 'cross join')
+        sql = re.sub(r',\s*KEY \w+ \([^)]*\)', '', sql)
+        return re.sub(r'(VARCHAR\(\d+\))', r'\1 COLLATE NOCASE', sql)
+
+    def execute(self, sql, params=()):
+        self.executed = self.executed + 1
+        cursor = self.db.execute(self.convert(sql), tuple(params or ()))
+        self.description = cursor.description
+        self.rows = cursor.fetchall() if cursor.description else []
+        return len(self.rows)
+
+    def executemany(self, sql, seq):
+        self.executed = self.executed + 1
+        self.db.executemany(self.convert(sql), [tuple(x) for x in seq])
+
+    def fetchall(self):
+        rows, self.rows = tuple(self.rows), []
+        return rows
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size=1):
+        rows, self.rows = tuple(self.rows[:size]), self.rows[size:]
+        return rows
+
+    def __iter__(self):
+        while self.rows:
+            yield self.rows.pop(0)
+
+    def close(self):
+        pass
+
+
+class Connection(object):
+    def __init__(self, db):
+        self.db = db
+        # MySQL does not index tables on the fly for a join; SQLite's
+        # automatic indexes would return the rows in their order
+        db.execute('pragma automatic_index = off;')
+
+    def cursor(self, cls=None):
+        return Cursor(self.db)
+
+    def ping(self, reconnect=True):
+        pass
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        pass
+
+
+"""A connection to a new database holding tables, a dict of table name
+to (column names, rows). Rows keep the order they are given in, which
+is the order an unordered query returns them. indexes maps a table name
+to the columns of an index on it; queries that read through the index
+return the rows in its order instead, as MySQL does. With a path the
+database is kept in that file, for reopen() to open more connections to
+"""
+def connect(tables, path=':memory:', indexes={}):
+    db = sqlite3.connect(path, check_same_thread=False)
+    for name, (columns, rows) in tables.items():
+        db.execute('create table ' + name + ' (' + ', '.join(['"' + c + \
+            '" COLLATE NOCASE' for c in columns]) + ');')
+        db.executemany('insert into ' + name + ' values (' + \
+            ', '.join(['?'] * len(columns)) + ');', rows)
+        if name in indexes:
+            db.execute('create index ' + name + '_index on ' + name + \
+                ' (' + ', '.join(indexes[name]) + ');')
+    db.commit()
+    return Connection(db)
+
+
+def reopen(path):
+    return Connection(sqlite3.connect(path, check_same_thread=False))
+
+### EOF
@@ -0,0 +1,109 @@
+# test_async_lookup.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the adaptive limit on queries in flight and of the pipelined
+# lookups it drives
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import async_lookup
+
+
+"""Stage whose query sleeps for latency(key) seconds and records how
+many queries were running at once
+"""
+class SlowStage(object):
+    def __init__(self, latency):
+        self.latency = latency
+        self.running = 0
+        self.most = 0
+        self.queried = []
+        self.lock = threading.Lock()
+
+    def query(self, cursor, key):
+        with self.lock:
+            self.running = self.running + 1
+            self.most = max(self.most, self.running)
+            self.queried.append(key)
+        time.sleep(self.latency(key))
+        with self.lock:
+            self.running = self.running - 1
+        return ('row', key)
+
+
+def test_limit_halves_once_per_round_on_slow_queries():
+    limit = async_lookup.AdaptiveLimit(8)
+    before = time.monotonic()
+    limit.update(before, 0.010)
+    assert limit.current() == 8
+
+    limit.update(before, 0.100)
+    assert limit.current() == 4
+    # Queries already in flight when the limit dropped come back slow
+    # too; they do not cut it again
+    limit.update(before, 0.100)
+    assert limit.current() == 4
+    assert limit.decreases == 1
+
+    limit.update(time.monotonic(), 0.100)
+    assert limit.current() == 2
+    for n in range(5):
+        limit.update(time.monotonic(), 0.100)
+    assert limit.current() == 1
+    assert limit.limit >= 1.0
+
+
+def test_limit_grows_by_about_one_per_round_up_to_maximum():
+    limit = async_lookup.AdaptiveLimit(4)
+    limit.limit = 2.0
+    started = time.monotonic()
+    limit.update(started, 0.010)
+    limit.update(started, 0.010)
+    assert 2.0 < limit.limit < 3.0
+    limit.update(started, 0.011)
+    assert limit.current() == 3
+    for n in range(20):
+        limit.update(started, 0.010)
+    assert limit.current() == 4
+    assert limit.limit == 4.0
+
+
+def test_resolve_returns_rows_in_key_order_once_per_key():
+    stage = SlowStage(lambda key: 0.001 * (key % 3))
+    executor = ThreadPoolExecutor(max_workers=8)
+    lookups = async_lookup.PipelinedLookups(executor, lambda: None, 4)
+    keys = [5, None, 3, 5, 1, 2, 3, 0]
+    assert lookups.resolve(stage, keys) == [None if (key is None) else
+        ('row', key) for key in keys]
+    assert sorted(stage.queried) == [0, 1, 2, 3, 5]
+    assert lookups.queries == 5
+    assert lookups.resolve(stage, [None]) == [None]
+    executor.shutdown()
+
+
+def test_queries_in_flight_stay_within_the_limit():
+    stage = SlowStage(lambda key: 0.005)
+    executor = ThreadPoolExecutor(max_workers=16)
+    lookups = async_lookup.PipelinedLookups(executor, lambda: None, 6)
+    lookups.resolve(stage, list(range(60)))
+    assert 1 < stage.most <= 6
+    executor.shutdown()
+
+    # Once the database slows down the limit drops, and fewer queries
+    # are sent at once
+    stage = SlowStage(lambda key: 0.05 if (key >= 10) else 0.001)
+    executor = ThreadPoolExecutor(max_workers=16)
+    lookups = async_lookup.PipelinedLookups(executor, lambda: None, 8)
+    lookups.resolve(stage, list(range(60)))
+    assert lookups.limit.decreases > 0
+    assert lookups.limit.current() < 8
+    executor.shutdown()
+
+### EOF
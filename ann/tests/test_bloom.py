@@ -0,0 +1,91 @@
+# test_bloom.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the dbSNP Bloom filters and of the lookups they let the
+# dbSNP stage skip
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+
+import pytest
+
+import annotate as ann
+import bloom as bl
+import reference_db
+
+DBSNP = ['id', 'CHR', 'POS', 'RSID', 'REF', 'ALT', 'INFO']
+
+
+@pytest.fixture
+def dbsnp():
+    rng = random.Random(7)
+    rows = []
+    for n in range(300):
+        rows.append((n, rng.choice(['1', '2', 'x']), rng.randrange(1, 5000),
+            'rs' + str(n), rng.choice('ACGT'), rng.choice('ACGT'), 'SNV'))
+    return rows
+
+
+def test_filter_has_every_value_added_and_few_others():
+    bits, hashes = bl.dimensions(1000, 0.01)
+    bloom = bl.BloomFilter(bits, hashes)
+    for value in range(1000):
+        bloom.add(value)
+    assert all([value in bloom for value in range(1000)])
+    false = len([value for value in range(1000, 21000) if value in bloom])
+    assert false < 20000 * 0.02
+
+
+def test_filters_fold_chromosome_names(tmp_path, dbsnp):
+    bl.build(str(tmp_path / 'bloom'), 0.01,
+        conn=reference_db.connect({'dbSNP': (DBSNP, dbsnp)}))
+    filters = bl.BloomFilters(str(tmp_path / 'bloom'))
+    for n, chrom, pos, rsid, ref, alt, info in dbsnp:
+        assert filters.may_contain(chrom, pos)
+        assert filters.may_contain(chrom.upper(), str(pos))
+    assert not filters.may_contain('3', dbsnp[0][2])
+    assert filters.may_contain('1', 'not a position')
+
+
+# A position the filter wrongly reports present is looked up as without
+# the filter and found missing; a position it rules out is not looked
+# up at all, and is counted as an avoided lookup
+def test_false_positives_fall_through_to_the_query(tmp_path, dbsnp):
+    conn = reference_db.connect({'dbSNP': (DBSNP, dbsnp)})
+    bl.build(str(tmp_path / 'bloom'), 0.3, conn=conn)
+    filters = bl.BloomFilters(str(tmp_path / 'bloom'))
+    present = set([(row[1], row[2]) for row in dbsnp])
+    missing = [('1', pos) for pos in range(1, 5000)
+        if ('1', pos) not in present]
+    false = [key for key in missing if filters.may_contain(*key)]
+    ruled_out = [key for key in missing if not filters.may_contain(*key)]
+    assert (len(false) > 0) and (len(ruled_out) > 0)
+
+    cursor = conn.cursor()
+    stage = ann.DbSnpStage()
+    stage.bloom = filters
+    for chrom, pos in false[:20]:
+        executed = cursor.executed
+        assert stage.query(cursor, (chrom, str(pos), 'A')) == ()
+        assert cursor.executed == executed + 1
+    assert stage.counts['bloom_avoided'] == 0
+
+    for chrom, pos in ruled_out[:20]:
+        executed = cursor.executed
+        assert stage.query(cursor, (chrom, str(pos), 'A')) == ()
+        assert cursor.executed == executed
+    assert stage.counts['bloom_avoided'] == 20
+
+    # Positions dbSNP has are always looked up and found
+    for n, chrom, pos, rsid, ref, alt, info in dbsnp[:20]:
+        stage.bloom = None
+        expected = stage.query(cursor, (chrom, str(pos), ref))
+        stage.bloom = filters
+        assert stage.query(cursor, (chrom, str(pos), ref)) == expected
+        assert len(expected) > 0
+
+### EOF
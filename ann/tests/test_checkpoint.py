@@ -0,0 +1,178 @@
+# test_checkpoint.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of saving, loading and resuming checkpoints, on local disk and
+# through a shared store
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import shutil
+
+import pytest
+from botocore.exceptions import ClientError
+
+import checkpoint as ck
+
+LINES = ['##fileformat=VCFv4.1\n', '#CHROM\tPOS\n', '1\t100\n', '1\t200\n',
+    '1\t300\n']
+
+
+class CountingStage(object):
+    def __init__(self, label):
+        self.label = label
+        self.counts = {'line_count': 0}
+
+
+@pytest.fixture
+def job(tmp_path):
+    infile = str(tmp_path / 'job~input.vcf')
+    outfile = str(tmp_path / 'job~input.annot')
+    with open(infile, 'w') as fh:
+        fh.writelines(LINES)
+    with open(outfile, 'w') as fh:
+        fh.write('first\nsecond\n')
+    ck.use_store(None)
+    yield infile, outfile
+    ck.use_store(None)
+
+
+def test_input_crc(job):
+    infile, outfile = job
+    assert ck.input_crc(infile, 3) == ck.input_crc(infile, 3)
+    assert ck.input_crc(infile, 3) != ck.input_crc(infile, 4)
+    assert ck.input_crc(infile, len(LINES) + 1) is None
+
+
+def test_save_and_resume(job):
+    infile, outfile = job
+    stages = [CountingStage('dbSNP'), CountingStage('cytoBand')]
+    stages[1].counts['line_count'] = 2
+    saved = ck.save(outfile, infile, stages, 3, ck.input_crc(infile, 3),
+        False)
+    assert not os.path.exists(ck.path_for(outfile) + '.tmp')
+
+    # Output written after the checkpoint is dropped on resume
+    with open(outfile, 'a') as fh:
+        fh.write('partial')
+    stages = [CountingStage('dbSNP'), CountingStage('cytoBand')]
+    state = ck.load(outfile, infile, stages, False)
+    assert state == saved
+    ck.resume(outfile, state, stages)
+    with open(outfile) as fh:
+        assert fh.read() == 'first\nsecond\n'
+    assert [stage.counts for stage in stages] == \
+        [{'line_count': 0}, {'line_count': 2}]
+
+    ck.remove(outfile)
+    assert ck.load(outfile, infile, stages, False) is None
+
+
+def test_done_checkpoint_keeps_the_output(job):
+    infile, outfile = job
+    stages = [CountingStage('dbSNP')]
+    ck.save(outfile, infile, stages, len(LINES),
+        ck.input_crc(infile, len(LINES)), False, done=True)
+    state = ck.load(outfile, infile, stages, False)
+    assert state['done']
+    ck.resume(outfile, state, stages)
+    assert os.path.getsize(outfile) == state['offset']
+
+
+def test_changed_input_is_not_resumed(job):
+    infile, outfile = job
+    stages = [CountingStage('dbSNP')]
+    ck.save(outfile, infile, stages, 4, ck.input_crc(infile, 4), False)
+    with open(infile, 'w') as fh:
+        fh.writelines(LINES[:2] + ['1\t101\n'] + LINES[3:])
+    assert ck.load(outfile, infile, stages, False) is None
+
+
+def test_other_run_is_not_resumed(job):
+    infile, outfile = job
+    stages = [CountingStage('dbSNP')]
+    ck.save(outfile, infile, stages, 3, ck.input_crc(infile, 3), False)
+    assert ck.load(outfile, infile, [CountingStage('cytoBand')],
+        False) is None
+    assert ck.load(outfile, infile, stages, True) is None
+
+    # An output shorter than the checkpoint records cannot be resumed
+    os.truncate(outfile, 3)
+    assert ck.load(outfile, infile, stages, False) is None
+
+
+def test_lock(job):
+    infile, outfile = job
+    held = ck.lock(outfile)
+    with pytest.raises(ck.Locked):
+        ck.lock(outfile)
+    ck.unlock(held)
+    ck.unlock(ck.lock(outfile))
+
+
+"""S3 client that keeps the objects in a local directory, and the order
+they were uploaded in
+"""
+class DirectoryClient(object):
+    def __init__(self, root):
+        self.root = root
+        self.uploads = []
+
+    def upload_file(self, path, bucket, key):
+        self.uploads.append(key)
+        target = os.path.join(self.root, bucket, key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy(path, target)
+
+    def download_file(self, bucket, key, path):
+        source = os.path.join(self.root, bucket, key)
+        if not os.path.exists(source):
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        shutil.copy(source, path)
+
+    def delete_object(self, Bucket, Key):
+        path = os.path.join(self.root, Bucket, Key)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ck.S3Store('results', 'checkpoints', interval=300)
+    store.s3 = DirectoryClient(str(tmp_path / 's3'))
+    store.pid = os.getpid()
+    return store
+
+
+def test_resume_on_another_instance(job, store, tmp_path):
+    infile, outfile = job
+    stages = [CountingStage('dbSNP')]
+    ck.use_store(store)
+    ck.save(outfile, infile, stages, 3, ck.input_crc(infile, 3), False)
+    assert store.s3.uploads == ['checkpoints/job~input.annot',
+        'checkpoints/job~input.annot.ckpt']
+
+    # Saves within the interval are kept on local disk only
+    ck.save(outfile, infile, stages, 4, ck.input_crc(infile, 4), False)
+    assert len(store.s3.uploads) == 2
+
+    os.remove(outfile)
+    os.remove(ck.path_for(outfile))
+    state = ck.load(outfile, infile, stages, False)
+    assert state['lines'] == 3
+    with open(outfile) as fh:
+        assert fh.read() == 'first\nsecond\n'
+
+    ck.remove(outfile)
+    assert not store.pull(outfile)
+
+
+def test_missing_checkpoint_in_store(job, store):
+    infile, outfile = job
+    ck.use_store(store)
+    assert ck.load(outfile, infile, [CountingStage('dbSNP')], False) is None
+
+### EOF
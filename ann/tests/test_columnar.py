@@ -0,0 +1,95 @@
+# test_columnar.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the typed columns of the Parquet sidecar
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import pytest
+
+import columnar
+
+KINDS = {'DB': 'flag', 'VC': 'string', 'GMAF': 'doubles',
+    'otherStart': 'int', 'cytoBand': 'strings', 'gadAll': 'strings'}
+
+
+def test_parse_record_types():
+    line = 'chr1\t100\trs1;rs2\tA\tG\t50.5\tPASS\t' + \
+        'AC=1;DB;VC=SNV;GMAF=0.25;GMAF=x;otherStart=1200;' + \
+        'cytoBand=p36.33;p36.32;AN=2;q1;gadAll=BRCA2\tGT\t0/1'
+    values = columnar.parse_record(line, KINDS)
+    assert values == {'CHROM': 'chr1', 'POS': 100, 'rsID': ['rs1', 'rs2'],
+        'REF': 'A', 'ALT': 'G', 'QUAL': 50.5, 'FILTER': 'PASS',
+        'DB': True, 'VC': 'SNV', 'GMAF': [0.25, None], 'otherStart': 1200,
+        'cytoBand': ['p36.33', 'p36.32'], 'gadAll': ['BRCA2']}
+
+
+def test_parse_record_missing_values():
+    values = columnar.parse_record('chr1\t100\t.\tA\tG\t.\t.\t.', KINDS)
+    assert values['rsID'] == []
+    assert values['QUAL'] is None
+    assert values['DB'] is False
+    assert (values['VC'], values['otherStart']) == (None, None)
+    assert (values['GMAF'], values['cytoBand']) == ([], [])
+
+    # Records cut short after POS
+    values = columnar.parse_record('chr1\tx', KINDS)
+    assert values['POS'] is None
+    assert values['ALT'] == '.'
+
+
+def test_parse_record_of_padded_record():
+    line = 'chr1\t 100\t .\t A\t G\t .\t .\t ' + \
+        'VC=SNV;VC=MNV;otherStart=abc;gadAll=TP53'
+    values = columnar.parse_record(line, KINDS)
+    assert values['POS'] == 100
+    assert values['VC'] == 'SNV'
+    assert values['otherStart'] is None
+    assert values['gadAll'] == ['TP53']
+
+
+def test_path_for():
+    assert columnar.path_for('j~x.annot.vcf') == 'j~x.annot.parquet'
+    assert columnar.path_for('j~x.annot.vcf.gz') == 'j~x.annot.parquet'
+
+
+class KeyStage(object):
+    def __init__(self, *infoKeys):
+        self.infoKeys = infoKeys
+
+
+def test_annotation_columns():
+    stages = [KeyStage('DB', 'VC'), KeyStage('cytoBand'),
+        KeyStage('VC', 'otherStart')]
+    assert columnar.annotation_columns(stages) == [('DB', 'flag'),
+        ('VC', 'string'), ('cytoBand', 'strings'), ('otherStart', 'int')]
+
+
+def test_write_parquet(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    annotfile = str(tmp_path / 'x.annot.vcf')
+    with open(annotfile, 'w') as fh:
+        fh.write('##fileformat=VCFv4.1\n#CHROM\tPOS\n')
+        for pos in range(5):
+            fh.write(f"chr1\t{pos}\trs{pos}\tA\tG\t.\t.\tDB;" + \
+                f"cytoBand=p{pos};q{pos}\n")
+        fh.write('\n')
+    outfile = columnar.path_for(annotfile)
+    stages = [KeyStage('DB'), KeyStage('cytoBand')]
+
+    assert columnar.write_parquet(annotfile, outfile, stages,
+        row_group_rows=2) == 5
+    parquet = pq.ParquetFile(outfile)
+    assert parquet.num_row_groups == 3
+    table = parquet.read()
+    assert table.column_names == ['CHROM', 'POS', 'rsID', 'REF', 'ALT',
+        'QUAL', 'FILTER', 'DB', 'cytoBand']
+    assert table.column('POS').to_pylist() == [0, 1, 2, 3, 4]
+    assert table.column('DB').to_pylist() == [True] * 5
+    assert table.column('cytoBand').to_pylist()[3] == ['p3', 'q3']
+    assert table.column('QUAL').to_pylist() == [None] * 5
+
+### EOF
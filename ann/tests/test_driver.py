@@ -0,0 +1,70 @@
+# test_driver.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the annotation profiles and of the stages built for them
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import pytest
+
+import driver
+import pipeline
+
+NAMES = [name for name, cls, kwargs in driver.STAGES]
+
+
+def test_profile_stages():
+    assert driver.profile_stages('full') == NAMES
+    assert driver.profile_stages('fast') == ['dbSNP', 'BigRefGene', 'Genes']
+    assert driver.profile_stages(' hugo, cytoBand ,') == ['hugo', 'cytoBand']
+
+
+@pytest.mark.parametrize('profile', ['', ',', 'slow', 'dbSNP,cytoband'])
+def test_unknown_profile(profile):
+    with pytest.raises(ValueError):
+        driver.profile_stages(profile)
+
+
+def test_profiles_name_known_stages():
+    for profile, names in driver.PROFILES.items():
+        assert set(names) <= set(NAMES), profile
+
+
+def test_build_stages_adds_dependencies():
+    stages = driver.build_stages('vcf', 'Genes')
+    assert [stage.name for stage in stages] == ['BigRefGene', 'Genes']
+
+    stages = driver.build_stages('vcf', 'hugo,Genes,cytoBand')
+    assert [stage.name for stage in stages] == \
+        ['BigRefGene', 'Genes', 'cytoBand', 'hugo']
+
+
+def test_build_stages_closure():
+    # Every stage built has the stages it depends on before it, for
+    # every profile and for every stage on its own
+    for profile in list(driver.PROFILES) + NAMES:
+        stages = driver.build_stages('vcf', profile)
+        labels = [stage.label for stage in stages]
+        for i, stage in enumerate(stages):
+            for label in stage.depends:
+                assert label in labels[:i], (profile, stage.name, label)
+        pipeline.check_depends(stages)
+
+
+def test_build_stages_are_new_and_named():
+    first = driver.build_stages('vcf')
+    second = driver.build_stages('vcf')
+    assert [stage.name for stage in first] == NAMES
+    assert all([a is not b for a, b in zip(first, second)])
+    for stage in first:
+        assert stage.version == driver.reference_version(stage.name)
+
+
+def test_log_path():
+    assert driver.log_path('job~x.vcf') == 'job~x.vcf.count.log'
+    assert driver.log_path('job~x.vcf.gz') == 'job~x.vcf.count.log'
+
+### EOF
@@ -0,0 +1,125 @@
+# test_hash_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the hash indexes against the equality queries they replace
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import pytest
+
+import annotate as ann
+import hash_index
+import reference_db
+
+DBSNP = ['id', 'CHR', 'POS', 'RSID', 'REF', 'ALT', 'INFO']
+
+# Rows at one position on both strands, in either case, of another
+# variant class, and with REFs that have no allele code
+DBSNP_ROWS = [(1, '1', 100, 'rs1', 'G', 'A', 'SNV'),
+    (2, '1', 100, 'rs2', 'C', 'T', 'SNV'),
+    (3, '1', 100, 'rs3', 'a', 'G', 'SNV'),
+    (4, '1', 100, 'rs4', 'G', 'T', 'MNV'),
+    (5, '1', 100, 'rs5', 'N', 'A', 'SNV'),
+    (6, '1', 100, 'rs6', 'GA', 'G', 'SNV'),
+    (7, '1', 100, 'rs7', 'c', 'A', 'SNV'),
+    (8, '1', 101, 'rs8', 'G', 'A', 'SNV'),
+    (9, '2', 100, 'rs9', 'G', 'A', 'SNV')]
+
+REFGENE = ['id', 'CHR', 'start', 'end', 'haplotypeReference',
+    'haplotypeAlternate', 'name']
+
+
+def test_allele_code_is_the_same_on_both_strands():
+    assert hash_index.allele_code(('A',)) == hash_index.allele_code(('T',))
+    assert hash_index.allele_code(('g',)) == hash_index.allele_code(('C',))
+    assert hash_index.allele_code(('A',)) != hash_index.allele_code(('G',))
+    assert hash_index.allele_code(('A', 'G')) == \
+        hash_index.allele_code(('T', 'C'))
+    assert hash_index.allele_code(('A', 'G')) != \
+        hash_index.allele_code(('A', 'C'))
+    assert hash_index.allele_code(('N',)) == 0
+    assert hash_index.allele_code(('GA',)) == 0
+
+
+def test_probe_merges_coded_and_uncoded_rows_in_table_order():
+    rows = [('1', 5, 'N'), ('1', 5, 'A'), ('1', 5, 'G'), ('1', 5, 'T'),
+        ('1', 6, 'A')]
+    index = hash_index.HashIndex(rows, '1', 1, [2])
+    assert index.probe('1', 5, hash_index.allele_code(('A',))) == \
+        [rows[0], rows[1], rows[3]]
+    assert index.probe('chr1', 5, hash_index.allele_code(('C',))) == \
+        [rows[0], rows[2]]
+    assert index.probe('1', 7, hash_index.allele_code(('A',))) == []
+
+
+@pytest.mark.parametrize('ref', ['G', 'C', 'A', 'T', 'g', 'N'])
+def test_dbsnp_hashes_find_what_the_query_finds(ref):
+    cursor = reference_db.connect({'dbSNP': (DBSNP, DBSNP_ROWS)}).cursor()
+    stage = ann.DbSnpStage()
+    for chrom, pos in [('1', '100'), ('1', '101'), ('2', '100'),
+        ('1', '102'), ('3', '100')]:
+        key = (chrom, pos, ref)
+        stage.hashes = None
+        expected = list(stage.query(cursor, key))
+        stage.hashes = hash_index.HashIndexCache()
+        assert list(stage.query(cursor, key)) == expected
+
+
+def test_dbsnp_hashes_hit_both_strands():
+    cursor = reference_db.connect({'dbSNP': (DBSNP, DBSNP_ROWS)}).cursor()
+    stage = ann.DbSnpStage()
+    stage.hashes = hash_index.HashIndexCache()
+    assert [row[3] for row in stage.query(cursor, ('1', '100', 'G'))] == \
+        ['rs1', 'rs2', 'rs7']
+    assert [row[3] for row in stage.query(cursor, ('1', '100', 'T'))] == \
+        ['rs3']
+
+
+# The equal-base tier matches the alleles or their complements; the
+# hash index must keep both strands' rows, and fall back to the tiers
+# after it as the tiered query does
+@pytest.mark.parametrize('alleles', [('A', 'G'), ('T', 'C'), ('a', 'g'),
+    ('A', 'C'), ('G', 'A')])
+def test_refgene_hashes_find_what_the_tiered_query_finds(alleles):
+    tables = {'chrom_pos_equal_base': (REFGENE, [
+            (1, '1', 100, 100, 'A', 'G', 'forward'),
+            (2, '1', 100, 100, 'C', 'T', 'other'),
+            (3, '1', 100, 100, 'T', 'C', 'reverse'),
+            (4, '1', 200, 200, 'G', 'A', 'forward')]),
+        'chrom_pos_equal_nobase': (REFGENE, [
+            (5, '1', 100, 100, 'G', 'G', 'nobase'),
+            (6, '1', 300, 300, 'A', 'A', 'nobase')]),
+        'chrom_pos_unequal': (REFGENE, [
+            (7, '1', 50, 400, 'A', 'A', 'range'),
+            (8, '1', 150, 250, 'A', 'A', 'range')])}
+    cursor = reference_db.connect(tables).cursor()
+    stage = ann.BigRefGeneStage()
+    ref, alt = alleles
+    for pos in ['100', '200', '300', '220', '500']:
+        key = ('1', pos, ref, alt)
+        stage.hashes = None
+        expected = list(stage.query(cursor, key))
+        stage.hashes = hash_index.HashIndexCache()
+        assert list(stage.query(cursor, key)) == expected
+    # getComplementary() complements upper case bases only, so lower case
+    # alleles match their own strand, in the query as in the index
+    if alleles in [('A', 'G'), ('T', 'C')]:
+        assert [row[6] for row in stage.query(cursor, ('1', '100', ref,
+            alt))] == ['forward', 'reverse']
+
+
+def test_cache_evicts_least_recently_used_chromosomes():
+    cursor = reference_db.connect({'dbSNP': (DBSNP, DBSNP_ROWS)}).cursor()
+    cache = hash_index.HashIndexCache()
+    for chrom in ['1', '2', '1']:
+        cache.probe(cursor, 'dbSNP', chrom, 100, ('G',))
+    assert cache.loads == 2
+    cache.budget = cache.sizes[('dbSNP', None, '1')]
+    cache.evict()
+    assert list(cache.indexes) == [('dbSNP', None, '1')]
+    assert cache.evictions == 1
+
+### EOF
@@ -0,0 +1,171 @@
+# test_interval_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the interval index and its NumPy batch kernel, against a
+# brute-force scan of the intervals
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+
+import pytest
+
+import annotate as ann
+import interval_index as ii
+import snapshot as snap
+import utils as u
+import reference_db
+
+np = pytest.importorskip('numpy')
+
+
+def random_intervals(rng, count, span=2000, longest=300):
+    intervals = []
+    for n in range(count):
+        start = rng.randrange(span)
+        intervals.append((start, start + rng.randrange(longest), n))
+    return intervals
+
+
+# Rows with start <= pos <= end, in the order of intervals
+def brute_force(intervals, pos):
+    return [row for start, end, row in intervals if start <= pos <= end]
+
+
+def test_overlap_hits_matches_brute_force():
+    rng = random.Random(7)
+    intervals = sorted(random_intervals(rng, 500))
+    starts = np.array([i[0] for i in intervals], dtype=np.int64)
+    ends = np.array([i[1] for i in intervals], dtype=np.int64)
+    maxEnds = np.maximum.accumulate(ends)
+    positions = np.array([rng.randrange(-10, 2400) for n in range(400)],
+        dtype=np.int64)
+
+    variants, candidates = ii.overlap_hits(starts, ends, maxEnds, positions)
+    found = [[] for pos in positions]
+    for v, c in zip(variants.tolist(), candidates.tolist()):
+        found[v].append(intervals[c][2])
+    for v, pos in enumerate(positions.tolist()):
+        assert found[v] == brute_force(intervals, pos)
+
+
+def test_overlap_hits_nested_and_edges():
+    # The long interval ends after the short ones, so only maxEnds
+    # keeps it from being skipped at position 90
+    intervals = [(0, 100, 'a'), (10, 20, 'b'), (20, 20, 'c'), (30, 40, 'd')]
+    starts = np.array([i[0] for i in intervals], dtype=np.int64)
+    ends = np.array([i[1] for i in intervals], dtype=np.int64)
+    positions = np.array([-1, 0, 20, 21, 40, 90, 100, 101], dtype=np.int64)
+
+    variants, candidates = ii.overlap_hits(starts, ends,
+        np.maximum.accumulate(ends), positions)
+    found = [[] for pos in positions]
+    for v, c in zip(variants.tolist(), candidates.tolist()):
+        found[v].append(intervals[c][2])
+    assert found == [[], ['a'], ['a', 'b', 'c'], ['a'], ['a', 'd'], ['a'],
+        ['a'], []]
+
+
+def test_overlap_hits_empty():
+    empty = np.array([], dtype=np.int64)
+    variants, candidates = ii.overlap_hits(empty, empty, empty,
+        np.array([5, 6], dtype=np.int64))
+    assert len(variants) == 0 and len(candidates) == 0
+
+
+def test_index_returns_rows_in_table_order():
+    rng = random.Random(11)
+    intervals = random_intervals(rng, 300)
+    index = ii.IntervalIndex(intervals)
+    positions = [rng.randrange(2400) for n in range(200)]
+
+    for pos in positions:
+        assert index.overlapping(pos) == brute_force(intervals, pos)
+    assert index.overlapping_batch(positions) == \
+        [brute_force(intervals, pos) for pos in positions]
+
+
+def test_index_keeps_table_order_of_equal_starts():
+    intervals = [(5, 9, 'first'), (1, 9, 'second'), (5, 6, 'third')]
+    index = ii.IntervalIndex(intervals)
+    assert index.overlapping(5) == ['first', 'second', 'third']
+    assert index.overlapping_batch([5, 8]) == \
+        [['first', 'second', 'third'], ['first', 'second']]
+
+
+"""Cursor over a fixed table, which returns every row for any statement
+"""
+class TableCursor(object):
+    def __init__(self, names, rows):
+        self.description = [(name,) for name in names]
+        self.rows = rows
+
+    def execute(self, sql, params=()):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_table_index_folds_chromosome_case():
+    rows = [('chrMT', 10, 50, 'CpG: 5'), ('chr1', 10, 50, 'CpG: 9'),
+        ('chrmt', 40, 60, 'CpG: 7')]
+    index = ii.TableIndex('cpgIslandTest')
+    cursor = TableCursor(['chrom', 'chromStart', 'chromEnd', 'name'], rows)
+    assert index.overlapping(cursor, 'chrmt', 45) == [rows[0], rows[2]]
+    assert index.overlapping(cursor, 'chrMT ', 20) == [rows[0]]
+    assert index.overlapping(cursor, 'CHR1', 20) == [rows[1]]
+    assert index.overlapping(cursor, 'chr2', 20) == []
+
+
+def test_table_index_keeps_the_order_of_the_chromosome_query():
+    rows = [('chr1', 30, 90, 'late'), ('chr1', 10, 50, 'early'),
+        ('chr1', 10, 40, 'tie'), ('chr1', 60, 70, 'inner')]
+    index = ii.TableIndex('cpgIslandOrder')
+    cursor = TableCursor(['chrom', 'chromStart', 'chromEnd', 'name'], rows)
+    assert index.overlapping(cursor, 'chr1', 35) == \
+        [rows[0], rows[1], rows[2]]
+    assert index.overlapping(cursor, 'chr1', 65) == [rows[0], rows[3]]
+
+
+# Overlapping islands stored out of start order, with two equal starts
+CPG_ISLANDS = [(585, 'chr1', 300, 900, 'CpG: 1', 100),
+    (585, 'chr1', 100, 600, 'CpG: 2', 100),
+    (585, 'chr1', 450, 500, 'CpG: 3', 100),
+    (585, 'chr1', 100, 800, 'CpG: 4', 100),
+    (585, 'chr2', 700, 750, 'CpG: 5', 100),
+    (585, 'chr2', 20, 800, 'CpG: 6', 100)]
+
+
+# With the (chrom, chromStart) index the query reads the islands in
+# order of start, and without it in table order
+@pytest.mark.parametrize('indexes', [{'cpgIslandExt': ['chrom',
+    'chromStart']}, {}])
+def test_cpg_island_is_the_one_the_query_fetches(tmp_path, monkeypatch,
+    capsys, indexes):
+    path = str(tmp_path / 'reference.db')
+    conn = reference_db.connect({'cpgIslandExt': (['bin', 'chrom',
+        'chromStart', 'chromEnd', 'name', 'length'], CPG_ISLANDS)}, path,
+        indexes)
+    monkeypatch.setattr(u, 'db_open', lambda: reference_db.reopen(path))
+    monkeypatch.setattr(u, '_pool', [])
+    monkeypatch.setattr(ii, '_tables', {})
+    snap.build(str(tmp_path / 'snap'), ['cpgIslandExt'], conn=conn)
+    capsys.readouterr()
+    stage = ann.GenesStage()
+    stage.snapshot = snap.Snapshot(str(tmp_path / 'snap'))
+
+    cursor = conn.cursor()
+    for chr in ['chr1', 'chr2', 'chr3']:
+        for pos in range(0, 1000, 25):
+            cursor.execute('select chrom, chromStart, chromEnd, name from ' + \
+                'cpgIslandExt where chrom="' + chr + '" AND (chromStart <= ' + \
+                str(pos) + ' AND ' + str(pos) + ' <= chromEnd);')
+            expected = cursor.fetchone()
+            assert ann.cpgIslandAt(cursor, chr, pos) == expected
+            assert stage.cpgIsland(cursor, chr, pos) == expected
+
+### EOF
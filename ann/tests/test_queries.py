@@ -0,0 +1,53 @@
+# test_queries.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the statement registry and of the parameters the stages bind
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import pytest
+
+import annotate as ann
+import queries
+
+
+class RecordingCursor(object):
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, sql, params=()):
+        self.executed.append((sql, params))
+
+    def fetchall(self):
+        return ()
+
+
+def test_register_keeps_one_statement_per_name():
+    statement = queries.register('test.one', 'select 1;')
+    assert queries.register('test.one', 'select 1;') is statement
+    with pytest.raises(ValueError):
+        queries.register('test.one', 'select 2;')
+
+
+def test_report_writes_to_stdout_at_call_time(capsys):
+    queries.reset()
+    queries.execute(RecordingCursor(), queries.register('test.two',
+        'select %s;'), (1,))
+    queries.report()
+    assert capsys.readouterr().out.startswith('Query test.two: 1 executions')
+
+
+def test_alleles_are_bound_without_quotes():
+    fields = ['chr1', '100', 'rs1', '"G', "'A", '.', '.', '.']
+    assert ann.DbSnpStage().key(fields) == ('1', '100', 'G')
+    assert ann.BigRefGeneStage().key(fields) == ('1', '100', 'G', 'A')
+
+    cursor = RecordingCursor()
+    ann.DbSnpStage().query(cursor, ann.DbSnpStage().key(fields))
+    assert cursor.executed == [(ann.DbSnpStage.statement.sql,
+        ('1', 100, 'G', 'C', 'SNV'))]
+
+### EOF
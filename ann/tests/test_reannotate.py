@@ -0,0 +1,235 @@
+# test_reannotate.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of re-annotating one stage of annotated records: the result must
+# be what annotating the input again with every stage would give
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import pytest
+
+import driver
+import pipeline
+import reannotate as rean
+from vcf_record import VcfRecord
+
+PROFILE = 'cytoBand,gadAll,dgv_Cnv'
+
+LINES = ['chr1\t100\trs1\tA\tG\t50\tPASS\tAC=1',
+    'chr1\t200\t.\tC\tT\t.\t.\t.',
+    'chr2\t300\t.\tG\tA\t.\t.\tcytoBand=p36;AN=2\tGT\t0/1',
+    'chr2\t400\t.\tT\tC\t.\t.\tAC=2\tGT:DP\t1/1:4\t0/1:9']
+
+# Reference rows by table and position, before and after a table is
+# reloaded
+BEFORE = {
+    'cytoBand': {'100': [('chr1', 0, 150, 'p36.33')],
+        '200': [('chr1', 150, 250, 'p36.32'), ('chr1', 190, 210, 'p36.31')],
+        '400': [('chr2', 350, 450, 'p25.3')]},
+    'gadAll': {'100': [('1', 90, 110, 'BRCA2')],
+        '300': [('2', 290, 310, 'TP53'), ('2', 299, 301, 'TP53')]},
+    'dgv_Cnv': {'200': [('chr1', 150, 250, 'cnv1')],
+        '400': [('chr2', 350, 450, 'cnv2')]}}
+RELOADED = {
+    'cytoBand': {'100': [('chr1', 0, 150, 'p36.33')],
+        '300': [('chr2', 250, 350, 'p25.2'), ('chr2', 280, 320, 'p25.1')]},
+    'gadAll': {'200': [('1', 190, 210, 'EGFR')],
+        '300': [('2', 290, 310, 'KRAS')]},
+    'dgv_Cnv': {'100': [('chr1', 50, 150, 'cnv3')]}}
+
+
+def stages_over(reference, profile=PROFILE):
+    stages = driver.build_stages('vcf', profile)
+    for stage in stages:
+        rows = reference.get(stage.name, {})
+        stage.query = lambda cursor, key, rows=rows: rows.get(key[1], [])
+    return stages
+
+
+# The lines as a full run with stages writes them out
+def annotate(stages, lines):
+    records = [VcfRecord(line) for line in lines]
+    pipeline.annotate_chunk(None, stages, records)
+    return [record.serialize() for record in records]
+
+
+# The lines annotated over before, with the stages named in changed
+# annotated again over after, and the stages that did it
+def reannotate(lines, before, after, changed, profile=PROFILE):
+    annotated = annotate(stages_over(before, profile), lines)
+    stages = stages_over(after, profile)
+    numbers = [i for i, stage in enumerate(stages) if stage.name in changed]
+    return rean.reannotate_chunk(None, stages, numbers, annotated,
+        lines), stages
+
+
+def test_split_info():
+    owners = {'cytoBand': 0, 'gadAll': 1, 'dgv_Cnv': 2}
+    info = 'AN=2;cytoBand=p36.33;p36.32;gadAll=BRCA2;dgv_Cnv=True'
+    assert rean.split_info(info, 'AN=2', 0, owners) == (['AN=2'],
+        ['cytoBand=p36.33', 'p36.32'], ['gadAll=BRCA2', 'dgv_Cnv=True'])
+    assert rean.split_info(info, 'AN=2', 1, owners) == \
+        (['AN=2', 'cytoBand=p36.33', 'p36.32'], ['gadAll=BRCA2'],
+        ['dgv_Cnv=True'])
+    assert rean.split_info(info, 'AN=2', 2, owners) == \
+        (info.split(';')[:-1], ['dgv_Cnv=True'], [])
+
+
+def test_split_info_without_the_stage():
+    owners = {'cytoBand': 0, 'gadAll': 1, 'dgv_Cnv': 2}
+    assert rean.split_info('AC=1;dgv_Cnv=True', 'AC=1', 1, owners) == \
+        (['AC=1'], [], ['dgv_Cnv=True'])
+    assert rean.split_info('.', '.', 1, owners) == (['.'], [], [])
+    assert rean.split_info('.;gadAll=X', '.', 0, owners) == \
+        (['.'], [], ['gadAll=X'])
+
+
+def test_split_info_of_a_replaced_placeholder():
+    owners = {'DB': 0, 'VC': 0, 'GMAF': 0, 'cytoBand': 1}
+    assert rean.split_info('DB;GMAF=0.1;cytoBand=p1', '.', 0, owners) == \
+        ([], ['DB', 'GMAF=0.1'], ['cytoBand=p1'])
+    assert rean.split_info('DB;GMAF=0.1;cytoBand=p1', '.', 1, owners) == \
+        (['DB', 'GMAF=0.1'], ['cytoBand=p1'], [])
+
+
+def test_split_info_of_input_entries_with_the_keys_of_stages():
+    owners = {'cytoBand': 0, 'gadAll': 1, 'dgv_Cnv': 2}
+    assert rean.split_info('gadAll=Y;cytoBand=p1;gadAll=X;dgv_Cnv=True',
+        'gadAll=Y;cytoBand=p1', 1, owners) == \
+        (['gadAll=Y', 'cytoBand=p1'], ['gadAll=X'], ['dgv_Cnv=True'])
+    assert rean.split_info('gadAll=Y;cytoBand=p1', 'gadAll=Y;cytoBand=p1',
+        0, owners) == (['gadAll=Y', 'cytoBand=p1'], [], [])
+
+
+def test_split_info_refuses_what_it_cannot_tell_apart():
+    owners = {'cytoBand': 0, 'gadAll': 1, 'dgv_Cnv': 2}
+    # The trailing ; of the input went into the stage's entry
+    assert rean.split_info('AC=1;gadAll=X', 'AC=1;', 1, owners) is None
+    # The stages' entries are out of stage order
+    assert rean.split_info('AC=1;gadAll=X;cytoBand=p1', 'AC=1', 1,
+        owners) is None
+    # An entry after the input's belongs to no stage
+    assert rean.split_info('AC=1;gadAll=X;AN=2', 'AC=1', 1, owners) is None
+    # The annotated record was not annotated from that input
+    assert rean.split_info('AC=2;gadAll=X', 'AC=1', 1, owners) is None
+
+
+def test_entry_owners():
+    owners = {'cytoBand': 0, 'gadAll': 1}
+    assert rean.entry_owners(['AC=1', 'cytoBand=p1', 'p2', 'DB',
+        'gadAll=X', 'AN=2', 'q'], owners) == [None, 0, 0, 0, 1, None, None]
+
+
+@pytest.mark.parametrize('changed', ['cytoBand', 'gadAll', 'dgv_Cnv'])
+def test_reannotate_chunk(changed):
+    after = dict(BEFORE)
+    after[changed] = RELOADED[changed]
+    stages = stages_over(after)
+    s = [stage.name for stage in stages].index(changed)
+    assert rean.separable(stages[s], stages)
+
+    found, stages = reannotate(LINES, BEFORE, after, [changed])
+    assert found == annotate(stages_over(after), LINES)
+
+
+def test_reannotate_chunk_looks_up_only_the_stage():
+    after = dict(BEFORE)
+    after['cytoBand'] = {'100': [('chr1', 0, 150, 'p36.13')],
+        '200': [('chr1', 150, 250, 'p36.12')],
+        '400': [('chr2', 350, 450, 'p25.1')]}
+    inputs = LINES
+    lines = annotate(stages_over(BEFORE), inputs)
+    stages = stages_over(after)
+
+    def unexpected(cursor, key):
+        raise AssertionError('looked up a stage that did not change')
+    for stage in stages[1:]:
+        stage.query = unexpected
+    assert rean.reannotate_chunk(None, stages, [0], lines, inputs) == \
+        annotate(stages_over(after), inputs)
+
+
+def test_reannotate_chunk_twice_is_stable():
+    stages = stages_over(BEFORE)
+    lines = annotate(stages, LINES)
+    for s in range(len(stages)):
+        assert rean.reannotate_chunk(None, stages, [s], lines, LINES) == \
+            lines
+
+
+# Records that annotating one stage again cannot split, or whose
+# neighbouring entries are joined differently once the stage's entries
+# come or go: an INFO of ., input keys of the stages, a trailing ;, a
+# padded input POS and Genes writing a lone ;
+TRICKY = 'dbSNP,Genes,cytoBand,gadAll,genomicSuperDups'
+
+TRICKY_LINES = ['chr1\t100\t.\tA\tG\t.\t.\t.',
+    'chr1\t200\t.\tC\tT\t.\t.\tpositionType=CDS',
+    'chr1\t300\t.\tG\tA\t.\t.\tAC=1;cytoBand=p1',
+    'chr1\t 400\t.\tT\tC\t.\t.\tAC=1',
+    'chr1\t500\t.\tA\tC\t.\t.\tAC=1;',
+    'chr1\t600\t.\tC\tG\t.\t.\tAC=1\tGT\t0/1',
+    'chr1\t700\t.\tG\tT\t.\t.\t.']
+
+TRANSCRIPT = (0, 'NM_1', 'chr1', '+', 0, 1000, 100, 900, 2, '0,800,',
+    '200,1000,', 0, 'GENE1', 'cmpl', 'cmpl', '0,0,')
+
+def snp(rsid, maf='.'):
+    return ('1', 0, 0, rsid, 'A', 'G', 'SNV', maf)
+
+def dup(other):
+    return ('chr1', 0, 1000, 'dup', 0, '+', 0, other, 10, 20)
+
+TRICKY_BEFORE = {
+    'dbSNP': {'100': [snp('rs1', '0.1')], '200': [snp('rs2')],
+        '300': [snp('rs3')], '400': [snp('rs4')], '500': [snp('rs5')]},
+    # A transcript that covers the position without a region is written
+    # as a lone ;
+    'Genes': {'200': [(TRANSCRIPT, '', 0, 0)],
+        '500': [(TRANSCRIPT, '', 0, 0)], '600': [(TRANSCRIPT, '', 0, 0)],
+        '700': [(TRANSCRIPT, 'exon=ex1/2', 1, 0)]},
+    'cytoBand': {'100': [('chr1', 0, 150, 'p36.33')],
+        '300': [('chr1', 250, 350, 'p36.32')],
+        '500': [('chr1', 450, 550, 'p36.31')],
+        '600': [('chr1', 550, 650, 'p36.23')]},
+    'gadAll': {'600': [('1', 590, 610, 'TP53')]},
+    'genomicSuperDups': {'200': [dup('chr2')], '600': [dup('chr3')]}}
+TRICKY_RELOADED = {
+    'dbSNP': {'200': [snp('rs2')], '300': [snp('rs6')], '700': [snp('rs7')]},
+    'Genes': TRICKY_BEFORE['Genes'],
+    'cytoBand': {'100': [('chr1', 0, 150, 'p36.33')],
+        '200': [('chr1', 150, 250, 'p36.32')],
+        '400': [('chr1', 350, 450, 'p36.31')],
+        '700': [('chr1', 650, 750, 'p36.22')]},
+    'gadAll': {'100': [('1', 90, 110, 'EGFR')],
+        '400': [('1', 390, 410, 'BRCA2')],
+        '600': [('1', 590, 610, 'TP53')]},
+    'genomicSuperDups': {'500': [dup('chr4')], '600': [dup('chr5')]}}
+
+
+@pytest.mark.parametrize('changed', [['dbSNP'], ['cytoBand'], ['gadAll'],
+    ['genomicSuperDups'], ['dbSNP', 'cytoBand', 'genomicSuperDups']])
+def test_reannotate_chunk_gives_what_a_full_run_gives(changed):
+    after = dict(TRICKY_BEFORE)
+    for name in changed:
+        after[name] = TRICKY_RELOADED[name]
+    found, stages = reannotate(TRICKY_LINES, TRICKY_BEFORE, after, changed,
+        TRICKY)
+    full = stages_over(after, TRICKY)
+    assert found == annotate(full, TRICKY_LINES)
+    # The counters of the stages annotated again count every record once
+    for stage, expected in zip(stages, full):
+        if stage.name in changed:
+            assert stage.counts == expected.counts
+
+
+def test_stages_that_share_keys_are_not_separable():
+    stages = driver.build_stages('vcf', 'dbSNP,cytoBand')
+    assert rean.separable(stages[1], stages)
+    stages[0].infoKeys = stages[0].infoKeys + ('cytoBand',)
+    assert not rean.separable(stages[1], stages)
+
+### EOF
@@ -0,0 +1,84 @@
+# test_snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of building a snapshot and looking rows up in it
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import pytest
+
+import snapshot as snap
+import reference_db
+
+COLUMNS = ['bin', 'chrom', 'chromStart', 'chromEnd', 'name', 'gieStain']
+ROWS = [(0, 'chr1', 100, 200, 'p36.2', 'gpos'),
+    (0, 'chr1', 0, 150, 'p36.3', 'gneg'),
+    (0, 'chrMT', 0, 500, 'mt1', 'gneg'),
+    (0, 'chrmt', 400, 900, 'mt2', 'gneg'),
+    (0, 'chr1', 120, 130, 'p36.1', 'acen')]
+
+
+@pytest.fixture
+def snapshot(tmp_path, capsys):
+    conn = reference_db.connect({'cytoBand': (COLUMNS, ROWS)})
+    snap.build(str(tmp_path / 'snap'), ['cytoBand'], conn=conn)
+    capsys.readouterr()
+    return snap.Snapshot(str(tmp_path / 'snap'))
+
+
+def test_span_returns_rows_in_table_order(snapshot):
+    assert [row[4] for row in snapshot.span('cytoBand', 'chr1', 125, 125)] \
+        == ['p36.2', 'p36.3', 'p36.1']
+    assert snapshot.span('cytoBand', 'chr1', 300, 400) == []
+    assert snapshot.span('cytoBand', 'chr2', 0, 1000) == []
+
+
+def test_span_batch_matches_span(snapshot):
+    positions = [0, 100, 125, 150, 151, 200, 201]
+    c = snapshot.chromosome('cytoBand', 'chr1')
+    assert c.span_batch(positions) == \
+        [snapshot.span('cytoBand', 'chr1', pos, pos) for pos in positions]
+
+
+def test_chromosomes_match_without_case(snapshot):
+    rows = [row[4] for row in snapshot.span('cytoBand', 'chrmt', 450, 450)]
+    assert rows == ['mt1', 'mt2']
+    assert snapshot.span('cytoBand', 'chrMT', 450, 450) == \
+        snapshot.span('cytoBand', 'CHRmt ', 450, 450)
+    assert snapshot.chromosome('cytoBand', 'Chr1') is \
+        snapshot.chromosome('cytoBand', 'chr1')
+
+
+def test_row_cache_stays_within_its_budget(snapshot):
+    expected = [snapshot.span('cytoBand', 'chr1', pos, pos)
+        for pos in range(0, 220, 10)]
+    assert snapshot.rows.evictions == 0
+    full = snapshot.rows.used
+
+    snapshot.rows.budget = full // 2
+    snapshot.rows.evict()
+    assert 0 < snapshot.rows.used <= full // 2
+    assert [snapshot.span('cytoBand', 'chr1', pos, pos)
+        for pos in range(0, 220, 10)] == expected
+    snapshot.span('cytoBand', 'chrMT', 450, 450)
+    assert snapshot.rows.used <= full // 2
+    assert snapshot.rows.evictions > 0
+
+    # The most recently returned row is kept whatever the budget
+    snapshot.rows.budget = 0
+    snapshot.rows.evict()
+    assert len(snapshot.rows.rows) == 1
+    assert snapshot.span('cytoBand', 'chr1', 125, 125) == expected[12]
+
+
+def test_open_snapshot_sets_the_row_cache_budget(snapshot, monkeypatch):
+    monkeypatch.setattr(snap, '_snapshots', {})
+    opened = snap.open_snapshot(snapshot.dirname, 1)
+    assert opened.rows.budget == 1024 * 1024
+    assert snap.open_snapshot(snapshot.dirname, 2) is opened
+    assert opened.rows.budget == 2 * 1024 * 1024
+
+### EOF
@@ -0,0 +1,99 @@
+# test_sweep.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the sweep join against a brute-force scan of a range table
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import random
+
+import pytest
+
+import interval_index
+import sweep
+import reference_db
+
+COLUMNS = ['chrom', 'chromStart', 'chromEnd', 'name']
+
+
+@pytest.fixture
+def rows():
+    rng = random.Random(11)
+    rows = []
+    for n in range(600):
+        start = rng.randrange(3000)
+        rows.append((rng.choice(['chr1', 'chr2']), start,
+            start + rng.randrange(400), 'r' + str(n)))
+    return rows
+
+
+def regionQuery(chrom):
+    return (interval_index.chromosome_statement('sweepRanges', 'chrom'),
+        (chrom,))
+
+
+@pytest.fixture
+def join(monkeypatch, rows):
+    conn = reference_db.connect({'sweepRanges': (COLUMNS, rows)})
+    monkeypatch.setattr(sweep.u, 'db_open', lambda: conn)
+    monkeypatch.setattr(sweep.u, '_pool', [])
+    return sweep.SweepJoin(regionQuery)
+
+
+# Rows with start <= pos <= end, in table order
+def brute_force(rows, chrom, pos):
+    return [row for row in rows if row[0] == chrom and row[1] <= pos <= row[2]]
+
+
+def test_overlapping_matches_brute_force(join, rows):
+    rng = random.Random(5)
+    for chrom in ['chr1', 'chr2']:
+        # Starting past the first regions, as a shard of the input would
+        for pos in sorted(rng.randrange(500, 3500) for n in range(300)):
+            assert join.overlapping(chrom, pos) == \
+                brute_force(rows, chrom, pos)
+    join.close()
+
+
+def test_overlapping_stops_at_the_first_variant_out_of_order(join, rows):
+    assert join.overlapping('chr1', 1000) == brute_force(rows, 'chr1', 1000)
+    assert join.overlapping('chr1', 900) is None
+    # Later variants in order are not swept again
+    assert join.overlapping('chr1', 2000) is None
+    assert join.conn is None
+
+
+def test_overlapping_stops_when_a_chromosome_comes_back(join, rows):
+    assert join.overlapping('chr1', 1000) == brute_force(rows, 'chr1', 1000)
+    assert join.overlapping('chr2', 100) == brute_force(rows, 'chr2', 100)
+    assert join.overlapping('chr1', 2000) is None
+    assert join.overlapping('chr2', 200) is None
+
+
+def test_read_streams_go_back_to_the_pool(join, rows):
+    assert join.overlapping('chr1', 3500) == brute_force(rows, 'chr1', 3500)
+    assert join.conn is None
+    assert len(sweep.u._pool) == 1
+    # The next stream reuses that connection and, left unread, discards
+    # it rather than pooling it again
+    assert join.overlapping('chr2', 0) == brute_force(rows, 'chr2', 0)
+    assert join.conn is not None and sweep.u._pool == []
+    join.close()
+    assert sweep.u._pool == []
+
+
+def test_chromosomes_past_the_stream_limit_are_not_swept(join, rows):
+    joins = [sweep.SweepJoin(regionQuery) for n in range(sweep.MAX_STREAMS)]
+    for other in joins:
+        assert other.overlapping('chr1', 0) == brute_force(rows, 'chr1', 0)
+    assert join.overlapping('chr1', 100) is None
+    assert join.overlapping('chr1', 200) is None
+    joins[0].close()
+    assert join.overlapping('chr2', 100) == brute_force(rows, 'chr2', 100)
+    for other in joins[1:] + [join]:
+        other.close()
+
+### EOF
@@ -0,0 +1,101 @@
+# test_ucsc_bin.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the UCSC bin predicate: every row a range query matches must
+# be in one of the candidate bins, at the bin edges in particular
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sqlite3
+
+import ucsc_bin as ub
+
+SIZE = 1 << ub.FIRST_SHIFT
+
+
+# UCSC's binFromRange() for the half-open range [start, end)
+def bin_from_range(start, end):
+    offsets = ub.OFFSETS
+    base = 0
+    if (end > ub.MAXEND):
+        offsets = ub.OFFSETS_EXTENDED
+        base = ub.OLD_TO_EXTENDED
+    startBin = start >> ub.FIRST_SHIFT
+    endBin = (end - 1) >> ub.FIRST_SHIFT
+    for offset in offsets:
+        if (startBin == endBin):
+            return base + offset + startBin
+        startBin = startBin >> ub.NEXT_SHIFT
+        endBin = endBin >> ub.NEXT_SHIFT
+    raise ValueError((start, end))
+
+
+# Rows around the edges of the bins at the first two levels, including
+# rows that end exactly at an edge and empty rows
+def edge_rows():
+    rows = []
+    for edge in [SIZE, 2 * SIZE, 8 * SIZE, 64 * SIZE]:
+        for start in [edge - 2, edge - 1, edge, edge + 1]:
+            for length in [0, 1, 2, 3, SIZE, 9 * SIZE]:
+                rows.append((start, start + length))
+    return rows + [(0, 1), (1, 1), (1, 2)]
+
+
+def test_params_hold_every_matching_row():
+    rows = edge_rows()
+    positions = set([p for start, end in rows
+        for p in (start - 1, start, start + 1, end - 1, end, end + 1)
+        if p >= 0])
+    for pos in positions:
+        bins = set(ub.params(pos, pos))
+        for start, end in rows:
+            if (start <= pos <= end):
+                assert bin_from_range(start, end) in bins, (pos, start, end)
+
+
+def test_bin_ranges_at_edges():
+    # A position on the first base of a bin also reaches back into the
+    # bin before it, for rows that end there
+    assert ub.bin_ranges(SIZE, SIZE)[0] == (585, 586)
+    assert ub.bin_ranges(SIZE + 1, SIZE + 1)[0] == (586, 586)
+    assert ub.bin_ranges(0, 0)[0] == (585, 585)
+    assert ub.bin_ranges(1, SIZE)[-1] == (0, 0)
+    assert len(ub.bin_ranges(1, 1)) == ub.LEVELS
+
+
+def test_params_fill_every_slot():
+    assert ub.predicate() == 'bin IN (' + ', '.join(['%s'] * ub.SLOTS) + ')'
+    assert ub.predicate('b').startswith('b IN (')
+    for pos in [0, 1, SIZE - 1, SIZE, SIZE + 1, 8 * SIZE]:
+        params = ub.params(pos, pos)
+        assert len(params) == ub.SLOTS
+        assert params[-1] == 0
+
+
+def test_no_bins_past_maxend():
+    assert ub.bin_ranges(ub.MAXEND, ub.MAXEND) is None
+    assert ub.params(ub.MAXEND - 1, ub.MAXEND) is None
+    assert ub.params(ub.MAXEND - 1, ub.MAXEND - 1) is not None
+
+
+def test_no_params_for_wide_ranges():
+    assert ub.params(1, 6 * SIZE) is None
+    assert ub.params(1, 2 * SIZE - 1) is not None
+
+
+def test_bin_sql_matches_bin_from_range():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table t (s integer, e integer)')
+    rows = [(start, end) for start, end in edge_rows() if end > start] + \
+        [(ub.MAXEND - 10, ub.MAXEND + 10), (ub.MAXEND + SIZE,
+        ub.MAXEND + SIZE + 1)]
+    conn.executemany('insert into t values (?, ?)', rows)
+    found = conn.execute('select s, e, ' + ub.bin_sql('s', 'e') + \
+        ' from t').fetchall()
+    assert [b for s, e, b in found] == \
+        [bin_from_range(s, e) for s, e in rows]
+
+### EOF
@@ -0,0 +1,40 @@
+# test_utils.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of how long the reference database secret is kept
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+
+import utils as u
+
+
+class SecretsManager(object):
+    def __init__(self):
+        self.fetched = 0
+
+    def get_secret_value(self, SecretId):
+        self.fetched = self.fetched + 1
+        return {'SecretString': json.dumps({'password': str(self.fetched)})}
+
+
+def test_secret_is_fetched_again_after_its_ttl(monkeypatch):
+    asm = SecretsManager()
+    now = [1000.0]
+    monkeypatch.setattr(u.boto3, 'client', lambda *args, **kwargs: asm)
+    monkeypatch.setattr(u.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(u, '_secret', None)
+
+    assert u.db_secret()['password'] == '1'
+    now[0] = now[0] + u.DB_SECRET_TTL - 1
+    assert u.db_secret()['password'] == '1'
+    assert u.db_secret(refresh=True)['password'] == '2'
+    now[0] = now[0] + u.DB_SECRET_TTL
+    assert u.db_secret()['password'] == '3'
+    assert asm.fetched == 3
+
+### EOF
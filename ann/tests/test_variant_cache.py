@@ -0,0 +1,86 @@
+# test_variant_cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of the variant cache: a warm run must write what a cold run
+# writes, records and counters alike
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import driver
+import pipeline
+import variant_cache
+from vcf_record import VcfRecord
+
+LINES = ['chr1\t100\t.\tA\tG\t.\t.\tAC=1;positionType=intron',
+    'chr1\t200\t.\tC\tT\t.\t.\tAC=2;positionType=intron',
+    'chr1\t300\t.\tG\tA\t.\t.\t.']
+
+
+# Genes with BigRefGene before it; every position but 300 is in a
+# transcript, which is counted by the positionType of the record
+def stages():
+    stages = driver.build_stages('vcf', 'Genes')
+    stages[0].query = lambda cursor, key: ()
+    stages[1].query = lambda cursor, key: [] if (key[1] == '300') else \
+        [((), '', 0, 0)]
+    return stages
+
+
+def run(cache, lines):
+    run_stages = stages()
+    records = [VcfRecord(line) for line in lines]
+    pipeline.annotate_cached(None, run_stages, records, cache)
+    return [record.serialize() for record in records], run_stages[1].counts
+
+
+def test_warm_run_matches_cold_run(tmp_path):
+    cache = variant_cache.VariantCache(str(tmp_path / 'cache.db'), 'v1')
+    cold = run(cache, LINES)
+    assert cold[1]['intronic_count'] == 2
+    assert cold[1]['interGenic_count'] == 1
+    assert run(cache, LINES) == cold
+    assert cache.hits == len(LINES)
+
+
+def test_key_holds_the_position_type_counted(tmp_path):
+    cache = variant_cache.VariantCache(str(tmp_path / 'cache.db'), 'v1')
+    run(cache, LINES)
+    lines = [line.replace('intron', 'utr3') for line in LINES]
+    warm = run(cache, lines)
+    cold = run(variant_cache.VariantCache(str(tmp_path / 'cold.db'), 'v1'),
+        lines)
+    assert warm == cold
+    assert (warm[1]['utr3_count'], warm[1]['intronic_count']) == (2, 0)
+
+    fields = VcfRecord(LINES[0])
+    other = VcfRecord(lines[0])
+    assert cache.key(stages(), fields) != cache.key(stages(), other)
+    assert cache.key(stages(), fields) == \
+        cache.key(stages(), VcfRecord(LINES[0]))
+
+
+def test_profiles_share_the_file(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    full = variant_cache.VariantCache(path, 'v1', profile='full')
+    run(full, LINES)
+    full.close()
+
+    fast = variant_cache.VariantCache(path, 'v1', profile='fast')
+    run(fast, LINES)
+    assert fast.hits == 0
+    fast.close()
+
+    full = variant_cache.VariantCache(path, 'v1', profile='full')
+    run(full, LINES)
+    assert full.hits == len(LINES)
+    full.close()
+
+    # Reloaded reference data empties the cache
+    full = variant_cache.VariantCache(path, 'v2', profile='full')
+    run(full, LINES)
+    assert full.hits == 0
+
+### EOF
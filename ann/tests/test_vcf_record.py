@@ -0,0 +1,106 @@
+# test_vcf_record.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Tests of VcfRecord against the plain list of columns it stands in for,
+# and of the padding the gadAll stage puts in the records
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import annotate as ann
+import vcf_record
+from vcf_record import VcfRecord, INFO
+
+SITES = 'chr1\t100\trs1\tA\tG\t50\tPASS\tAC=1;AN=2'
+SAMPLES = SITES + '\tGT:DP\t0/1:12\t1/1:7'
+
+
+def test_serialize_round_trip():
+    for line in [SITES, SAMPLES, 'chr1\t100\t.\tA\tG\t.\t.']:
+        record = VcfRecord(line)
+        assert record.serialize() == line
+        assert record.columns() == line.split('\t')
+        assert len(record) == len(line.split('\t'))
+        assert record == line.split('\t')
+
+
+def test_other_separator_is_written_with_tabs():
+    record = VcfRecord(SAMPLES.replace('\t', ','), sep=',')
+    assert record.serialize() == SAMPLES
+    assert record[INFO] == 'AC=1;AN=2'
+
+
+def test_info_fragments():
+    record = VcfRecord(SITES)
+    record.appendInfo('DB')
+    record.addInfo(';VC=SNV')
+    record.appendInfo('GMAF=0.1')
+    assert record[INFO] == 'AC=1;AN=2;DB;VC=SNV;GMAF=0.1'
+    assert record.info == ['AC=1;AN=2;DB;VC=SNV;GMAF=0.1']
+
+    record[INFO] = 'AC=1;'
+    record.appendInfo('DB')
+    assert record.serialize() == SITES.replace('AC=1;AN=2', 'AC=1;DB')
+
+
+def test_setting_a_sample_column():
+    record = VcfRecord(SAMPLES)
+    record[9] = '0/0:3'
+    assert record.serialize() == SAMPLES.replace('0/1:12', '0/0:3')
+    assert record[10] == '1/1:7'
+
+
+def test_copy_is_independent():
+    record = VcfRecord(SAMPLES)
+    copy = record.copy()
+    copy.appendInfo('DB')
+    copy[2] = 'rs2'
+    assert record.serialize() == SAMPLES
+    assert copy != record
+
+
+def test_pad_matches_list_of_columns():
+    for line in [SITES, SAMPLES]:
+        record = VcfRecord(line)
+        columns = line.split('\t')
+        vcf_record.pad(record)
+        vcf_record.pad(columns)
+        assert record.serialize() == '\t'.join(columns)
+        assert record == columns
+
+
+def test_restrip_only_touches_the_last_column():
+    record = VcfRecord(SITES + ' ')
+    record.restrip()
+    assert record.serialize() == SITES
+    record = VcfRecord(SAMPLES)
+    record.restrip()
+    assert record.serialize() == SAMPLES
+
+
+def test_gad_all_padding_round_trip():
+    stage = ann.GadAllStage()
+    for line in [SITES, SAMPLES]:
+        record = VcfRecord(line)
+        columns = line.split('\t')
+        rows = [('1', 90, 110, 'BRCA2'), ('1', 95, 105, 'BRCA2'),
+            ('1', 99, 101, 'TP53')]
+        stage.annotate(record, rows)
+        stage.annotate(columns, rows)
+        padded = record.serialize()
+        assert padded == '\t'.join(columns)
+        assert padded.split('\t')[INFO] == ' AC=1;AN=2;gadAll=BRCA2;gadAll=TP53'
+        assert all([c.startswith(' ') for c in padded.split('\t')[1:]])
+
+        # Taking the padding out gives the record as annotated, and
+        # putting it back gives the same line
+        unpadded = padded.replace('\t ', '\t')
+        assert unpadded == line.replace('AN=2', 'AN=2;gadAll=BRCA2;gadAll=TP53')
+        record = VcfRecord(unpadded)
+        record.pad()
+        assert record.serialize() == padded
+    assert stage.counts == {'var_count': 12, 'line_count': 4}
+
+### EOF
@@ -0,0 +1,155 @@
+# ucsc_bin.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# UCSC bin scheme for range queries against the reference tables, and
+# the (chrom, bin, start) indexes that let MySQL seek on it
+#
+# Add the bin column where a table lacks it and build the indexes with:
+#   python ucsc_bin.py [--dry-run]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+
+import utils as u
+
+# Standard scheme: 128 kb bins at the finest level, each level up
+# 8 times larger, for coordinates below 512 Mb
+FIRST_SHIFT = 17
+NEXT_SHIFT = 3
+OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+MAXEND = 512 * 1024 * 1024
+# Extended scheme, for rows that end past MAXEND
+OFFSETS_EXTENDED = [4096 + 512 + 64 + 8 + 1, 512 + 64 + 8 + 1,
+    64 + 8 + 1, 8 + 1, 1, 0]
+OLD_TO_EXTENDED = 4681
+LEVELS = len(OFFSETS)
+
+
+"""First and last bin at each level of the standard scheme for rows with
+start <= hi and lo <= end, as the annotation queries compare them. A
+row's bin covers its half-open range [start, end), so the bins are
+taken over [lo - 1, hi], which also holds the rows that end exactly at
+lo and empty rows. None past MAXEND, where the bins do not apply
+"""
+def bin_ranges(lo, hi):
+    lo = max(0, int(lo) - 1)
+    hi = int(hi)
+    if (hi >= MAXEND):
+        return None
+    ranges = []
+    shift = FIRST_SHIFT
+    for offset in OFFSETS:
+        ranges.append((offset + (lo >> shift), offset + (hi >> shift)))
+        shift = shift + NEXT_SHIFT
+    return ranges
+
+
+# Placeholders in predicate(): two bins a level, which is all a range
+# of up to 128 kb touches
+SLOTS = 2 * LEVELS
+
+
+"""SQL condition on column that holds for the candidate bins, as an IN
+list of SLOTS placeholders (see params()), so that MySQL seeks the
+(chrom, bin, start) index once per bin
+"""
+def predicate(column='bin'):
+    return column + ' IN (' + ', '.join(['%s'] * SLOTS) + ')'
+
+
+"""Parameters of predicate() for rows with start <= hi and lo <= end:
+the bins of bin_ranges(), with the last one repeated to fill the list.
+None past MAXEND or for a range that touches more than SLOTS bins
+"""
+def params(lo, hi):
+    ranges = bin_ranges(lo, hi)
+    if ranges is None:
+        return None
+    bins = [b for first, last in ranges for b in range(first, last + 1)]
+    if (len(bins) > SLOTS):
+        return None
+    return tuple(bins + [bins[-1]] * (SLOTS - len(bins)))
+
+
+"""SQL expression for the bin of a row from its start and end columns,
+as UCSC's binFromRange() computes it
+"""
+def bin_sql(startColumn, endColumn):
+    def levels(offsets, base):
+        cases = []
+        shift = FIRST_SHIFT
+        for offset in offsets[:-1]:
+            cases.append(f"WHEN ({startColumn} >> {str(shift)}) = " + \
+                f"(({endColumn} - 1) >> {str(shift)}) THEN " + \
+                f"{str(base + offset)} + ({startColumn} >> {str(shift)})")
+            shift = shift + NEXT_SHIFT
+        return 'CASE ' + ' '.join(cases) + f" ELSE {str(base)} END"
+    return f"CASE WHEN {endColumn} <= {str(MAXEND)} THEN " + \
+        levels(OFFSETS, 0) + ' ELSE ' + \
+        levels(OFFSETS_EXTENDED, OLD_TO_EXTENDED) + ' END'
+
+
+def has_column(cursor, table, column):
+    cursor.execute('select count(*) from information_schema.columns ' + \
+        'where table_schema = database() AND table_name = %s AND ' + \
+        'column_name = %s;', (table, column))
+    return (cursor.fetchone()[0] > 0)
+
+
+def has_index(cursor, table, name):
+    cursor.execute('select count(*) from information_schema.statistics ' + \
+        'where table_schema = database() AND table_name = %s AND ' + \
+        'index_name = %s;', (table, name))
+    return (cursor.fetchone()[0] > 0)
+
+
+"""Gives table a bin column, filled from its start and end columns, if
+it has none, and a (chrom, bin, start) index, or (bin, start) for
+tables without a chromosome column. Returns the statements run (or to
+run, with dry_run)
+"""
+def build_index(cursor, table, chromColumn, startColumn, endColumn,
+    dry_run=False):
+    statements = []
+    if not has_column(cursor, table, 'bin'):
+        statements.append('alter table ' + table + ' add column bin ' + \
+            'smallint unsigned not null default 0;')
+        statements.append('update ' + table + ' set bin = ' + \
+            bin_sql(startColumn, endColumn) + ';')
+
+    name = table + '_bin'
+    if not has_index(cursor, table, name):
+        columns = [c for c in [chromColumn, 'bin', startColumn] if c]
+        statements.append('create index ' + name + ' on ' + table + \
+            ' (' + ', '.join(columns) + ');')
+
+    if not dry_run:
+        for sql in statements:
+            cursor.execute(sql)
+    return statements
+
+
+if __name__ == '__main__':
+    import driver
+
+    dry_run = ('--dry-run' in sys.argv[1:])
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    tables = []
+    for stage in driver.build_stages('vcf'):
+        for spec in stage.rangeTables():
+            if spec not in tables:
+                tables.append(spec)
+    for spec in tables:
+        for sql in build_index(cursor, *spec, dry_run=dry_run):
+            print(sql)
+        print(f"{spec[0]} - done.")
+    if not dry_run:
+        conn.commit()
+    conn.close()
+
+### EOF
@@ -13,13 +13,35 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+# Idle connections kept open for reuse
+DB_POOL_SIZE = 8
+# Seconds the RDS secret is used for before it is fetched again
+DB_SECRET_TTL = 3600
+
+_secret = None
+_secret_time = 0.0
+_pool = []
+_pool_lock = threading.Lock()
+
+
+"""Get the RDS secret from AWS Secrets Manager. The secret is kept for
+DB_SECRET_TTL seconds, so a long job picks up a rotated password
+before its connections start failing, and fetched again sooner when
+refresh is True. run.py runs every job in a process of its own, so
+each job fetches the secret at least once
 """
-def db_connect():
+def db_secret(refresh=False):
+    global _secret, _secret_time
+    if (_secret is not None) and not refresh and \
+        (time.monotonic() - _secret_time < DB_SECRET_TTL):
+        return _secret
+
     AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
         ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
@@ -32,6 +54,25 @@ def db_connect():
         print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
         raise e
 
+    _secret = rds_secret
+    _secret_time = time.monotonic()
+    return _secret
+
+
+"""Open a new connection to the reference database
+If the cached secret is rejected (e.g. the password was rotated), the
+secret is fetched again and the connection retried once
+"""
+def db_open():
+    try:
+        return db_open_with(db_secret())
+    except pymysql.OperationalError as e:
+        print(f"Unable to connect to the reference database, retrying " + \
+            f"with a fresh secret: {e}")
+        return db_open_with(db_secret(refresh=True))
+
+
+def db_open_with(rds_secret):
     # Extract database connection parameters
     rds_host = rds_secret['host']
     mysql_port = rds_secret['port']
@@ -48,6 +89,70 @@ def db_connect():
         db=database_name)
 
 
+"""Connection handed out by db_connect()
+Behaves like the pymysql connection it wraps; close() returns the
+connection to the pool instead of closing it
+"""
+class PooledConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        if self.conn is None:
+            raise pymysql.InterfaceError("Connection already closed")
+        return getattr(self.conn, name)
+
+    def close(self):
+        if self.conn is not None:
+            db_release(self.conn)
+            self.conn = None
+
+    # Closes the connection instead of returning it to the pool, for one
+    # left with a result the next user could not get past
+    def discard(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+"""Get connection to reference database
+Connections the stages of the job have closed are reused after a ping,
+which reopens them if the server dropped them; a connection that cannot
+be revived is discarded and a new one opened. The pool belongs to the
+process: the shard workers of pipeline.py are forked before the job
+opens any connection, and open their own
+"""
+def db_connect():
+    while True:
+        with _pool_lock:
+            conn = _pool.pop() if _pool else None
+        if conn is None:
+            return PooledConnection(db_open())
+        try:
+            conn.ping(reconnect=True)
+            return PooledConnection(conn)
+        except pymysql.Error as e:
+            print(f"Discarding broken reference database connection: {e}")
+            try:
+                conn.close()
+            except pymysql.Error:
+                pass
+
+
+"""Return a connection to the pool, or close it if the pool is full
+"""
+def db_release(conn):
+    try:
+        conn.rollback()
+    except pymysql.Error:
+        return
+    with _pool_lock:
+        if (len(_pool) < DB_POOL_SIZE):
+            _pool.append(conn)
+            return
+    conn.close()
+
+
 """Column inices for pileup and VCF
 """
 def getFormatSpecificIndices(format='vcf'):
@@ -0,0 +1,196 @@
+# variant_cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# On-disk cache of the annotation each variant received, shared by
+# annotator jobs and processes on a host
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import sqlite3
+
+import vcf_record
+
+# Keys looked up or stored per statement
+BATCH = 500
+
+
+"""Size-bounded LRU cache of variant annotations, in a SQLite file
+
+An entry is keyed by the lookup keys every stage computes for the record
+(so it covers exactly what the stages look up), the values of the input
+INFO that stages read (the positionType Genes counts by, see
+annotate.Stage.infoInputs) and the few properties of the INFO column
+that change how stages write to it. It holds the ID
+column, the text added to INFO, whether the record was padded by gadAll
+and the counter increments each stage made in annotate(), so a hit
+reproduces both the record and its counts in the .count.log. Counters
+kept while looking variants up (dbSNP lookups avoided by the Bloom
+filter, BigRefGene lookups) measure the database work of the run
+itself: they only count the variants that missed the cache, so those
+lines of the .count.log are lower on a warm run than on a cold one.
+
+version identifies the reference data; entries of any other version
+are dropped when the cache is opened, so refreshing the reference
+tables invalidates the cache. profile names the stages of the run (and
+the input format): jobs that run other stages keep their entries apart
+in the same file rather than replacing each other's. Entries are
+evicted least recently used first, whatever their profile, once the
+file grows past budget bytes.
+"""
+class VariantCache(object):
+    def __init__(self, path, version, budget=1024 * 1024 * 1024,
+        profile=''):
+        self.path = path
+        self.version = version
+        self.profile = profile
+        self.budget = budget
+        self.db = None
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Connections are not pickled (see pipeline.annotate_sharded); each
+    # process opens its own
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['db'] = None
+        return state
+
+    def connect(self):
+        if self.db is not None:
+            return self.db
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.execute('pragma journal_mode=WAL;')
+        self.db.execute('create table if not exists variants (' + \
+            'profile text, key text, version text, value text, ' + \
+            'used integer, primary key (profile, key));')
+        self.db.execute('create index if not exists variants_used ' + \
+            'on variants (used);')
+        self.db.execute('delete from variants where version != ?;',
+            (self.version,))
+        self.db.commit()
+        row = self.db.execute('select max(used) from variants;').fetchone()
+        self.clock = row[0] or 0
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    """Cache key of a split record, or None if the record is not cached
+    """
+    def key(self, stages, fields):
+        if (len(fields) < 8):
+            return None
+        info = fields[7]
+        shape = [len(fields) == 8, info == '.', info.startswith('.'),
+            info.endswith(';')]
+        return json.dumps([[stage.key(fields) for stage in stages],
+            [stage.infoInputs(fields) for stage in stages], shape])
+
+    # Entries for a list of keys, as a dict; hits become most recently
+    # used
+    def get(self, keys):
+        db = self.connect()
+        found = {}
+        for i in range(0, len(keys), BATCH):
+            batch = keys[i:i + BATCH]
+            sql = 'select key, value from variants where profile = ? ' + \
+                'AND key in (' + ','.join(['?'] * len(batch)) + ');'
+            for key, value in db.execute(sql, [self.profile] + batch):
+                found[key] = json.loads(value)
+
+        if found:
+            self.clock = self.clock + 1
+            hit = list(found.keys())
+            for i in range(0, len(hit), BATCH):
+                batch = hit[i:i + BATCH]
+                db.execute('update variants set used = ? where ' + \
+                    'profile = ? AND key in (' + \
+                    ','.join(['?'] * len(batch)) + ');',
+                    [self.clock, self.profile] + batch)
+            db.commit()
+        self.hits = self.hits + len(found)
+        self.misses = self.misses + len(keys) - len(found)
+        return found
+
+    """Rewrites a split record as the annotation in entry, and adds the
+    entry's counter increments to stages
+    """
+    def apply(self, stages, fields, entry):
+        rsid, tail, padded, counts = entry
+        if rsid is not None:
+            fields[2] = rsid
+        fields[7] = ('' if (fields[7] == '.') else fields[7]) + tail
+        if padded:
+            vcf_record.pad(fields)
+        for i, deltas in counts:
+            stage = stages[i]
+            for name, delta in deltas:
+                stage.counts[name] = stage.counts[name] + delta
+
+    """Entry that turns original into annotated, or None if the change
+    is not one apply() can reproduce
+    """
+    def entry(self, stages, original, annotated, counts):
+        padded = annotated[1].startswith(' ')
+        pad = ' ' if padded else ''
+        info = annotated[7][len(pad):]
+        base = '' if (original[7] == '.') else original[7]
+        if not info.startswith(base):
+            return None
+        rsid = None
+        if any([stage.writesId for stage in stages]):
+            rsid = annotated[2][len(pad):]
+        entry = [rsid, info[len(base):], padded, counts]
+
+        fields = original.copy()
+        self.apply(stages, fields, [rsid, entry[1], padded, []])
+        if (fields != annotated):
+            return None
+        return entry
+
+    # Stores (key, original, annotated, counts) tuples
+    def put(self, stages, records):
+        rows = []
+        for key, original, annotated, counts in records:
+            entry = self.entry(stages, original, annotated, counts)
+            if entry is not None:
+                rows.append((self.profile, key, self.version,
+                    json.dumps(entry), self.clock))
+        if (len(rows) == 0):
+            return
+
+        db = self.connect()
+        db.executemany('insert or replace into variants ' + \
+            '(profile, key, version, value, used) values ' + \
+            '(?, ?, ?, ?, ?);', rows)
+        db.commit()
+        self.evict()
+
+    # Bytes in use; pages freed by evict() are reused by later entries
+    def size(self):
+        db = self.connect()
+        pages = db.execute('pragma page_count;').fetchone()[0] - \
+            db.execute('pragma freelist_count;').fetchone()[0]
+        return pages * db.execute('pragma page_size;').fetchone()[0]
+
+    # Drops the least recently used tenth of the entries while the cache
+    # is over budget
+    def evict(self):
+        db = self.connect()
+        while (self.size() > self.budget):
+            count = db.execute('select count(*) from variants;').fetchone()[0]
+            if (count == 0):
+                return
+            db.execute('delete from variants where rowid in (select ' + \
+                'rowid from variants order by used limit ?);',
+                (max(1, count // 10),))
+            db.commit()
+
+### EOF
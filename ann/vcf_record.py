@@ -0,0 +1,153 @@
+# vcf_record.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Compact record for a VCF line that is split only as far as INFO
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+INFO = 7
+
+
+"""A VCF line split into CHROM through FILTER (head), the INFO column
+(a list of fragments joined only when INFO is read or written out) and
+the FORMAT and sample columns, kept as the raw rest of the line. Stages
+index a record like the list of its columns; reading or setting a
+sample column splits the rest of the line, which no stage does.
+
+padded counts the times every column after CHROM has had a space put
+in front of it (see pad()); the sample columns get theirs as the record
+is written out
+"""
+class VcfRecord(object):
+    __slots__ = ('head', 'info', 'rest', 'sep', 'padded')
+
+    def __init__(self, line, sep='\t'):
+        parts = line.split(sep, INFO + 1)
+        self.head = parts[:INFO]
+        self.info = parts[INFO:INFO + 1]
+        self.rest = parts[INFO + 1] if (len(parts) > INFO + 1) else None
+        self.sep = sep
+        self.padded = 0
+
+    def copy(self):
+        record = VcfRecord.__new__(VcfRecord)
+        record.head = list(self.head)
+        record.info = [self[INFO]] if self.info else []
+        record.rest = self.rest
+        record.sep = self.sep
+        record.padded = self.padded
+        return record
+
+    # The sample columns, as written out
+    def samples(self):
+        rest = self.rest
+        if (self.sep != '\t'):
+            rest = rest.replace(self.sep, '\t')
+        if (self.padded > 0):
+            pad = ' ' * self.padded
+            rest = pad + rest.replace('\t', '\t' + pad)
+        return rest
+
+    # Every column, as a list
+    def columns(self):
+        columns = self.head + ([self[INFO]] if self.info else [])
+        if self.rest is not None:
+            columns = columns + self.samples().split('\t')
+        return columns
+
+    def __len__(self):
+        count = len(self.head) + len(self.info)
+        if self.rest is not None:
+            count = count + self.rest.count(self.sep) + 1
+        return count
+
+    def __getitem__(self, i):
+        if (i == INFO) and self.info:
+            if (len(self.info) > 1):
+                self.info[:] = [''.join(self.info)]
+            return self.info[0]
+        if (0 <= i < len(self.head)):
+            return self.head[i]
+        return self.columns()[i]
+
+    def __setitem__(self, i, value):
+        if (i == INFO) and self.info:
+            self.info[:] = [value]
+        elif (0 <= i < len(self.head)):
+            self.head[i] = value
+        else:
+            columns = self.columns()
+            columns[i] = value
+            self.head = columns[:INFO]
+            self.info = columns[INFO:INFO + 1]
+            self.rest = '\t'.join(columns[INFO + 1:]) \
+                if (len(columns) > INFO + 1) else None
+            self.sep = '\t'
+            self.padded = 0
+
+    def __eq__(self, other):
+        if isinstance(other, VcfRecord):
+            return (self.head == other.head) and \
+                (self[INFO] if self.info else None) == \
+                (other[INFO] if other.info else None) and \
+                ((self.rest is None) == (other.rest is None)) and \
+                ((self.rest is None) or (self.samples() == other.samples()))
+        return self.columns() == list(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    # Adds text to the end of INFO
+    def addInfo(self, text):
+        self.info.append(text)
+
+    # Adds text to INFO as a new ;-separated entry
+    def appendInfo(self, text):
+        last = ''
+        for fragment in reversed(self.info):
+            if fragment:
+                last = fragment
+                break
+        self.info.append(text if last.endswith(';') else ';' + text)
+
+    # Puts a space in front of every column after CHROM
+    def pad(self):
+        self.head[1:] = [' ' + f for f in self.head[1:]]
+        if self.info:
+            self.info[:] = [' ' + self[INFO]]
+        self.padded = self.padded + 1
+
+    # Drops trailing whitespace from the last column. The sample
+    # columns come from a stripped line and are never edited, so only
+    # a record that ends at INFO or before can have any
+    def restrip(self):
+        if self.rest is not None:
+            return
+        if self.info:
+            self.info[:] = [self[INFO].rstrip()]
+        elif self.head:
+            self.head[-1] = self.head[-1].rstrip()
+
+    # The record as a tab-separated line, without the newline
+    def serialize(self):
+        line = '\t'.join(self.head)
+        if self.info:
+            line = line + '\t' + ''.join(self.info)
+        if self.rest is not None:
+            line = line + '\t' + self.samples()
+        return line
+
+
+"""Puts a space in front of every column after CHROM of a split record,
+which may be a list of columns or a VcfRecord
+"""
+def pad(fields):
+    if isinstance(fields, VcfRecord):
+        fields.pad()
+    else:
+        fields[1:] = [' ' + f for f in fields[1:]]
+
+### EOF
@@ -125,6 +125,10 @@ class Config(object):
   # Time before free user results are archived (in seconds)
   FREE_USER_DATA_RETENTION = 300
 
+  # Annotation profiles users can pick (see PROFILES in ann/driver.py)
+  ANNOTATION_PROFILES = ["full", "fast", "cnv"]
+  ANNOTATION_PROFILE_DEFAULT = "full"
+
 class DevelopmentConfig(Config):
   DEBUG = True
   GAS_LOG_LEVEL = 'DEBUG'
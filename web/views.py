@@ -65,7 +65,9 @@ def annotate():
   conditions = [
     ["starts-with", "$success_action_redirect", redirect_url],
     {"x-amz-server-side-encryption": encryption},
-    {"acl": acl}
+    {"acl": acl},
+    # The annotation profile picked in the form is stored with the upload
+    ["starts-with", "$x-amz-meta-annotation-profile", ""]
   ]
 
   # Generate the presigned POST call
@@ -81,7 +83,9 @@ def annotate():
     return abort(500)
     
   # Render the upload form which will parse/submit the presigned POST
-  return render_template('annotate.html', s3_post=presigned_post)
+  return render_template('annotate.html', s3_post=presigned_post,
+    profiles=app.config['ANNOTATION_PROFILES'],
+    default_profile=app.config['ANNOTATION_PROFILE_DEFAULT'])
 
 
 """Fires off an annotation job
@@ -136,12 +140,24 @@ def create_annotation_job_request():
   
   email = session.get('email')
 
+  #Annotation profile the user picked, stored as metadata of the upload
+  s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  try:
+      metadata = s3.head_object(Bucket=bucket_name, Key=s3_key)['Metadata']
+  except ClientError as e:
+      print(e.response)
+      raise
+  annotation_profile = metadata.get('annotation-profile')
+  if annotation_profile not in app.config['ANNOTATION_PROFILES']:
+      annotation_profile = app.config['ANNOTATION_PROFILE_DEFAULT']
+
   #Data to be persisted in DynamoDB
   data = { 'job_id': job_id, 'user_id': user_id, 'input_file_name': input_file,   
   "s3_inputs_bucket": bucket_name, 
   "s3_key_input_file": key_input_file, 
   "submit_time": epoch,
   "email": email,
+  "annotation_profile": annotation_profile,
   "job_status": "PENDING",
   }
 
@@ -305,6 +321,7 @@ def annotation_details(id):
       temp_dict['submit_time']= time.strftime('%Y-%m-%d %H:%M', time.localtime(epoch_submit_time))
       temp_dict['input_file_name'] = i['input_file_name']
       temp_dict['job_status'] = i['job_status']
+      temp_dict['annotation_profile'] = i.get('annotation_profile', 'full')
       epoch_complete_time = i['complete_time']
       temp_dict['complete_time']= time.strftime('%Y-%m-%d %H:%M', time.localtime(epoch_complete_time))
       temp_dict['s3_key_results_file'] = i['s3_key_results_file']
@@ -339,6 +356,7 @@ def annotation_details(id):
       temp_dict['submit_time']= time.strftime('%Y-%m-%d %H:%M', time.localtime(epoch_submit_time))
       temp_dict['input_file_name'] = i['input_file_name']
       temp_dict['job_status'] = i['job_status']
+      temp_dict['annotation_profile'] = i.get('annotation_profile', 'full')
       response_list.append(temp_dict)
 
 